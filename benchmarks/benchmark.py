@@ -0,0 +1,240 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""Benchmark dwarf2ctypes on synthetic binaries with a lot of DWARF.
+
+Generates C sources at a configurable scale, compiles them into a fixture,
+converts its root type with `dwarf2ctypes.TypeLibrary` in a fresh process,
+and prints the results as JSON:
+
+    python benchmarks/benchmark.py --profile vmlinux --output results.json
+
+The generated types have what makes vmlinux expensive to convert:
+
+  - `--cus` CUs, each defining a struct that points to the struct of the
+    next CU through a forward declaration, the last one pointing back to
+    the first, so the types form one big cycle across CUs;
+  - a header included by every CU, so its types are repeated in all of them;
+  - a union of `--union-width` members in that header;
+  - a chain of `--depth` structs, each holding the next one by value.
+
+Every run reports the wall time and the peak RSS at the end of each phase
+of the conversion, the `ConversionStats` counters, and the number of DIEs
+of the fixture.
+"""
+
+import argparse
+import concurrent.futures
+import dataclasses
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dwarf2ctypes
+
+
+RESULTS_VERSION = 1
+
+PROFILES = {
+    'small': dict(cus=50, depth=10, union_width=16),
+    'medium': dict(cus=500, depth=30, union_width=64),
+    'vmlinux': dict(cus=3000, depth=60, union_width=256),
+}
+
+ROOT_TYPE = b'root'
+
+# Base types dwarf2ctypes converts, used round robin for generated members.
+_MEMBER_TYPES = ('char', 'short', 'int', 'long', 'unsigned char',
+                 'unsigned short', 'unsigned int', 'unsigned long',
+                 'long long', '_Bool')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profile', choices=PROFILES, default='small',
+                        help='scale of the generated fixture')
+    parser.add_argument('--cus', type=int, help='number of CUs')
+    parser.add_argument('--depth', type=int, help='length of the chain of nested structs')
+    parser.add_argument('--union-width', type=int, help='number of members of the wide union')
+    parser.add_argument('--cc', default=os.environ.get('CC', 'gcc'),
+                        help='C compiler, gcc or clang')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='number of parallel compilations')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of conversions to measure')
+    parser.add_argument('--work-dir',
+                        help='where to generate the fixture, kept between runs '
+                             '(default: a temporary directory)')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--measure', metavar='BINARY', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure is not None:
+        json.dump(measure(args.measure, ROOT_TYPE), sys.stdout)
+        return
+
+    params = dict(PROFILES[args.profile])
+    for name in params:
+        if getattr(args, name) is not None:
+            params[name] = getattr(args, name)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = args.work_dir or tmp_dir
+        start = time.perf_counter()
+        binary_path = build_fixture(work_dir, args.cc, args.jobs, **params)
+        build_seconds = time.perf_counter() - start
+
+        runs = [measure_in_subprocess(binary_path) for _ in range(args.repeat)]
+        results = {
+            'version': RESULTS_VERSION,
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'compiler': _compiler_version(args.cc),
+            'profile': args.profile,
+            'params': params,
+            'fixture': {
+                'size': os.path.getsize(binary_path),
+                'dies': count_dies(binary_path),
+                'build_seconds': build_seconds,
+            },
+            'runs': runs,
+        }
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+def generate_sources(cus, depth, union_width):
+    """Returns a dict mapping file names to the C sources of a fixture."""
+    header = ['#ifndef BENCH_H', '#define BENCH_H', '',
+              'struct list_head {', '  struct list_head *next, *prev;', '};', '',
+              'union wide {']
+    for i in range(union_width):
+        header.append(f'  {_MEMBER_TYPES[i % len(_MEMBER_TYPES)]} m{i};')
+    header += ['};', '',
+               'struct shared {',
+               '  struct list_head list;',
+               '  union wide wide;',
+               '  int refcount;',
+               '};', '', '#endif']
+    sources = {'bench.h': '\n'.join(header) + '\n'}
+
+    for i in range(cus):
+        next_i = (i + 1) % cus
+        lines = ['#include "bench.h"', '',
+                 f'struct s{next_i};', '',
+                 f'struct s{i} {{',
+                 '  struct shared shared;',
+                 f'  struct s{next_i} *next;',
+                 '  unsigned long flags;',
+                 '  char name[16];',
+                 f'}} s{i}_var;']
+        if i == 0:
+            lines.append('')
+            lines.append(f'struct nest{depth} {{\n  int leaf;\n}};')
+            for level in reversed(range(depth)):
+                lines.append(f'struct nest{level} {{\n  struct nest{level + 1} inner;\n'
+                             f'  int level;\n}};')
+            lines += ['',
+                      'struct root {',
+                      '  struct s0 *first;',
+                      '  struct nest0 nest;',
+                      '  struct shared shared;',
+                      '} root_var;']
+        sources[f'cu{i}.c'] = '\n'.join(lines) + '\n'
+    return sources
+
+
+def build_fixture(work_dir, cc, jobs, cus, depth, union_width):
+    """Generate and compile a fixture in `work_dir`, return its path.
+
+    CUs are linked into a shared object, so its DWARF sections need no
+    relocations.  A fixture already built with the same parameters is reused.
+    """
+    name = f'bench-{os.path.basename(cc)}-{cus}-{depth}-{union_width}'
+    fixture_dir = os.path.join(work_dir, name)
+    binary_path = os.path.join(fixture_dir, f'{name}.so')
+    if os.path.exists(binary_path):
+        return binary_path
+
+    os.makedirs(fixture_dir, exist_ok=True)
+    sources = generate_sources(cus, depth, union_width)
+    for file_name, source in sources.items():
+        with open(os.path.join(fixture_dir, file_name), 'w') as f:
+            f.write(source)
+
+    c_files = [file_name for file_name in sources if file_name.endswith('.c')]
+
+    def compile_cu(file_name):
+        object_name = file_name[:-len('.c')] + '.o'
+        subprocess.run([cc, '-g', '-fPIC', '-c', file_name, '-o', object_name],
+                       cwd=fixture_dir, check=True)
+        return object_name
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        object_names = list(executor.map(compile_cu, c_files))
+    tmp_path = f'{binary_path}.tmp'
+    subprocess.run([cc, '-shared', '-nostdlib', '-o', tmp_path] + object_names,
+                   cwd=fixture_dir, check=True)
+    os.replace(tmp_path, binary_path)
+    return binary_path
+
+
+def measure_in_subprocess(binary_path):
+    """Run `measure` in a fresh interpreter, so RSS only counts one conversion."""
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--measure', binary_path],
+        check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output)
+
+
+def measure(binary_path, type_name):
+    """Convert `type_name` from `binary_path`, return timings and counters."""
+    phases = {}
+
+    def trace(event, **details):
+        if event == 'phase':
+            phase = phases.setdefault(details['phase'], {'seconds': 0})
+            phase['seconds'] += details['seconds']
+            phase['peak_rss_kib'] = _peak_rss_kib()
+
+    start = time.perf_counter()
+    library = dwarf2ctypes.TypeLibrary(binary_path, trace=trace)
+    library.get_type(type_name)
+    wall_seconds = time.perf_counter() - start
+    return {
+        'wall_seconds': wall_seconds,
+        'peak_rss_kib': _peak_rss_kib(),
+        'phases': phases,
+        'stats': dataclasses.asdict(library.stats),
+    }
+
+
+def count_dies(binary_path):
+    dwarf_info = dwarf2ctypes._get_dwarf_info(binary_path)
+    return sum(1 for cu in dwarf_info.iter_CUs() for _ in cu.iter_DIEs())
+
+
+def _peak_rss_kib():
+    # ru_maxrss is in KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _compiler_version(cc):
+    output = subprocess.run([cc, '--version'], check=True,
+                            stdout=subprocess.PIPE, text=True).stdout
+    return output.splitlines()[0]
+
+
+if __name__ == '__main__':
+    main()
@@ -5,11 +5,26 @@ Not every possible C type is supported.  Places where some corners were cut are
 marked with `XXX`.
 """
 import ctypes
-from dataclasses import dataclass
-from collections import defaultdict
+from dataclasses import dataclass, field
+from collections import defaultdict, namedtuple
+import bisect
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import itertools
+import json
+import keyword
+import mmap
+import os
+import pickle
+import py_compile
+import struct
 import threading
+import time
 
-from elftools.elf.elffile import ELFFile
+# Default size limit of a `cache_dir`.
+DEFAULT_CACHE_MAX_BYTES = 1 << 30
 
 
 def main():
@@ -17,16 +32,77 @@ def main():
     type_ = get_type(path, b'task_struct', relocate_dwarf_sections=False)
 
 
-def get_type(binary_path, struct_name, relocate_dwarf_sections=True):
-    dwarf_info = _get_dwarf_info(binary_path,
-                                 relocate_dwarf_sections=relocate_dwarf_sections)
-    print('Got dwarf_info')
-    type_die = _find_type_die(dwarf_info, struct_name)
-    type_ctypes = convert_type_die_to_ctypes(type_die)
-    return type_ctypes
+def get_type(binary_path, struct_name, relocate_dwarf_sections=True,
+             cache_dir=None, cache_max_bytes=DEFAULT_CACHE_MAX_BYTES,
+             index_jobs=None, max_pointer_depth=None, max_structs=None):
+    """Convert the type named `struct_name` in `binary_path` to ctypes.
+
+    With `cache_dir`, the name index of the binary and the converted layout
+    are kept there between runs.  A later call for the same type loads the
+    layout and doesn't parse DWARF at all.  See `TypeLibrary` for converting
+    several types of one binary, and for `max_pointer_depth` and
+    `max_structs`, which limit how much of the type graph is converted.
+    """
+    library = TypeLibrary(binary_path,
+                          relocate_dwarf_sections=relocate_dwarf_sections,
+                          cache_dir=cache_dir, cache_max_bytes=cache_max_bytes,
+                          index_jobs=index_jobs,
+                          max_pointer_depth=max_pointer_depth,
+                          max_structs=max_structs)
+    return library.get_type(struct_name)
+
+
+def get_types(binary_path, struct_names, relocate_dwarf_sections=True,
+              cache_dir=None, cache_max_bytes=DEFAULT_CACHE_MAX_BYTES,
+              index_jobs=None, max_pointer_depth=None, max_structs=None):
+    """Convert the types named `struct_names` in `binary_path` to ctypes.
+
+    Returns a dict mapping names to ctypes types.  Types reachable from
+    several of the names are converted once.
+    """
+    library = TypeLibrary(binary_path,
+                          relocate_dwarf_sections=relocate_dwarf_sections,
+                          cache_dir=cache_dir, cache_max_bytes=cache_max_bytes,
+                          index_jobs=index_jobs,
+                          max_pointer_depth=max_pointer_depth,
+                          max_structs=max_structs)
+    return library.get_types(struct_names)
+
+
+def update_layouts(binary_path, previous, names=None,
+                   relocate_dwarf_sections=True):
+    """Convert types of a rebuilt `binary_path`, reusing unchanged ones.
+
+    See `TypeLibrary.update_layouts`.
+    """
+    library = TypeLibrary(binary_path,
+                          relocate_dwarf_sections=relocate_dwarf_sections)
+    return library.update_layouts(previous, names)
 
 
-def _get_dwarf_info(binary_path, relocate_dwarf_sections=True):
+def convert_type_die_to_ctypes(type_die):
+    """Convert `type_die` to ctypes, with a fresh `TypeLibrary`."""
+    library = TypeLibrary(dwarf_info=type_die.dwarfinfo)
+    return library.convert_type_die_to_ctypes(type_die)
+
+
+def _get_dwarf_info(binary_path, relocate_dwarf_sections=True,
+                    mmap_sections=True):
+    # pyelftools is imported lazily, so that loading saved layouts doesn't
+    # need it.
+    from elftools.elf.elffile import ELFFile
+
+    if mmap_sections:
+        # The mapping outlives the file object, and stays alive as long as
+        # the section streams of the DWARF info refer to it.
+        with open(binary_path, 'rb') as f:
+            mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        elf_file = _open_mapped_elf_file(mapped_file)
+        if not elf_file.has_dwarf_info():
+            raise RuntimeError(f'{binary_path} has no DWARF info')
+        return elf_file.get_dwarf_info(
+            relocate_dwarf_sections=relocate_dwarf_sections)
+
     with open(binary_path, 'rb') as f:
         elf_file = ELFFile(f)
         if not elf_file.has_dwarf_info():
@@ -36,190 +112,2330 @@ def _get_dwarf_info(binary_path, relocate_dwarf_sections=True):
     return dwarf_info
 
 
-def _find_type_die(dwarf_info, name: bytes):
+def _open_mapped_elf_file(mapped_file):
+    """Returns an ELFFile whose DWARF sections are views of `mapped_file`.
+
+    pyelftools copies every DWARF section into memory before parsing it.
+    Sections that are used as they are on disk are read from the mapping
+    instead, so only the pages of the DIEs actually parsed are loaded.
+    Sections that need relocations or decompression are still copied.
+    """
+    from elftools.dwarf.dwarfinfo import DebugSectionDescriptor
+    from elftools.elf.elffile import ELFFile
+    from elftools.elf.relocation import RelocationHandler
+
+    class MappedELFFile(ELFFile):
+        def _read_dwarf_section(self, section, relocate_dwarf_sections):
+            copy_needed = (
+                section.compressed or
+                section.name.startswith('.zdebug') or
+                section['sh_type'] == 'SHT_NOBITS' or
+                self.has_phantom_bytes() or
+                (relocate_dwarf_sections and
+                 RelocationHandler(self).find_relocations_for_section(section)
+                 is not None))
+            if copy_needed:
+                return super()._read_dwarf_section(section,
+                                                   relocate_dwarf_sections)
+            return DebugSectionDescriptor(
+                stream=_MappedSectionStream(self.stream, section['sh_offset'],
+                                            section.data_size),
+                name=section.name,
+                global_offset=section['sh_offset'],
+                size=section.data_size,
+                address=section['sh_addr'])
+
+    return MappedELFFile(mapped_file)
+
+
+class _MappedSectionStream:
+    """A read-only stream over `size` bytes of `mapped_file` at `offset`.
+
+    Reads only copy the bytes asked for, and `getbuffer()` returns the whole
+    section as a memoryview without copying it.
+    """
+
+    def __init__(self, mapped_file, offset, size):
+        self._mapped_file = mapped_file
+        self._offset = offset
+        self._size = size
+        self._position = 0
+
+    def read(self, size=-1):
+        start = self._position
+        end = self._size if size is None or size < 0 else min(start + size,
+                                                                self._size)
+        if start >= end:
+            return b''
+        self._position = end
+        return self._mapped_file[self._offset + start:self._offset + end]
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self._position + offset
+        elif whence == os.SEEK_END:
+            position = self._size + offset
+        else:
+            raise ValueError(f'Invalid whence: {whence}')
+        if position < 0:
+            raise ValueError(f'Negative seek position {position}')
+        self._position = position
+        return position
 
-    def check(die):
-        return (die.attributes.get('DW_AT_name') and
-                die.attributes.get('DW_AT_name').value == name)
+    def tell(self):
+        return self._position
 
-    for compilation_unit in dwarf_info.iter_CUs():
-        top_die = compilation_unit.get_top_DIE()
-        if check(top_die):
-            return top_die
-        for child in top_die.iter_children():
-            if check(child):
-                return child
-    else:
-        raise ValueError(f'No type DIE named {name} found')
+    def getbuffer(self):
+        return memoryview(self._mapped_file)[self._offset:
+                                             self._offset + self._size]
 
 
-def convert_type_die_to_ctypes(type_die):
-    # traverse the graph.  save structs and their relationships
+def _is_declaration(die):
+    return ('DW_AT_declaration' in die.attributes and
+            die.attributes['DW_AT_declaration'].value)
 
-    nodes = set()
-    refs = defaultdict(set)
-    pointer_refs = defaultdict(set)
 
-    def traverse(type_die):
-        if type_die in nodes:
+# Kinds of `TypeIndex` entries.  They are the first byte of an index key.
+_INDEX_ANY = 0
+_INDEX_DEFINITION = 1
+_INDEX_DECLARATION = 2
+
+
+def _index_key(kind, tag, name: bytes):
+    return bytes((kind,)) + tag.encode('ascii') + b'\0' + name
+
+
+class _BaseTypeIndex:
+
+    def __init__(self, dwarf_info, die_at=None):
+        """`die_at(offset)` returns found DIEs, by default parsed by pyelftools."""
+        self._dwarf_info = dwarf_info
+        self._die_at = die_at or dwarf_info.get_DIE_from_refaddr
+
+    def _lookup(self, key):
+        """Return the DIE offset stored under `key`, or None."""
+        raise NotImplementedError
+
+    def _get_die(self, key):
+        offset = self._lookup(key)
+        if offset is None:
+            return None
+        return self._die_at(offset)
+
+    def find(self, name: bytes):
+        """Return the first top level DIE named `name`, or None."""
+        return self._get_die(_index_key(_INDEX_ANY, '', name))
+
+    def find_definition(self, tag, name: bytes):
+        """Return the first non-declaration DIE with `tag` and `name`, or None."""
+        return self._get_die(_index_key(_INDEX_DEFINITION, tag, name))
+
+    def find_declaration(self, tag, name: bytes):
+        """Return the first declaration DIE with `tag` and `name`, or None."""
+        return self._get_die(_index_key(_INDEX_DECLARATION, tag, name))
+
+
+class TypeIndex(_BaseTypeIndex):
+    """Maps names of top level DIEs to their offsets in `.debug_info`.
+
+    The index is built with a single walk over all compilation units.
+    Definitions and declarations are kept apart, so resolving a forward
+    declaration is a dictionary lookup instead of another walk.  When a name
+    is defined more than once, the first DIE in `.debug_info` order wins.
+    """
+
+    def __init__(self, dwarf_info, entries=None, die_at=None):
+        """Build the index of `dwarf_info`.
+
+        `entries` are the `(key, offset)` pairs of all CUs, in `.debug_info`
+        order, if they were already extracted, e.g. by `_build_type_index`.
+        """
+        super().__init__(dwarf_info, die_at)
+        # `_index_key` -> DIE offset.
+        self._offsets = {}
+
+        if entries is None:
+            entries = itertools.chain.from_iterable(
+                _index_entries(compilation_unit)
+                for compilation_unit in _iter_cus(dwarf_info))
+        for key, offset in entries:
+            self._offsets.setdefault(key, offset)
+
+    def _lookup(self, key):
+        return self._offsets.get(key)
+
+    def write(self, path):
+        """Save the index in the format read by `MappedTypeIndex`.
+
+        The file is written next to `path` and renamed over it, so readers
+        never see a partially written index.
+        """
+        keys = sorted(self._offsets)
+        keys_offset = _INDEX_HEADER.size + _INDEX_RECORD.size * len(keys)
+        records = []
+        key_offset = keys_offset
+        for key in keys:
+            records.append(_INDEX_RECORD.pack(key_offset, len(key), self._offsets[key]))
+            key_offset += len(key)
+
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION, len(keys)))
+            f.writelines(records)
+            f.writelines(keys)
+        os.replace(tmp_path, path)
+
+
+def _iter_cus(dwarf_info, cu_offsets=None):
+    """Yield the CUs at `cu_offsets`, or all CUs, without keeping them.
+
+    pyelftools caches every CU it parses along with its parsed DIEs, so a scan
+    through `iter_CUs` leaves all of `.debug_info` parsed in memory.  CUs
+    yielded here are only referenced by the caller, and are freed with their
+    DIEs when it drops them.  Abbreviation tables parsed for them are dropped
+    too.  DIEs are parsed again by offset when needed later.
+    """
+    if dwarf_info.debug_info_sec is None:
+        return
+    abbrev_tables = dwarf_info._abbrevtable_cache
+    offsets = None if cu_offsets is None else iter(cu_offsets)
+    offset = 0
+    while True:
+        if offsets is not None:
+            offset = next(offsets, None)
+            if offset is None:
+                return
+        elif offset >= dwarf_info.debug_info_sec.size:
             return
-            # raise RuntimeError('Cycle :(')
-        nodes.add(type_die)
+        compilation_unit = dwarf_info._parse_CU_at_offset(offset)
+        abbrev_offset = compilation_unit['debug_abbrev_offset']
+        abbrev_table_cached = abbrev_offset in abbrev_tables
+        yield compilation_unit
+        if not abbrev_table_cached:
+            abbrev_tables.pop(abbrev_offset, None)
+        offset += compilation_unit.size
+
+
+def _index_entries(compilation_unit):
+    """Yield `(key, offset)` index entries of the top level DIEs of a CU."""
+    top_die = compilation_unit.get_top_DIE()
+    for die in itertools.chain((top_die,), top_die.iter_children()):
+        if 'DW_AT_name' not in die.attributes:
+            continue
+        name = die.attributes['DW_AT_name'].value
+        kind = _INDEX_DECLARATION if _is_declaration(die) else _INDEX_DEFINITION
+        yield _index_key(_INDEX_ANY, '', name), die.offset
+        yield _index_key(kind, die.tag, name), die.offset
+
+
+# Number of CU slices per indexing process.  Having more slices than
+# processes keeps them all busy when CUs differ a lot in size.
+_CU_SLICES_PER_JOB = 4
+
+
+def _build_type_index(dwarf_info, binary_path=None, relocate_dwarf_sections=True,
+                      jobs=None, die_at=None):
+    """Build a `TypeIndex`, with `jobs` processes if given.
+
+    CUs are split into contiguous slices of about the same size in bytes.
+    Every process opens `binary_path` itself and indexes its slices, and the
+    results are merged in `.debug_info` order, so the index is the same as a
+    serially built one.
+    """
+    if binary_path is None or jobs is None or jobs <= 1:
+        return TypeIndex(dwarf_info, die_at=die_at)
+
+    cu_slices = _split_cus(dwarf_info, jobs * _CU_SLICES_PER_JOB)
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        slices_entries = executor.map(
+            _index_cu_slice, itertools.repeat(binary_path),
+            itertools.repeat(relocate_dwarf_sections), cu_slices)
+        return TypeIndex(dwarf_info, itertools.chain.from_iterable(slices_entries),
+                         die_at=die_at)
+
+
+def _split_cus(dwarf_info, slices_nr):
+    """Split CU offsets into at most `slices_nr` contiguous, similarly sized lists."""
+    cus = [(cu.cu_offset, cu.size) for cu in _iter_cus(dwarf_info)]
+    slice_size = sum(size for _, size in cus) / slices_nr
+    cu_slices = [[]]
+    slice_bytes = 0
+    for cu_offset, size in cus:
+        if slice_bytes >= slice_size:
+            cu_slices.append([])
+            slice_bytes = 0
+        cu_slices[-1].append(cu_offset)
+        slice_bytes += size
+    return cu_slices
+
+
+def _index_cu_slice(binary_path, relocate_dwarf_sections, cu_offsets):
+    dwarf_info = _get_dwarf_info(binary_path,
+                                 relocate_dwarf_sections=relocate_dwarf_sections)
+    entries = []
+    for compilation_unit in _iter_cus(dwarf_info, cu_offsets):
+        entries.extend(_index_entries(compilation_unit))
+    return entries
+
+
+# Index file layout: a header, records sorted by key, then the key bytes.
+_INDEX_MAGIC = b'D2CTIDX\0'
+_INDEX_VERSION = 1
+_INDEX_HEADER = struct.Struct('<8sII')  # magic, version, number of records
+_INDEX_RECORD = struct.Struct('<IIQ')  # key offset, key length, DIE offset
+
+
+class MappedTypeIndex(_BaseTypeIndex):
+    """A `TypeIndex` read from a file written by `TypeIndex.write`.
+
+    The file is memory-mapped and looked up with a binary search, so opening
+    it costs the same no matter how many types the binary has.
+    """
+
+    def __init__(self, dwarf_info, path, die_at=None):
+        super().__init__(dwarf_info, die_at)
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self._size = _INDEX_HEADER.unpack_from(self._map)
+        except struct.error:
+            magic, version = None, None
+        if magic != _INDEX_MAGIC or version != _INDEX_VERSION:
+            self._map.close()
+            raise ValueError(f'{path} is not a type index')
+
+    def _key_at(self, i):
+        key_offset, key_len, die_offset = _INDEX_RECORD.unpack_from(
+            self._map, _INDEX_HEADER.size + i * _INDEX_RECORD.size)
+        return self._map[key_offset:key_offset + key_len], die_offset
+
+    def _lookup(self, key):
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key, die_offset = self._key_at(mid)
+            if mid_key == key:
+                return die_offset
+            if mid_key < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+
+class AcceleratedTypeIndex(_BaseTypeIndex):
+    """A type index backed by the accelerator tables of a binary.
+
+    `name_table` maps names to the CUs that define them, so a lookup only
+    parses the top level DIEs of those CUs.  Declarations aren't in
+    accelerator tables, and tables don't have to cover every CU, so
+    declarations and names missing from the table are looked up in the index
+    returned by `build_fallback()`, which is called on the first such lookup.
+
+    Unlike `TypeIndex`, a name defined in several CUs may resolve to any of
+    the definitions the table points to.
+    """
+
+    def __init__(self, dwarf_info, name_table, build_fallback, die_at=None):
+        super().__init__(dwarf_info, die_at)
+        self._name_table = name_table
+        self._build_fallback = build_fallback
+        self._fallback = None
+        # CU offset -> {`_index_key` -> DIE offset}
+        self._cu_entries = {}
+
+    def _lookup(self, key):
+        if key[0] != _INDEX_DECLARATION:
+            name = key[key.index(b'\0', 1) + 1:]
+            offsets = []
+            for cu_offset in self._name_table.find_cus(name):
+                offset = self._get_cu_entries(cu_offset).get(key)
+                if offset is not None:
+                    offsets.append(offset)
+            if offsets:
+                return min(offsets)
+        if self._fallback is None:
+            self._fallback = self._build_fallback()
+        return self._fallback._lookup(key)
+
+    def _get_cu_entries(self, cu_offset):
+        if cu_offset not in self._cu_entries:
+            entries = {}
+            for compilation_unit in _iter_cus(self._dwarf_info, [cu_offset]):
+                for key, offset in _index_entries(compilation_unit):
+                    entries.setdefault(key, offset)
+            self._cu_entries[cu_offset] = entries
+        return self._cu_entries[cu_offset]
+
+
+def _load_name_table(binary_path, dwarf_info):
+    """Return a name table from the accelerator tables of a binary, or None.
+
+    `.debug_names` is preferred over `.gdb_index`, which is preferred over
+    `.debug_pubtypes`.  The first two are only used in linked binaries, as
+    CU offsets in relocatable objects aren't final.
+    """
+    from elftools.elf.elffile import ELFFile
+
+    with open(binary_path, 'rb') as f:
+        elf_file = ELFFile(f)
+        if elf_file['e_type'] != 'ET_REL':
+            section = elf_file.get_section_by_name('.debug_names')
+            if section is not None:
+                byte_order = '<' if elf_file.little_endian else '>'
+                return _DebugNamesTable(section.data(), dwarf_info, byte_order)
+            section = elf_file.get_section_by_name('.gdb_index')
+            if section is not None:
+                return _GdbIndexTable(section.data())
+    pubtypes = dwarf_info.get_pubtypes()
+    if pubtypes is not None:
+        return _PubtypesTable(pubtypes)
+    return None
+
+
+class _PubtypesTable:
+    """Name table of `.debug_pubtypes`, as parsed by pyelftools."""
+
+    def __init__(self, pubtypes):
+        self._pubtypes = pubtypes
+
+    def find_cus(self, name: bytes):
+        entry = self._pubtypes.get(name.decode('utf-8', 'replace'))
+        return [] if entry is None else [entry.cu_ofs]
+
+
+class _GdbIndexTable:
+    """Name table of a `.gdb_index` section, versions 7 to 9.
+
+    See https://sourceware.org/gdb/current/onlinedocs/gdb.html/Index-Section-Format.html
+    """
+
+    def __init__(self, data):
+        self._data = data
+        (version,) = struct.unpack_from('<I', data)
+        if version in (7, 8):
+            cu_list, tu_list, _, symbol_table, constant_pool = struct.unpack_from(
+                '<5I', data, 4)
+        elif version == 9:
+            cu_list, tu_list, _, symbol_table, _, constant_pool = struct.unpack_from(
+                '<6I', data, 4)
+        else:
+            raise NotImplementedError(f'.gdb_index version {version} is not supported')
+        self._cu_offsets = [
+            offset for offset, _ in struct.iter_unpack('<QQ', data[cu_list:tu_list])]
+        self._symbol_table = symbol_table
+        self._slots_nr = (constant_pool - symbol_table) // 8
+        self._constant_pool = constant_pool
+
+    def find_cus(self, name: bytes):
+        if not self._slots_nr:
+            return []
+        hash_ = _gdb_index_hash(name)
+        mask = self._slots_nr - 1
+        slot = hash_ & mask
+        step = ((hash_ * 17) & mask) | 1
+        for _ in range(self._slots_nr):
+            name_offset, vector_offset = struct.unpack_from(
+                '<II', self._data, self._symbol_table + slot * 8)
+            if name_offset == 0 and vector_offset == 0:
+                return []
+            start = self._constant_pool + name_offset
+            if self._data[start:self._data.index(b'\0', start)] == name:
+                return self._read_cu_vector(self._constant_pool + vector_offset)
+            slot = (slot + step) & mask
+        return []
+
+    def _read_cu_vector(self, offset):
+        (count,) = struct.unpack_from('<I', self._data, offset)
+        cu_offsets = []
+        for value in struct.unpack_from(f'<{count}I', self._data, offset + 4):
+            # Bits 0-23 are the CU index, the rest are symbol attributes.  CU
+            # indices past the CU list refer to type units.
+            cu_index = value & 0xffffff
+            if cu_index < len(self._cu_offsets):
+                cu_offsets.append(self._cu_offsets[cu_index])
+        return cu_offsets
+
+
+def _gdb_index_hash(name: bytes):
+    hash_ = 0
+    for c in name.lower():
+        hash_ = (hash_ * 67 + c - 113) & 0xffffffff
+    return hash_
+
+
+_DW_IDX_COMPILE_UNIT = 1
+_DW_IDX_TYPE_UNIT = 2
+
+# Sizes of fixed size forms used by `.debug_names` entries.
+_DEBUG_NAMES_FORM_SIZES = {
+    0x0b: 1,  # DW_FORM_data1
+    0x05: 2,  # DW_FORM_data2
+    0x06: 4,  # DW_FORM_data4
+    0x07: 8,  # DW_FORM_data8
+    0x11: 1,  # DW_FORM_ref1
+    0x12: 2,  # DW_FORM_ref2
+    0x13: 4,  # DW_FORM_ref4
+    0x14: 8,  # DW_FORM_ref8
+    0x19: 0,  # DW_FORM_flag_present
+}
+_DW_FORM_UDATA = 0x0f
+_DW_FORM_REF_UDATA = 0x15
+_DW_FORM_IMPLICIT_CONST = 0x21
+_UNSIGNED_FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+
+class _DebugNamesTable:
+    """Name table of a DWARF 5 `.debug_names` section.
+
+    The section may hold several name indexes, e.g. one per CU; all of them
+    are searched.  See section 6.1.1 of the DWARF 5 standard.
+    """
+
+    def __init__(self, data, dwarf_info, byte_order='<'):
+        self._units = []
+        offset = 0
+        while offset < len(data):
+            unit = _DebugNamesUnit(data, offset, dwarf_info, byte_order)
+            self._units.append(unit)
+            offset = unit.end
+
+    def find_cus(self, name: bytes):
+        return [cu_offset for unit in self._units for cu_offset in unit.find_cus(name)]
+
+
+class _DebugNamesUnit:
+
+    def __init__(self, data, offset, dwarf_info, byte_order):
+        self._data = data
+        self._dwarf_info = dwarf_info
+        self._byte_order = byte_order
+
+        (unit_length,) = struct.unpack_from(byte_order + 'I', data, offset)
+        offset += 4
+        offset_size = 4
+        if unit_length == 0xffffffff:
+            (unit_length,) = struct.unpack_from(byte_order + 'Q', data, offset)
+            offset += 8
+            offset_size = 8
+        self.end = offset + unit_length
+        offset_format = _UNSIGNED_FORMATS[offset_size]
+
+        (version, _, cu_count, local_tu_count, foreign_tu_count, self._bucket_count,
+         self._name_count, abbrev_table_size, augmentation_size) = struct.unpack_from(
+            byte_order + 'HHIIIIIII', data, offset)
+        if version != 5:
+            raise NotImplementedError(f'.debug_names version {version} is not supported')
+        offset += 32 + augmentation_size
+
+        self._cu_offsets = struct.unpack_from(
+            f'{byte_order}{cu_count}{offset_format}', data, offset)
+        offset += (cu_count + local_tu_count) * offset_size + foreign_tu_count * 8
+
+        self._buckets_offset = offset
+        offset += self._bucket_count * 4
+        self._hashes_offset = offset
+        if self._bucket_count:
+            offset += self._name_count * 4
+        self._string_offsets = struct.unpack_from(
+            f'{byte_order}{self._name_count}{offset_format}', data, offset)
+        offset += self._name_count * offset_size
+        self._entry_offsets = struct.unpack_from(
+            f'{byte_order}{self._name_count}{offset_format}', data, offset)
+        offset += self._name_count * offset_size
+
+        self._abbrevs = self._parse_abbrevs(offset, offset + abbrev_table_size)
+        self._entry_pool = offset + abbrev_table_size
+
+    def _parse_abbrevs(self, offset, end):
+        # abbrev code -> [(DW_IDX_*, DW_FORM_*, implicit constant)]
+        abbrevs = {}
+        while offset < end:
+            code, offset = _read_uleb128(self._data, offset)
+            if not code:
+                break
+            _, offset = _read_uleb128(self._data, offset)  # tag
+            attributes = []
+            while True:
+                index, offset = _read_uleb128(self._data, offset)
+                form, offset = _read_uleb128(self._data, offset)
+                if not index and not form:
+                    break
+                implicit_const = None
+                if form == _DW_FORM_IMPLICIT_CONST:
+                    implicit_const, offset = _read_sleb128(self._data, offset)
+                attributes.append((index, form, implicit_const))
+            abbrevs[code] = attributes
+        return abbrevs
+
+    def find_cus(self, name: bytes):
+        if self._bucket_count:
+            hash_ = _debug_names_hash(name)
+            bucket = hash_ % self._bucket_count
+            (i,) = struct.unpack_from(self._byte_order + 'I', self._data,
+                                      self._buckets_offset + bucket * 4)
+            # Names are numbered from 1; 0 marks an empty bucket.
+            while 0 < i <= self._name_count:
+                (name_hash,) = struct.unpack_from(self._byte_order + 'I', self._data,
+                                                  self._hashes_offset + (i - 1) * 4)
+                if name_hash % self._bucket_count != bucket:
+                    break
+                if name_hash == hash_ and self._name_at(i - 1) == name:
+                    return self._read_entries(i - 1)
+                i += 1
+            return []
+        for i in range(self._name_count):
+            if self._name_at(i) == name:
+                return self._read_entries(i)
+        return []
+
+    def _name_at(self, i):
+        return self._dwarf_info.get_string_from_table(self._string_offsets[i])
+
+    def _read_entries(self, i):
+        cu_offsets = []
+        offset = self._entry_pool + self._entry_offsets[i]
+        while True:
+            code, offset = _read_uleb128(self._data, offset)
+            if not code:
+                return cu_offsets
+            cu_index = 0 if len(self._cu_offsets) == 1 else None
+            in_type_unit = False
+            for index, form, implicit_const in self._abbrevs[code]:
+                value, offset = self._read_form(form, implicit_const, offset)
+                if index == _DW_IDX_COMPILE_UNIT:
+                    cu_index = value
+                elif index == _DW_IDX_TYPE_UNIT:
+                    in_type_unit = True
+            if (not in_type_unit and cu_index is not None and
+                    cu_index < len(self._cu_offsets)):
+                cu_offsets.append(self._cu_offsets[cu_index])
+
+    def _read_form(self, form, implicit_const, offset):
+        if form in _DEBUG_NAMES_FORM_SIZES:
+            size = _DEBUG_NAMES_FORM_SIZES[form]
+            if not size:
+                return True, offset
+            (value,) = struct.unpack_from(
+                self._byte_order + _UNSIGNED_FORMATS[size], self._data, offset)
+            return value, offset + size
+        if form in (_DW_FORM_UDATA, _DW_FORM_REF_UDATA):
+            return _read_uleb128(self._data, offset)
+        if form == _DW_FORM_IMPLICIT_CONST:
+            return implicit_const, offset
+        raise NotImplementedError(f'.debug_names form 0x{form:x} is not supported')
+
+
+def _debug_names_hash(name: bytes):
+    hash_ = 5381
+    for c in name:
+        hash_ = (hash_ * 33 + c) & 0xffffffff
+    return hash_
+
+
+def _read_uleb128(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, offset
+
+
+def _read_sleb128(data, offset):
+    value, end = _read_uleb128(data, offset)
+    bits = (end - offset) * 7
+    if value & (1 << (bits - 1)):
+        value -= 1 << bits
+    return value, end
+
+
+# DW_AT_* codes -> names of the attributes decoded by `_DIEDecoder`: the ones
+# conversions read, and DW_AT_sibling, which is used to skip DIEs.
+_DECODED_ATTRIBUTES = {
+    0x01: 'DW_AT_sibling',
+    0x03: 'DW_AT_name',
+    0x0b: 'DW_AT_byte_size',
+    0x0c: 'DW_AT_bit_offset',
+    0x0d: 'DW_AT_bit_size',
+    0x1c: 'DW_AT_const_value',
+    0x2f: 'DW_AT_upper_bound',
+    0x37: 'DW_AT_count',
+    0x38: 'DW_AT_data_member_location',
+    0x3c: 'DW_AT_declaration',
+    0x3e: 'DW_AT_encoding',
+    0x49: 'DW_AT_type',
+    0x6b: 'DW_AT_data_bit_offset',
+}
+# The attributes `_DIEDecoder` decodes to skip DIEs.
+_SIBLING_ATTRIBUTE = {0x01: 'DW_AT_sibling'}
+
+_DW_UT_COMPILE = 0x01
+_DW_UT_PARTIAL = 0x03
+
+# DW_FORM_* codes used by `_DIEDecoder`.
+_DW_FORM_ADDR = 0x01
+_DW_FORM_BLOCK2 = 0x03
+_DW_FORM_BLOCK4 = 0x04
+_DW_FORM_DATA2 = 0x05
+_DW_FORM_DATA4 = 0x06
+_DW_FORM_DATA8 = 0x07
+_DW_FORM_STRING = 0x08
+_DW_FORM_BLOCK = 0x09
+_DW_FORM_BLOCK1 = 0x0a
+_DW_FORM_DATA1 = 0x0b
+_DW_FORM_FLAG = 0x0c
+_DW_FORM_SDATA = 0x0d
+_DW_FORM_STRP = 0x0e
+_DW_FORM_REF_ADDR = 0x10
+_DW_FORM_REF1 = 0x11
+_DW_FORM_REF2 = 0x12
+_DW_FORM_REF4 = 0x13
+_DW_FORM_REF8 = 0x14
+_DW_FORM_SEC_OFFSET = 0x17
+_DW_FORM_EXPRLOC = 0x18
+_DW_FORM_FLAG_PRESENT = 0x19
+_DW_FORM_LINE_STRP = 0x1f
+
+# Sizes of the fixed size forms that are skipped but not decoded.  Forms of
+# the size of an offset or of an address aren't listed.
+_SKIPPED_FORM_SIZES = {
+    0x1c: 4,  # DW_FORM_ref_sup4
+    0x1e: 16,  # DW_FORM_data16
+    0x20: 8,  # DW_FORM_ref_sig8
+    0x24: 8,  # DW_FORM_ref_sup8
+    0x25: 1,  # DW_FORM_strx1
+    0x26: 2,  # DW_FORM_strx2
+    0x27: 3,  # DW_FORM_strx3
+    0x28: 4,  # DW_FORM_strx4
+    0x29: 1,  # DW_FORM_addrx1
+    0x2a: 2,  # DW_FORM_addrx2
+    0x2b: 3,  # DW_FORM_addrx3
+    0x2c: 4,  # DW_FORM_addrx4
+}
+_SKIPPED_OFFSET_FORMS = (
+    0x1d,  # DW_FORM_strp_sup
+    0x1f20,  # DW_FORM_GNU_ref_alt
+    0x1f21,  # DW_FORM_GNU_strp_alt
+)
+_SKIPPED_ULEB128_FORMS = (
+    0x1a,  # DW_FORM_strx
+    0x1b,  # DW_FORM_addrx
+    0x22,  # DW_FORM_loclistx
+    0x23,  # DW_FORM_rnglistx
+    0x1f01,  # DW_FORM_GNU_addr_index
+    0x1f02,  # DW_FORM_GNU_str_index
+)
+
+# Kinds of the steps of a compiled abbreviation.  Steps are
+# `(kind, attribute name, argument)`; see `_compile_abbrev_steps`.
+_STEP_SKIP = 0  # argument: number of bytes
+_STEP_SKIP_ULEB128 = 1
+_STEP_SKIP_STRING = 2
+_STEP_SKIP_BLOCK = 3  # argument: `struct.Struct` of the length, or None for a ULEB128
+_STEP_UNSIGNED = 4  # argument: `struct.Struct`
+_STEP_ULEB128 = 5
+_STEP_SLEB128 = 6
+_STEP_FLAG = 7
+_STEP_CONSTANT = 8  # argument: the value
+_STEP_STRING = 9
+_STEP_STRP = 10  # argument: `struct.Struct` of the offset
+_STEP_LINE_STRP = 11  # argument: `struct.Struct` of the offset
+_STEP_REF = 12  # argument: `struct.Struct`, or None for a ULEB128
+_STEP_REF_ADDR = 13  # argument: `struct.Struct`
+_STEP_BLOCK = 14  # argument: `struct.Struct` of the length, or None for a ULEB128
+
+
+def _compile_abbrev_steps(specs, wanted, offset_size, address_size, version,
+                          byte_order):
+    """Compile the attribute specs of an abbreviation into read steps.
+
+    `specs` are `(DW_AT_*, DW_FORM_*, implicit constant)` tuples.  Attributes
+    in `wanted`, a dict from DW_AT_* to names, are decoded the way pyelftools
+    translates them; the others are skipped, and consecutive fixed size
+    skips are merged into one step.  Raises NotImplementedError for forms
+    that can't be decoded or skipped.
+    """
+    def unsigned(size):
+        return struct.Struct(byte_order + _UNSIGNED_FORMATS[size])
+
+    ref_addr_size = address_size if version == 2 else offset_size
+    fixed_sizes = {
+        _DW_FORM_ADDR: address_size, _DW_FORM_DATA1: 1, _DW_FORM_DATA2: 2,
+        _DW_FORM_DATA4: 4, _DW_FORM_DATA8: 8, _DW_FORM_FLAG: 1,
+        _DW_FORM_STRP: offset_size, _DW_FORM_REF_ADDR: ref_addr_size,
+        _DW_FORM_REF1: 1, _DW_FORM_REF2: 2, _DW_FORM_REF4: 4, _DW_FORM_REF8: 8,
+        _DW_FORM_SEC_OFFSET: offset_size, _DW_FORM_FLAG_PRESENT: 0,
+        _DW_FORM_LINE_STRP: offset_size, _DW_FORM_IMPLICIT_CONST: 0,
+        **_SKIPPED_FORM_SIZES,
+        **dict.fromkeys(_SKIPPED_OFFSET_FORMS, offset_size),
+    }
+    block_lengths = {_DW_FORM_BLOCK1: unsigned(1), _DW_FORM_BLOCK2: unsigned(2),
+                     _DW_FORM_BLOCK4: unsigned(4), _DW_FORM_BLOCK: None,
+                     _DW_FORM_EXPRLOC: None}
+
+    steps = []
+    for attribute, form, implicit_const in specs:
+        name = wanted.get(attribute)
+        if name is None:
+            if form in fixed_sizes:
+                if steps and steps[-1][0] == _STEP_SKIP:
+                    steps[-1] = (_STEP_SKIP, None, steps[-1][2] + fixed_sizes[form])
+                else:
+                    steps.append((_STEP_SKIP, None, fixed_sizes[form]))
+            elif form in (_DW_FORM_UDATA, _DW_FORM_SDATA, _DW_FORM_REF_UDATA,
+                          *_SKIPPED_ULEB128_FORMS):
+                steps.append((_STEP_SKIP_ULEB128, None, None))
+            elif form == _DW_FORM_STRING:
+                steps.append((_STEP_SKIP_STRING, None, None))
+            elif form in block_lengths:
+                steps.append((_STEP_SKIP_BLOCK, None, block_lengths[form]))
+            else:
+                raise NotImplementedError(f'DW_FORM 0x{form:x} is not supported')
+        elif form in (_DW_FORM_ADDR, _DW_FORM_DATA1, _DW_FORM_DATA2,
+                      _DW_FORM_DATA4, _DW_FORM_DATA8, _DW_FORM_SEC_OFFSET):
+            steps.append((_STEP_UNSIGNED, name, unsigned(fixed_sizes[form])))
+        elif form == _DW_FORM_UDATA:
+            steps.append((_STEP_ULEB128, name, None))
+        elif form == _DW_FORM_SDATA:
+            steps.append((_STEP_SLEB128, name, None))
+        elif form == _DW_FORM_FLAG:
+            steps.append((_STEP_FLAG, name, None))
+        elif form == _DW_FORM_FLAG_PRESENT:
+            steps.append((_STEP_CONSTANT, name, True))
+        elif form == _DW_FORM_IMPLICIT_CONST:
+            steps.append((_STEP_CONSTANT, name, implicit_const))
+        elif form == _DW_FORM_STRING:
+            steps.append((_STEP_STRING, name, None))
+        elif form == _DW_FORM_STRP:
+            steps.append((_STEP_STRP, name, unsigned(offset_size)))
+        elif form == _DW_FORM_LINE_STRP:
+            steps.append((_STEP_LINE_STRP, name, unsigned(offset_size)))
+        elif form in (_DW_FORM_REF1, _DW_FORM_REF2, _DW_FORM_REF4, _DW_FORM_REF8):
+            steps.append((_STEP_REF, name, unsigned(fixed_sizes[form])))
+        elif form == _DW_FORM_REF_UDATA:
+            steps.append((_STEP_REF, name, None))
+        elif form == _DW_FORM_REF_ADDR:
+            steps.append((_STEP_REF_ADDR, name, unsigned(ref_addr_size)))
+        elif form in block_lengths:
+            steps.append((_STEP_BLOCK, name, block_lengths[form]))
+        else:
+            raise NotImplementedError(f'DW_FORM 0x{form:x} of {name} is not supported')
+    return steps
+
+
+def _section_data(section):
+    """Return the buffer holding a DWARF section, and where it starts in it."""
+    if section is None:
+        return None, 0
+    if isinstance(section.stream, _MappedSectionStream):
+        return section.stream._mapped_file, section.stream._offset
+    return section.stream.getvalue(), 0
+
+
+# A value of a `_DIEView` attribute.  `value` is what pyelftools would
+# translate it to, and `refaddr` is the offset of the DIE a reference
+# refers to.
+_DecodedAttribute = namedtuple('_DecodedAttribute', 'value refaddr')
 
-        # print(type_die)
 
-        if type_die.tag in ('DW_TAG_structure_type', 'DW_TAG_union_type'):
-            for member_die in type_die.iter_children():
-                refs[type_die].add(member_die)
-                traverse(member_die)
+@dataclass
+class _DecodedCU:
+    cu_offset: int
+    # Abbreviation code -> `(tag, has_children, steps, skip_steps)`.
+    abbrevs: dict
+
+
+class _DIEDecoder:
+    """Decodes DIEs of `.debug_info` straight from the section bytes.
+
+    pyelftools parses every attribute of every DIE into a dict of attribute
+    objects, which is most of the time spent converting types.  The decoder
+    instead compiles each abbreviation into a list of steps once, which
+    decode the attributes in `_DECODED_ATTRIBUTES` and skip the others by
+    form, and returns `_DIEView`s.
+
+    CUs with forms the decoder doesn't know, e.g. the indexed strings of
+    split DWARF, are parsed by pyelftools instead, and so are units other
+    than compile and partial units.
+    """
+
+    def __init__(self, dwarf_info):
+        from elftools.dwarf.enums import ENUM_DW_TAG
+
+        self.dwarf_info = dwarf_info
+        self._byte_order = '<' if dwarf_info.config.little_endian else '>'
+        self._info, self._info_start = _section_data(dwarf_info.debug_info_sec)
+        self._abbrev, self._abbrev_start = _section_data(dwarf_info.debug_abbrev_sec)
+        self._str, self._str_start = _section_data(dwarf_info.debug_str_sec)
+        self._line_str, self._line_str_start = _section_data(
+            dwarf_info.debug_line_str_sec)
+        self._tags = {code: tag for tag, code in ENUM_DW_TAG.items()}
+        # Sorted offsets of all units, read on first use.
+        self._cu_offsets = None
+        # CU offset -> `_DecodedCU`, or None when pyelftools parses the CU.
+        self._cus = {}
+        # (abbrev offset, offset size, address size, version) -> abbreviations
+        # of `_DecodedCU`.
+        self._abbrev_tables = {}
+        # DIE offset -> `_DIEView`.
+        self._dies = {}
+
+    def die_at(self, offset):
+        """Return the DIE at `offset` of `.debug_info`."""
+        die = self._dies.get(offset)
+        if die is None:
+            cu = self._cu_containing(offset)
+            if cu is None:
+                return self.dwarf_info.get_DIE_from_refaddr(offset)
+            die = self._dies[offset] = self._decode(cu, offset)
+        return die
+
+    def _cu_containing(self, offset):
+        if self._cu_offsets is None:
+            self._cu_offsets = self._read_cu_offsets()
+        cu_offset = self._cu_offsets[bisect.bisect_right(self._cu_offsets, offset) - 1]
+        if cu_offset not in self._cus:
+            self._cus[cu_offset] = self._parse_cu(cu_offset)
+        return self._cus[cu_offset]
+
+    def _read_cu_offsets(self):
+        length_32 = struct.Struct(self._byte_order + 'I')
+        length_64 = struct.Struct(self._byte_order + 'Q')
+        cu_offsets = []
+        offset = 0
+        while offset < self.dwarf_info.debug_info_sec.size:
+            cu_offsets.append(offset)
+            (unit_length,) = length_32.unpack_from(self._info, self._info_start + offset)
+            if unit_length == 0xffffffff:
+                (unit_length,) = length_64.unpack_from(
+                    self._info, self._info_start + offset + 4)
+                offset += 12 + unit_length
+            else:
+                offset += 4 + unit_length
+        return cu_offsets
+
+    def _parse_cu(self, cu_offset):
+        byte_order = self._byte_order
+        position = self._info_start + cu_offset
+        (unit_length,) = struct.unpack_from(byte_order + 'I', self._info, position)
+        position += 4
+        offset_size = 4
+        if unit_length == 0xffffffff:
+            position += 8
+            offset_size = 8
+        offset_format = byte_order + _UNSIGNED_FORMATS[offset_size]
+        (version,) = struct.unpack_from(byte_order + 'H', self._info, position)
+        position += 2
+        if version >= 5:
+            unit_type, address_size = struct.unpack_from('BB', self._info, position)
+            (abbrev_offset,) = struct.unpack_from(offset_format, self._info, position + 2)
+            if unit_type not in (_DW_UT_COMPILE, _DW_UT_PARTIAL):
+                return None
+        else:
+            (abbrev_offset,) = struct.unpack_from(offset_format, self._info, position)
+            (address_size,) = struct.unpack_from('B', self._info, position + offset_size)
+        if not 2 <= version <= 5:
+            return None
+
+        key = (abbrev_offset, offset_size, address_size, version)
+        if key not in self._abbrev_tables:
+            try:
+                self._abbrev_tables[key] = {
+                    code: (self._tags.get(tag, tag), has_children,
+                           _compile_abbrev_steps(specs, _DECODED_ATTRIBUTES,
+                                                 offset_size, address_size,
+                                                 version, byte_order),
+                           _compile_abbrev_steps(specs, _SIBLING_ATTRIBUTE,
+                                                 offset_size, address_size,
+                                                 version, byte_order))
+                    for code, (tag, has_children, specs)
+                    in self._read_abbrevs(abbrev_offset).items()}
+            except NotImplementedError:
+                self._abbrev_tables[key] = None
+        if self._abbrev_tables[key] is None:
+            return None
+        return _DecodedCU(cu_offset=cu_offset, abbrevs=self._abbrev_tables[key])
+
+    def _read_abbrevs(self, abbrev_offset):
+        # abbrev code -> (DW_TAG_*, has children,
+        #                 [(DW_AT_*, DW_FORM_*, implicit constant)])
+        data = self._abbrev
+        offset = self._abbrev_start + abbrev_offset
+        abbrevs = {}
+        while True:
+            code, offset = _read_uleb128(data, offset)
+            if not code:
+                return abbrevs
+            tag, offset = _read_uleb128(data, offset)
+            has_children = bool(data[offset])
+            offset += 1
+            specs = []
+            while True:
+                attribute, offset = _read_uleb128(data, offset)
+                form, offset = _read_uleb128(data, offset)
+                if not attribute and not form:
+                    break
+                implicit_const = None
+                if form == _DW_FORM_IMPLICIT_CONST:
+                    implicit_const, offset = _read_sleb128(data, offset)
+                specs.append((attribute, form, implicit_const))
+            abbrevs[code] = (tag, has_children, specs)
+
+    def _decode(self, cu, offset):
+        code, position = _read_uleb128(self._info, self._info_start + offset)
+        tag, has_children, steps, _ = cu.abbrevs[code]
+        attributes, position = self._read_attributes(cu, steps, position)
+        return _DIEView(self, cu, offset, tag, attributes, has_children,
+                        position - self._info_start)
+
+    def _read_attributes(self, cu, steps, position):
+        data = self._info
+        attributes = {}
+        for kind, name, argument in steps:
+            refaddr = None
+            if kind == _STEP_SKIP:
+                position += argument
+                continue
+            elif kind == _STEP_SKIP_ULEB128:
+                while data[position] & 0x80:
+                    position += 1
+                position += 1
+                continue
+            elif kind == _STEP_SKIP_STRING:
+                position = data.find(b'\0', position) + 1
+                continue
+            elif kind == _STEP_SKIP_BLOCK:
+                length, position = self._read_block_length(argument, position)
+                position += length
+                continue
+            elif kind == _STEP_UNSIGNED:
+                (value,) = argument.unpack_from(data, position)
+                position += argument.size
+            elif kind == _STEP_REF:
+                if argument is None:
+                    value, position = _read_uleb128(data, position)
+                else:
+                    (value,) = argument.unpack_from(data, position)
+                    position += argument.size
+                refaddr = cu.cu_offset + value
+            elif kind == _STEP_STRP:
+                (string_offset,) = argument.unpack_from(data, position)
+                position += argument.size
+                value = _read_string(self._str, self._str_start + string_offset)
+            elif kind == _STEP_STRING:
+                value = _read_string(data, position)
+                position += len(value) + 1
+            elif kind == _STEP_CONSTANT:
+                value = argument
+            elif kind == _STEP_FLAG:
+                value = data[position] != 0
+                position += 1
+            elif kind == _STEP_ULEB128:
+                value, position = _read_uleb128(data, position)
+            elif kind == _STEP_SLEB128:
+                value, position = _read_sleb128(data, position)
+            elif kind == _STEP_LINE_STRP:
+                (string_offset,) = argument.unpack_from(data, position)
+                position += argument.size
+                value = _read_string(self._line_str,
+                                     self._line_str_start + string_offset)
+            elif kind == _STEP_REF_ADDR:
+                (value,) = argument.unpack_from(data, position)
+                position += argument.size
+                refaddr = value
+            elif kind == _STEP_BLOCK:
+                length, position = self._read_block_length(argument, position)
+                value = list(data[position:position + length])
+                position += length
+            attributes[name] = _DecodedAttribute(value, refaddr)
+        return attributes, position
+
+    def _read_block_length(self, length_struct, position):
+        if length_struct is None:
+            return _read_uleb128(self._info, position)
+        (length,) = length_struct.unpack_from(self._info, position)
+        return length, position + length_struct.size
+
+    def iter_children(self, die):
+        cu = die.cu
+        offset = die._end
+        while self._info[self._info_start + offset]:
+            child = self._dies.get(offset)
+            if child is None:
+                child = self._dies[offset] = self._decode(cu, offset)
+            yield child
+            if not child.has_children:
+                offset = child._end
+            elif 'DW_AT_sibling' in child.attributes:
+                offset = child.attributes['DW_AT_sibling'].refaddr
+            else:
+                offset = self._skip_children(cu, child._end)
+
+    def _skip_children(self, cu, offset):
+        """Return the offset following the children starting at `offset`."""
+        position = self._info_start + offset
+        depth = 1
+        while depth:
+            code, position = _read_uleb128(self._info, position)
+            if not code:
+                depth -= 1
+                continue
+            _, has_children, _, skip_steps = cu.abbrevs[code]
+            attributes, position = self._read_attributes(cu, skip_steps, position)
+            if has_children:
+                if 'DW_AT_sibling' in attributes:
+                    position = self._info_start + attributes['DW_AT_sibling'].refaddr
+                else:
+                    depth += 1
+        return position - self._info_start
+
+
+def _read_string(data, offset):
+    return data[offset:data.find(b'\0', offset)]
+
+
+class _DIEView:
+    """A DIE decoded by `_DIEDecoder`.
+
+    It can stand in for a pyelftools DIE in conversions, but its
+    `attributes` only hold the attributes of `_DECODED_ATTRIBUTES`.
+    """
+    __slots__ = ('_decoder', 'cu', 'offset', 'tag', 'attributes',
+                 'has_children', '_end')
+
+    def __init__(self, decoder, cu, offset, tag, attributes, has_children, end):
+        self._decoder = decoder
+        self.cu = cu
+        self.offset = offset
+        self.tag = tag
+        self.attributes = attributes
+        self.has_children = has_children
+        # Offset following the attributes, i.e. of the first child.
+        self._end = end
+
+    @property
+    def dwarfinfo(self):
+        return self._decoder.dwarf_info
+
+    def get_DIE_from_attribute(self, name):
+        return self._decoder.die_at(self.attributes[name].refaddr)
+
+    def iter_children(self):
+        if self.has_children:
+            yield from self._decoder.iter_children(self)
+
+    def __repr__(self):
+        return f'<{self.tag} DIE at 0x{self.offset:x}>'
+
+
+def _load_cached_type_index(dwarf_info, binary_path, cache_dir,
+                            cache_max_bytes=DEFAULT_CACHE_MAX_BYTES,
+                            relocate_dwarf_sections=True, jobs=None, die_at=None):
+    """Use the index of `binary_path` from `cache_dir`, building it if needed.
+
+    Index files are named after the binary's GNU build ID, or after its path,
+    size and mtime when it has none.  Every use refreshes the file's mtime, and
+    the least recently used files are removed once the directory holds more
+    than `cache_max_bytes` of indexes.  A missing index is built by
+    `_build_type_index`.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, _get_cache_key(binary_path) + _INDEX_SUFFIX)
+    try:
+        index = MappedTypeIndex(dwarf_info, path, die_at=die_at)
+        os.utime(path)
+    except (OSError, ValueError):
+        _build_type_index(dwarf_info, binary_path,
+                          relocate_dwarf_sections=relocate_dwarf_sections,
+                          jobs=jobs).write(path)
+        index = MappedTypeIndex(dwarf_info, path, die_at=die_at)
+    _evict_cache_files(cache_dir, cache_max_bytes, keep=(path,))
+    return index
+
+
+_INDEX_SUFFIX = '.typeidx'
+_LAYOUT_SUFFIX = '.layout.json'
+
+
+def _get_cache_key(binary_path):
+    from elftools.elf.elffile import ELFFile
+
+    with open(binary_path, 'rb') as f:
+        build_id = _get_build_id(ELFFile(f))
+    if build_id is not None:
+        return f'buildid-{build_id}'
+    stat = os.stat(binary_path)
+    fallback = f'{os.path.realpath(binary_path)}:{stat.st_size}:{stat.st_mtime_ns}'
+    return 'file-' + hashlib.sha1(fallback.encode('utf-8')).hexdigest()
+
+
+def _get_build_id(elf_file):
+    section = elf_file.get_section_by_name('.note.gnu.build-id')
+    if section is None:
+        return None
+    for note in section.iter_notes():
+        if note['n_type'] == 'NT_GNU_BUILD_ID':
+            return note['n_desc']
+    return None
+
+
+def _evict_cache_files(cache_dir, max_bytes, keep=()):
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith((_INDEX_SUFFIX, _LAYOUT_SUFFIX)):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+@dataclass
+class ConversionStats:
+    """Counters and per-phase timers of one `TypeLibrary` conversion."""
+    dies_visited: int = 0
+    structs_built: int = 0
+    cache_hits: int = 0
+    declarations_resolved: int = 0
+    layouts_loaded: int = 0
+    # DIEs merged into a structurally identical DIE of another CU.
+    duplicates_merged: int = 0
+    # `PrunedType`s of the structs and unions left out by conversion limits.
+    pruned: list = field(default_factory=list)
+    # Structs and unions taken unchanged from previous layouts.
+    structs_reused: int = 0
+    # Kind of type ('array', 'padding', 'pointer', 'struct' or 'union') ->
+    # number of times an interned type was used instead of building an
+    # identical one.
+    interned: dict = field(default_factory=dict)
+    # Phase name -> wall time in seconds.
+    phase_seconds: dict = field(default_factory=dict)
+
+
+@dataclass
+class PrunedType:
+    """A struct or union left out of a conversion by its limits."""
+    name: str
+    tag: str
+    # Number of pointers between the type and the closest root.
+    depth: int
+    # 'max_pointer_depth' or 'max_structs'.
+    reason: str
+
+
+@dataclass
+class LayoutUpdate:
+    """The result of `TypeLibrary.update_layouts`.
+
+    `changed`, `added` and `removed` list the names of the named structs and
+    unions whose fingerprints changed, or that only the new or the previous
+    layouts have.
+    """
+    types: dict
+    layouts: dict
+    changed: list
+    added: list
+    removed: list
+
+
+class TypeLibrary:
+    """Converts types of one binary to ctypes.
+
+    A library owns the DWARF info of its binary, the index of its types, and
+    the ctypes types converted so far, so converting the same struct twice
+    returns the same class.  Libraries don't share any state: several binaries
+    can be loaded at once, and each library can be used from its own thread.
+    Conversions within one library are serialized.
+
+    The DWARF info is only read when a type has to be converted, so types
+    found in the layout cache of `cache_dir` don't parse DWARF at all.
+
+    Lookups use the accelerator tables of the binary (`.debug_names`,
+    `.gdb_index` or `.debug_pubtypes`) when it has them, unless
+    `use_accelerator_tables` is false.  Otherwise, or for names the tables
+    don't know, a full index is built, by `index_jobs` processes if given.
+
+    With `mmap_sections`, the binary stays mapped for the life of the library
+    and DWARF sections are parsed in place, rather than copied to memory.
+    The binary must not be modified while it is mapped.
+
+    With `lazy`, structs only reachable through pointers are left empty, and
+    get their fields when first used: when a pointer to them is dereferenced,
+    when they are instantiated or one of their fields is looked up, or when
+    their `resolve()` is called.  Lazy libraries can't have a `cache_dir`.
+
+    `max_pointer_depth` and `max_structs` limit a conversion to the structs
+    and unions at most that many pointers away from the roots, and to that
+    many of them, closest first.  Pointers to the types left out become
+    `c_void_p`, and types left out but held by value become opaque structs of
+    the same size.  Anonymous types held by value are part of their
+    container and aren't counted.  The types left out are listed in
+    `stats.pruned`, and traced as 'pruned' events.  Structs and unions
+    converted by an earlier conversion of the library are reused as they
+    are, and don't count towards `max_structs`.
+
+    With `fast_die_decoder`, DIEs are decoded by a decoder that only reads
+    the attributes conversions use, which is much faster than pyelftools.
+    CUs using DWARF forms the decoder doesn't know are still parsed by
+    pyelftools.
+
+    `update_layouts` converts types again after the binary was rebuilt, and
+    reuses the types of previous layouts that didn't change.
+
+    `stats` holds the `ConversionStats` of the latest conversion.  If `trace`
+    is given, it is called as `trace(event, **details)` for every struct
+    built, cache hit, declaration resolved and phase finished.
+    """
+
+    def __init__(self, binary_path=None, relocate_dwarf_sections=True,
+                 cache_dir=None, cache_max_bytes=DEFAULT_CACHE_MAX_BYTES,
+                 dwarf_info=None, trace=None, index_jobs=None,
+                 use_accelerator_tables=True, mmap_sections=True, lazy=False,
+                 max_pointer_depth=None, max_structs=None, fast_die_decoder=True):
+        if binary_path is None and dwarf_info is None:
+            raise ValueError('Either binary_path or dwarf_info is required')
+        if cache_dir is not None and binary_path is None:
+            raise ValueError('cache_dir requires binary_path')
+        if cache_dir is not None and lazy:
+            raise ValueError("Layouts of lazy libraries can't be cached")
+        if max_pointer_depth is not None and max_pointer_depth < 0:
+            raise ValueError('max_pointer_depth must not be negative')
+        if max_structs is not None and max_structs < 1:
+            raise ValueError('max_structs must be positive')
+        self.binary_path = binary_path
+        self._relocate_dwarf_sections = relocate_dwarf_sections
+        self._cache_dir = cache_dir
+        self._cache_max_bytes = cache_max_bytes
+        self._dwarf_info = dwarf_info
+        self._index = None
+        self._cache_key = None
+        self._trace = trace
+        self._index_jobs = index_jobs
+        self._use_accelerator_tables = use_accelerator_tables
+        self._mmap_sections = mmap_sections
+        self._lazy = lazy
+        self._max_pointer_depth = max_pointer_depth
+        self._max_structs = max_structs
+        self._fast_die_decoder = fast_die_decoder
+        self._die_decoder = None
+        self.stats = ConversionStats()
+
+        self._lock = threading.RLock()
+        # Conversion caches.
+        self._structures = {}
+        self._declarations_to_be_resolved = {}
+        # (tag, name) of a declaration -> DIE of its definition, or None.
+        self._definitions = {}
+        self._anon_name_counter = 0
+        # DIE offset -> signature, signature -> first DIE seen with it, and
+        # signature -> ctypes type of unions and anonymous structs.
+        self._signatures = {}
+        self._canonical_dies = {}
+        self._aggregates = {}
+        # Lazy struct -> pointer type resolving it on dereference.
+        self._lazy_pointers = {}
+        # Offset of canonical DIE -> `PrunedType`, for the latest conversion,
+        # and signature -> opaque struct standing for a pruned type.
+        self._pruned = {}
+        self._opaque_types = {}
+        # Named struct or union -> fingerprint, the hex signature of its DIE,
+        # and signature -> class reusable from previous layouts.
+        self._fingerprints = {}
+        self._reusable = {}
+        # `(kind, *layout)` -> ctypes type, see `_intern`.
+        self._interned = {}
+
+    @property
+    def dwarf_info(self):
+        with self._lock:
+            if self._dwarf_info is None:
+                with self._phase('dwarf_info'):
+                    self._dwarf_info = _get_dwarf_info(
+                        self.binary_path,
+                        relocate_dwarf_sections=self._relocate_dwarf_sections,
+                        mmap_sections=self._mmap_sections)
+            return self._dwarf_info
+
+    @property
+    def index(self):
+        """The `TypeIndex` of the binary, built or loaded on first use."""
+        with self._lock:
+            if self._index is None:
+                dwarf_info = self.dwarf_info
+                with self._phase('index'):
+                    name_table = None
+                    if self._use_accelerator_tables and self.binary_path is not None:
+                        name_table = _load_name_table(self.binary_path, dwarf_info)
+                    if name_table is not None:
+                        self._index = AcceleratedTypeIndex(
+                            dwarf_info, name_table, self._build_full_index,
+                            die_at=self._die_at)
+                    else:
+                        self._index = self._build_full_index()
+            return self._index
+
+    def _build_full_index(self):
+        if self._cache_dir is not None:
+            return _load_cached_type_index(
+                self.dwarf_info, self.binary_path, self._cache_dir,
+                cache_max_bytes=self._cache_max_bytes,
+                relocate_dwarf_sections=self._relocate_dwarf_sections,
+                jobs=self._index_jobs, die_at=self._die_at)
+        return _build_type_index(
+            self.dwarf_info, self.binary_path,
+            relocate_dwarf_sections=self._relocate_dwarf_sections,
+            jobs=self._index_jobs, die_at=self._die_at)
+
+    def _die_at(self, offset):
+        if not self._fast_die_decoder:
+            return self.dwarf_info.get_DIE_from_refaddr(offset)
+        if self._die_decoder is None:
+            self._die_decoder = _DIEDecoder(self.dwarf_info)
+        return self._die_decoder.die_at(offset)
+
+    def find_type_die(self, name: bytes):
+        type_die = self.index.find(name)
+        if type_die is None:
+            raise ValueError(f'No type DIE named {name} found')
+        return type_die
+
+    def get_type(self, name: bytes):
+        """Convert the type named `name` to ctypes.
+
+        With a `cache_dir`, the converted layout is kept there between runs.
+        """
+        return self.get_types([name])[name]
+
+    def get_types(self, names):
+        """Convert the types named `names` to ctypes, in one pass.
+
+        Returns a dict mapping each name to its ctypes type.  The types
+        reachable from all the names are traversed and sorted together, so
+        types shared between them are converted once.
+        """
+        with self._lock:
+            self.stats = ConversionStats()
+            unique_names = list(dict.fromkeys(names))
+            if self._cache_dir is not None:
+                # One layout for all the names, so the types they share are
+                # the same classes when loaded.
+                layout_path = self._get_layout_path(unique_names)
+                try:
+                    loaded = self._read_layouts(layout_path)
+                except (OSError, ValueError):
+                    pass
+                else:
+                    os.utime(layout_path)
+                    self.stats.layouts_loaded += 1
+                    return {name: loaded[name.decode('utf-8')] for name in names}
+
+            type_dies = [self.find_type_die(name) for name in unique_names]
+            types = dict(zip(unique_names, self._convert_roots(type_dies)))
+            if self._cache_dir is not None:
+                write_layouts(layout_path, types, fingerprints=self._fingerprints)
+                _evict_cache_files(self._cache_dir, self._cache_max_bytes,
+                                   keep=[layout_path])
+
+            return {name: types[name] for name in names}
+
+    def _read_layouts(self, path):
+        """`read_layouts(path)`, sharing classes with the library.
+
+        Aggregates with the fingerprint of a class of the library are that
+        class, and the others are added to the library, so types are the
+        same classes however many times they're loaded or converted.
+        """
+        with open(path) as f:
+            layouts = json.load(f)
+        known = {fingerprint: cls for cls, fingerprint in self._fingerprints.items()}
+        classes = _load_aggregates(layouts, known)
+        for key, aggregate in layouts['aggregates'].items():
+            fingerprint = aggregate.get('fingerprint')
+            if fingerprint is None or fingerprint in known:
+                continue
+            cls = classes[key]
+            self._fingerprints[cls] = fingerprint
+            if aggregate['kind'] == 'struct':
+                self._structures.setdefault(aggregate['name'], cls)
+            else:
+                self._aggregates[bytes.fromhex(fingerprint)] = cls
+        return {name: _build_described_type(description, classes)
+                for name, description in layouts['roots'].items()}
+
+    def dump_layouts(self, types):
+        """`dump_layouts(types)`, with the fingerprints of this library's types."""
+        with self._lock:
+            return dump_layouts(types, fingerprints=self._fingerprints)
+
+    def get_descriptor(self, names):
+        """Convert the types named `names` into a `LayoutDescriptor`."""
+        with self._lock:
+            return LayoutDescriptor(self.dump_layouts(self.get_types(names)))
+
+    def update_layouts(self, previous, names=None):
+        """Convert types again, reusing the unchanged types of `previous`.
+
+        `previous` are layouts dumped by `TypeLibrary.dump_layouts`, e.g. for
+        an earlier build of the binary, and `names` default to its roots.
+        Named structs and unions are reused when the fingerprint of their
+        definition in the binary is unchanged, as are the fingerprints of
+        all the types they refer to, directly or not.  The rest is converted
+        again.  Returns a `LayoutUpdate`.
+        """
+        with self._lock:
+            self.stats = ConversionStats()
+            if names is None:
+                names = [name.encode('utf-8') for name in previous['roots']]
+            with self._phase('fingerprint'):
+                self._reusable = self._find_reusable(previous)
+            try:
+                type_dies = [self.find_type_die(name) for name in names]
+                types = dict(zip(names, self._convert_roots(type_dies)))
+            finally:
+                self._reusable = {}
+            layouts = dump_layouts(types, fingerprints=self._fingerprints)
+
+            old = _fingerprints_by_name(previous)
+            new = _fingerprints_by_name(layouts)
+            return LayoutUpdate(
+                types=types,
+                layouts=layouts,
+                changed=sorted(name for name in old.keys() & new.keys()
+                               if old[name] != new[name]),
+                added=sorted(new.keys() - old.keys()),
+                removed=sorted(old.keys() - new.keys()))
+
+    def _find_reusable(self, previous):
+        """Map signatures of the reusable types of `previous` to their classes."""
+        aggregates = previous['aggregates']
+        classes = _load_aggregates(previous)
+
+        dirty = set()
+        referrers = defaultdict(set)
+        for key, aggregate in aggregates.items():
+            for field_ in aggregate['fields'] or ():
+                for referenced in _referenced_aggregates(field_[1]):
+                    referrers[referenced].add(key)
+            if aggregate['fields'] is None:
+                # It may be defined now.
+                dirty.add(key)
+            elif 'fingerprint' in aggregate:
+                tag = ('DW_TAG_structure_type' if aggregate['kind'] == 'struct'
+                       else 'DW_TAG_union_type')
+                definition = self.index.find_definition(
+                    tag, aggregate['name'].encode('utf-8'))
+                if (definition is None or
+                        self._signature(definition).hex() != aggregate['fingerprint']):
+                    dirty.add(key)
+
+        # Types referring to changed types are converted again too.
+        stack = list(dirty)
+        while stack:
+            for referrer in referrers[stack.pop()]:
+                if referrer not in dirty:
+                    dirty.add(referrer)
+                    stack.append(referrer)
+
+        reusable = {}
+        for key, aggregate in aggregates.items():
+            if key not in dirty and 'fingerprint' in aggregate:
+                reusable[bytes.fromhex(aggregate['fingerprint'])] = classes[key]
+                self._fingerprints[classes[key]] = aggregate['fingerprint']
+        return reusable
+
+    def _reuse(self, signature, name):
+        """The class of previous layouts with `signature`, if it can be reused."""
+        reused = self._reusable.get(signature)
+        if reused is not None:
+            self.stats.structs_reused += 1
+            if self._trace is not None:
+                self._trace('struct_reused', name=name)
+        return reused
+
+    def _get_layout_path(self, names):
+        os.makedirs(self._cache_dir, exist_ok=True)
+        if self._cache_key is None:
+            self._cache_key = _get_cache_key(self.binary_path)
+        name = b'\0'.join(sorted(names))
+        if self._max_pointer_depth is not None or self._max_structs is not None:
+            # Limited conversions have layouts of their own.
+            name += f'\0{self._max_pointer_depth}\0{self._max_structs}'.encode()
+        return os.path.join(
+            self._cache_dir,
+            f'{self._cache_key}-{hashlib.sha1(name).hexdigest()}{_LAYOUT_SUFFIX}')
+
+    def convert_type_die_to_ctypes(self, type_die):
+        """Convert `type_die`, a DIE of this library's binary, to ctypes."""
+        with self._lock:
+            self.stats = ConversionStats()
+            (type_ctypes,) = self._convert_roots([type_die])
+            return type_ctypes
+
+    def _convert_roots(self, type_dies):
+        if self._max_pointer_depth is not None or self._max_structs is not None:
+            with self._phase('frontier'):
+                self._pruned = self._plan_frontier(type_dies)
+
+        # traverse the graph.  save structs and their relationships
+        with self._phase('traverse'):
+            nodes, refs = self._traverse_type_graph(type_dies)
+        with self._phase('toposort'):
+            # All nodes are sorted, including those holding nothing by value.
+            sorted_offsets = _toposort({offset: refs.get(offset, ()) for offset in nodes})
+
+        with self._phase('convert'):
+            # Aggregates are converted after everything they hold by value, so
+            # converting their members only finds types converted already.
+            # Structs only pointed to so far are declared, and get their
+            # fields when their own definition is converted.  Definitions of
+            # declarations are nodes of the graph too, except for lazy
+            # libraries, which resolve them on first use.
+            for offset in reversed(sorted_offsets):
+                die = nodes[offset]
+                if (die.tag not in ('DW_TAG_structure_type', 'DW_TAG_union_type') or
+                        _is_declaration(die)):
+                    continue
+                self._convert_type_die_to_ctypes(die)
+
+            return [self._convert_type_die_to_ctypes(type_die)
+                    for type_die in type_dies]
+
+    @contextlib.contextmanager
+    def _phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.stats.phase_seconds[name] = (
+                self.stats.phase_seconds.get(name, 0) + seconds)
+            if self._trace is not None:
+                self._trace('phase', phase=name, seconds=seconds)
+
+    def _traverse_type_graph(self, type_dies):
+        """Find DIEs reachable from any of `type_dies`.
+
+        Returns a mapping from the offset of each reachable DIE to the DIE, and
+        a mapping from DIE offsets to the offsets of the DIEs they hold by
+        value, i.e. that must be converted before them.  DIEs are replaced by
+        their canonical DIE, so a type described in many CUs is a single node.
+        DIEs are visited in depth-first preorder, with an explicit stack.
+        """
+        nodes = {}
+        refs = {}
+        merged_offsets = set()
+
+        def canonical(type_die):
+            canonical_die = self._canonical_die(type_die)
+            if (canonical_die.offset != type_die.offset and
+                    type_die.offset not in merged_offsets):
+                merged_offsets.add(type_die.offset)
+                self.stats.duplicates_merged += 1
+            return canonical_die
+
+        stack = [canonical(type_die) for type_die in reversed(type_dies)]
+        while stack:
+            type_die = stack.pop()
+            if type_die.offset in nodes:
+                continue
+            nodes[type_die.offset] = type_die
+            self.stats.dies_visited += 1
+
+            held, pointed_to = self._type_graph_edges(type_die)
+            held = [canonical(die) for die in held]
+            if held:
+                refs[type_die.offset] = list(dict.fromkeys(die.offset for die in held))
+            successors = held
+            if not self._lazy:
+                successors = held + [canonical(die) for die in pointed_to
+                                     if not self._is_pruned(die)]
+            stack.extend(reversed(successors))
+        return nodes, refs
+
+    def _type_graph_edges(self, type_die):
+        """Returns the DIEs `type_die` holds by value and the DIEs it points to."""
+        if _is_declaration(type_die):
+            # Declarations are only pointed to, and so is their definition,
+            # which is converted along with the rest of the graph.
+            definition_die = self._find_definition(type_die)
+            if definition_die is None:
+                return [], []
+            return [], [definition_die]
+        elif type_die.tag in ('DW_TAG_structure_type', 'DW_TAG_union_type'):
+            if type_die.offset in self._pruned:
+                return [], []
+            return list(type_die.iter_children()), []
         elif type_die.tag in ('DW_TAG_typedef', 'DW_TAG_volatile_type',
-                              'DW_TAG_const_type', 'DW_TAG_member'):
+                            'DW_TAG_const_type', 'DW_TAG_member'):
             if 'DW_AT_type' not in type_die.attributes:
-                return
-            referenced_type = type_die.get_DIE_from_attribute('DW_AT_type')
-            refs[type_die].add(referenced_type)
-            traverse(referenced_type)
-        elif ('DW_AT_declaration' in type_die.attributes and
-              type_die.attributes['DW_AT_declaration'].value):
-            # XXX
-            resolved = _resolve_declaration(type_die)
-            refs[type_die].add(resolved)
-            traverse(resolved)
+                return [], []
+            return [type_die.get_DIE_from_attribute('DW_AT_type')], []
         elif type_die.tag == 'DW_TAG_base_type':
-            pass
+            return [], []
         elif type_die.tag == 'DW_TAG_pointer_type':
             if 'DW_AT_type' not in type_die.attributes:
-                return
-            referenced_type = type_die.get_DIE_from_attribute('DW_AT_type')
+                return [], []
             # Track pointers as well?
-            traverse(referenced_type)
+            return [], [type_die.get_DIE_from_attribute('DW_AT_type')]
         elif type_die.tag == 'DW_TAG_subroutine_type':
             # XXX: For the task of looking at program's data, we don't really care
             # about function pointers.  If a need arises, ctypes allow defining
             # `CFUNCTYPES`.
-            pass
+            return [], []
         elif type_die.tag == 'DW_TAG_array_type':
-            item_type = type_die.get_DIE_from_attribute('DW_AT_type')
-            refs[type_die].add(item_type)
-            traverse(item_type)
+            return [type_die.get_DIE_from_attribute('DW_AT_type')], []
         elif type_die.tag == 'DW_TAG_enumeration_type':
-            pass
+            return [], []
         else:
-            print(type_die)
-            import pdb; pdb.set_trace()
             raise NotImplementedError(
                 f'Converting {type_die.tag} type DIEs is not yet supported.')
 
-    traverse(type_die)
+    def _plan_frontier(self, type_dies):
+        """Find the structs and unions that the conversion limits leave out.
+
+        Types are visited breadth first, by the number of pointers between
+        them and `type_dies`.  Returns a dict mapping the offsets of the
+        canonical DIEs of the types left out to `PrunedType`s.
+        """
+        admitted = set()
+        pruned = {}
+        structs_nr = 0
+        depth = 0
+        # (DIE, whether it's held by value or a root) pairs, per pointer depth.
+        level = [(type_die, True) for type_die in type_dies]
+        while level:
+            next_level = []
+            stack = level[::-1]
+            while stack:
+                type_die, held = stack.pop()
+                aggregate = self._resolve_aggregate(type_die)
+                if aggregate is None:
+                    type_die = _strip_typedefs(type_die)
+                    if 'DW_AT_type' not in type_die.attributes:
+                        continue
+                    if type_die.tag == 'DW_TAG_pointer_type':
+                        next_level.append((type_die.get_DIE_from_attribute('DW_AT_type'), False))
+                    elif type_die.tag == 'DW_TAG_array_type':
+                        stack.append((type_die.get_DIE_from_attribute('DW_AT_type'), True))
+                    continue
+                if aggregate.offset in admitted or aggregate.offset in pruned:
+                    continue
 
-    for die in _toposort(refs):
-        if die.tag != 'DW_TAG_structure_type':
-            continue
-        # print(die)
-        if 'DW_AT_name' in die.attributes:
-            name = die.attributes['DW_AT_name'].value
+                named = 'DW_AT_name' in aggregate.attributes
+                if named and self._is_converted(aggregate):
+                    # Reused as it is, with the types it refers to.
+                    admitted.add(aggregate.offset)
+                    continue
+                reason = None
+                if held and not named:
+                    pass
+                elif (self._max_pointer_depth is not None and
+                      depth > self._max_pointer_depth):
+                    reason = 'max_pointer_depth'
+                elif self._max_structs is not None and structs_nr >= self._max_structs:
+                    reason = 'max_structs'
+                else:
+                    structs_nr += 1
+                if reason is not None:
+                    name = (aggregate.attributes['DW_AT_name'].value.decode('utf-8')
+                            if named else None)
+                    pruned[aggregate.offset] = PrunedType(name=name, tag=aggregate.tag,
+                                                          depth=depth, reason=reason)
+                    self.stats.pruned.append(pruned[aggregate.offset])
+                    if self._trace is not None:
+                        self._trace('pruned', name=name, depth=depth, reason=reason)
+                    continue
+
+                admitted.add(aggregate.offset)
+                stack.extend(
+                    (member_die.get_DIE_from_attribute('DW_AT_type'), True)
+                    for member_die in reversed(list(aggregate.iter_children()))
+                    if 'DW_AT_type' in member_die.attributes)
+            level = next_level
+            depth += 1
+        return pruned
+
+    def _resolve_aggregate(self, type_die):
+        """The canonical definition of the struct or union `type_die` names, if any."""
+        type_die = _strip_typedefs(type_die)
+        if type_die.tag not in ('DW_TAG_structure_type', 'DW_TAG_union_type'):
+            return None
+        if _is_declaration(type_die):
+            type_die = self._find_definition(type_die)
+            if type_die is None:
+                return None
+        return self._canonical_die(type_die)
+
+    def _is_converted(self, aggregate):
+        """Whether the named struct or union `aggregate` was converted by an
+        earlier conversion of the library."""
+        name = aggregate.attributes['DW_AT_name'].value.decode('utf-8')
+        return (name in self._structures and
+                name not in self._declarations_to_be_resolved)
+
+    def _is_pruned(self, type_die):
+        """Whether `type_die` names a type left out by the conversion limits."""
+        if not self._pruned:
+            return False
+        aggregate = self._resolve_aggregate(type_die)
+        return aggregate is not None and aggregate.offset in self._pruned
+
+    def _canonical_die(self, die):
+        """Returns the first DIE seen with the same signature as `die`."""
+        return self._canonical_dies.setdefault(self._signature(die), die)
+
+    def _signature(self, die):
+        """A digest of the tag, name, size and layout of the DIE `die`.
+
+        DIEs of different CUs describing the same type have the same
+        signature.  Pointers to named types only hash the name, so recursive
+        types have finite signatures; types met again while being hashed,
+        which C doesn't allow otherwise, are hashed by their tag.  The DIEs
+        a signature depends on are hashed first, with an explicit stack.
+        """
+        signatures = self._signatures
+        if die.offset in signatures:
+            return signatures[die.offset]
+
+        in_progress = {die.offset}
+        stack = [(die, *self._signature_parts(die), [0])]
+        while stack:
+            top_die, parts, dependencies, position = stack[-1]
+            if position[0] < len(dependencies):
+                dependency = dependencies[position[0]]
+                position[0] += 1
+                if (not isinstance(dependency, tuple) and
+                        dependency.offset not in signatures and
+                        dependency.offset not in in_progress):
+                    in_progress.add(dependency.offset)
+                    stack.append((dependency, *self._signature_parts(dependency), [0]))
+                continue
+
+            stack.pop()
+            in_progress.discard(top_die.offset)
+            for dependency in dependencies:
+                if isinstance(dependency, tuple):
+                    parts.append(dependency)
+                else:
+                    parts.append(signatures.get(dependency.offset,
+                                                ('cycle', dependency.tag)))
+            signatures[top_die.offset] = hashlib.blake2b(
+                repr(parts).encode(), digest_size=16).digest()
+        return signatures[die.offset]
+
+    @staticmethod
+    def _signature_parts(die):
+        """Returns the attributes `die`'s signature hashes, and what it depends on.
+
+        Dependencies are DIEs, whose signatures are hashed too, or tuples
+        hashed as they are.
+        """
+        attributes = die.attributes
+        parts = [die.tag]
+        for name in _SIGNATURE_ATTRIBUTES:
+            parts.append(attributes[name].value if name in attributes else None)
+        dependencies = []
+        if 'DW_AT_type' in attributes:
+            type_die = die.get_DIE_from_attribute('DW_AT_type')
+            if die.tag == 'DW_TAG_pointer_type':
+                type_die, qualifiers = _strip_qualifiers(type_die)
+                parts.append(qualifiers)
+                if 'DW_AT_name' in type_die.attributes:
+                    type_die = (type_die.tag, type_die.attributes['DW_AT_name'].value)
+            dependencies.append(type_die)
+        dependencies.extend(die.iter_children())
+        return parts, dependencies
+
+    def _convert_type_die_to_ctypes(self, type_die, declaration=False):
+        type_die = _resolve_type(type_die)
+        if _is_declaration(type_die):
+            type_die = self._resolve_declaration(type_die)
+
+        if self._is_pruned(type_die):
+            return self._convert_opaque_type_die_to_ctypes(type_die)
+        elif type_die.tag == 'DW_TAG_base_type':
+            return _convert_base_type_die_to_ctypes(type_die)
+        elif type_die.tag == 'DW_TAG_pointer_type':
+            return self._convert_pointer_type_die_to_ctypes(type_die)
+        elif type_die.tag == 'DW_TAG_subroutine_type':
+            # XXX: For the task of looking at program's data, we don't really care
+            # about function pointers.  If a need arises, ctypes allow defining
+            # `CFUNCTYPES`.
+            return ctypes.c_void_p
+        elif type_die.tag == 'DW_TAG_array_type':
+            return self._convert_array_type_die_to_ctypes(type_die)
+        elif type_die.tag == 'DW_TAG_enumeration_type':
+            return self._convert_enum_type_die_to_ctypes(type_die)
+        elif type_die.tag == 'DW_TAG_union_type':
+            return self._convert_unon_type_die_to_ctypes(type_die)
+        elif type_die.tag == 'DW_TAG_structure_type':
+            return self._convert_structure_type_die_to_ctypes(type_die, declaration=declaration)
         else:
-            name = 'anon_struct?'
-        print('>>> ', name)
-        _convert_type_die_to_ctypes(die)
+            raise NotImplementedError(
+                f'Converting {type_die.tag} type DIEs is not yet supported.')
 
-    for decl in list(_declarations_to_be_resolved.values()):
-        _convert_type_die_to_ctypes(decl)
+    def _find_definition(self, declaration_die):
+        """The DIE defining the type `declaration_die` declares, or None.
+
+        Unlike `_resolve_declaration`, it isn't counted or traced, so it can
+        be used to look ahead at definitions.
+        """
+        key = (declaration_die.tag, declaration_die.attributes['DW_AT_name'].value)
+        if key not in self._definitions:
+            self._definitions[key] = self.index.find_definition(*key)
+        return self._definitions[key]
+
+    def _resolve_declaration(self, maybe_declaration_die):
+        assert _is_declaration(maybe_declaration_die)
+
+        declaration_die = maybe_declaration_die
+        type_name = declaration_die.attributes['DW_AT_name'].value
+        definition_die = self._find_definition(declaration_die)
+        if definition_die is None:
+            raise DefinitionNotFound(f"Can't find declaration named {type_name}")
+        self.stats.declarations_resolved += 1
+        if self._trace is not None:
+            self._trace('declaration_resolved', name=type_name,
+                        offset=definition_die.offset)
+        return definition_die
+
+    def _convert_pointer_type_die_to_ctypes(self, pointer_die):
+        if 'DW_AT_type' not in pointer_die.attributes:
+            return ctypes.c_void_p
+        type_die = pointer_die.get_DIE_from_attribute('DW_AT_type')
+        if type_die.tag == 'DW_TAG_const_type' and not type_die.attributes:
+            return ctypes.c_void_p
+        if self._is_pruned(type_die):
+            return ctypes.c_void_p
+        try:
+            pointed_to_type = self._convert_type_die_to_ctypes(type_die, declaration=True)
+        except DefinitionNotFound:
+            return ctypes.c_void_p  # XXX
+        if isinstance(pointed_to_type, _LazyStructType):
+            if pointed_to_type not in self._lazy_pointers:
+                self._lazy_pointers[pointed_to_type] = type(
+                    f'LP_{pointed_to_type.__name__}',
+                    (_LazyPointerMixin, ctypes.POINTER(pointed_to_type)),
+                    {'_type_': pointed_to_type})
+            return self._lazy_pointers[pointed_to_type]
+        return self._intern(('pointer', pointed_to_type),
+                            lambda: ctypes.POINTER(pointed_to_type))
+
+    def _materialize(self, offset):
+        """Convert the fields of the lazy struct defined by the DIE at `offset`."""
+        with self._lock:
+            self._convert_roots([self._die_at(offset)])
+
+    def _convert_opaque_type_die_to_ctypes(self, type_die):
+        """An opaque struct with the size of the struct or union `type_die`."""
+        signature = self._signature(type_die)
+        if signature not in self._opaque_types:
+            if 'DW_AT_name' in type_die.attributes:
+                name = type_die.attributes['DW_AT_name'].value.decode('utf-8')
+            else:
+                name = self._get_anon_name('opaque_')
+            opaque = type(name, (ctypes.Structure,), {})
+            size = type_die.attributes['DW_AT_byte_size'].value
+            _set_fields(opaque, [('_opaque', ctypes.c_byte * size, None)])
+            self._opaque_types[signature] = opaque
+        return self._opaque_types[signature]
+
+    def _convert_array_type_die_to_ctypes(self, array_die):
+        (subrange_die,) = list(array_die.iter_children())
+        item_type = self._convert_type_die_to_ctypes(array_die.get_DIE_from_attribute('DW_AT_type'))
+        if 'DW_AT_upper_bound' not in subrange_die.attributes:
+            # XXX: That should be only the last item in struct.
+            length = 0
+        else:
+            length = subrange_die.attributes['DW_AT_upper_bound'].value
+        return self._intern(('array', item_type, length), lambda: item_type * length)
 
-    return _convert_type_die_to_ctypes(type_die)
+    def _convert_enum_type_die_to_ctypes(self, enum_die):
+        return self._convert_type_die_to_ctypes(enum_die.get_DIE_from_attribute('DW_AT_type'))
 
+    def _convert_unon_type_die_to_ctypes(self, union_die):
+        assert union_die.tag == 'DW_TAG_union_type'
 
-def _toposort(refs):
+        if 'DW_AT_name' in union_die.attributes:
+            union_name = union_die.attributes['DW_AT_name'].value.decode('utf-8')
+        else:
+            union_name = self._get_anon_name('union_')
+
+        signature = self._signature(union_die)
+        if signature in self._aggregates:
+            self.stats.cache_hits += 1
+            if self._trace is not None:
+                self._trace('cache_hit', name=union_name)
+            return self._aggregates[signature]
+        if 'DW_AT_name' in union_die.attributes:
+            reused = self._reuse(signature, union_name)
+            if reused is not None:
+                self._aggregates[signature] = reused
+                return reused
+
+        members_info = [
+            self._get_member_info(member_die)
+            for member_die in union_die.iter_children()
+        ]
+
+        fields = [(member.name, member.ctypes_type, member.bit_size) for member in members_info]
+        if 'DW_AT_name' not in union_die.attributes:
+            layout = ('union', tuple(fields))
+            union = self._find_interned(layout)
+            if union is not None:
+                self._aggregates[signature] = union
+                return union
+        union = type(union_name, (ctypes.Union,), {})
+        _set_fields(union, fields)
+        self._aggregates[signature] = union
+        if 'DW_AT_name' in union_die.attributes:
+            self._fingerprints[union] = signature.hex()
+        else:
+            self._interned[layout] = union
 
-    discovered = defaultdict(bool)
-    processed = defaultdict(bool)
-    sorted_nodes = []
-    parent = {}
-
-    def dfs(x):
-        discovered[x] = True
-        for y in refs[x]:
-            if not discovered[y]:
-                parent[y] = x
-                process_edge(x, y)
-                dfs(y)
+        self.stats.structs_built += 1
+        if self._trace is not None:
+            self._trace('struct_built', name=union_name, size=ctypes.sizeof(union))
+        return union
+
+    def _convert_structure_type_die_to_ctypes(self, struct_die, declaration=False):
+        assert struct_die.tag == 'DW_TAG_structure_type'
+
+        if 'DW_AT_name' in struct_die.attributes:
+            struct_name = struct_die.attributes['DW_AT_name'].value.decode('utf-8')
+            is_anon_struct = False
+        else:
+            # Identical anonymous structs, e.g. from the same header included
+            # by several CUs, are converted once.
+            signature = self._signature(struct_die)
+            if signature in self._aggregates:
+                self.stats.cache_hits += 1
+                if self._trace is not None:
+                    self._trace('cache_hit', name=self._aggregates[signature].__name__)
+                return self._aggregates[signature]
+            struct_name = self._get_anon_name('struct_')
+            is_anon_struct = True
+            # Can't have a declaration of an anon struct.
+            declaration = False
+
+        if struct_name in self._declarations_to_be_resolved and not declaration:
+            resolve_declaration = True
+        else:
+            resolve_declaration = False
+
+        if not is_anon_struct:
+            if struct_name in self._structures:
+                struct = self._structures[struct_name]
+                if not resolve_declaration:
+                    self.stats.cache_hits += 1
+                    if self._trace is not None:
+                        self._trace('cache_hit', name=struct_name)
+                    return self._structures[struct_name]
+
+        if not is_anon_struct and not resolve_declaration and self._reusable:
+            reused = self._reuse(self._signature(struct_die), struct_name)
+            if reused is not None:
+                self._structures[struct_name] = reused
+                return reused
+
+        if not resolve_declaration and not is_anon_struct:
+            # Forward declare the struct for self referencing structures.
+            if declaration and self._lazy:
+                struct = _LazyStructType(struct_name, (ctypes.Structure,), {})
+                struct._materialize = functools.partial(self._materialize,
+                                                        struct_die.offset)
             else:
-                process_edge(x, y)
-        sorted_nodes.append(x)
-        processed[x] = True
+                struct = type(struct_name, (ctypes.Structure,), {})
+            self._structures[struct_name] = struct
+
+        if declaration:
+            assert not is_anon_struct
+            self._declarations_to_be_resolved[struct_name] = struct_die
+            return struct
+
+        members_info = [
+            self._get_member_info(member_die)
+            for member_die in struct_die.iter_children()
+        ]
+
+        def pad_fields(members_info):
+            struct_fields = []
+            struct_size = struct_die.attributes['DW_AT_byte_size'].value
+            padding_nr = 0
+            bytes_so_far = 0
+
+            def pad(n):
+                nonlocal padding_nr, bytes_so_far
+                if not n:
+                    return
+                assert n > 0
+                padding = self._intern(('padding', n), lambda: ctypes.c_byte * n)
+                struct_fields.append((f'__padding_{padding_nr}', padding, None))
+                padding_nr += 1
+                bytes_so_far += n
+
+            for member in members_info:
+                if member.offset > bytes_so_far:
+                    pad(member.offset - bytes_so_far)
+
+                if member.offset < bytes_so_far:
+                    assert member.bit_size is not None
+                    # XXX
+                    if member.offset + member.size != bytes_so_far:
+                        continue
+                    continue  # XXX
+                    # assert member.offset + member.size == bytes_so_far
+                else:
+                    bytes_so_far += member.size
+
+                struct_fields.append((
+                        member.name,
+                        member.ctypes_type,
+                        None # member.bit_size,
+                ))
+
+            pad(struct_size - bytes_so_far)
+
+            return struct_fields
+
+        # TODO: Try to resolve flexible array members?
+
+        struct_fields = pad_fields(members_info)
+        if is_anon_struct:
+            # Nothing can refer to an anonymous struct before it's built, so
+            # it's only created once its layout is known, and shares the class
+            # of an identical layout built before.
+            layout = ('struct', tuple(struct_fields))
+            struct = self._find_interned(layout)
+            if struct is not None:
+                self._aggregates[signature] = struct
+                return struct
+            struct = self._interned[layout] = type(struct_name, (ctypes.Structure,), {})
+        _set_fields(struct, struct_fields)
 
-    def process_edge(x, y):
-        if parent.get(y) == x:
-            return
-        if discovered[y] and not processed[y]:
-            raise RuntimeError('A cycle')
+        if resolve_declaration:
+            self._declarations_to_be_resolved.pop(struct_name)
+        if is_anon_struct:
+            self._aggregates[signature] = struct
+        else:
+            self._fingerprints[struct] = self._signature(struct_die).hex()
 
-    for node in list(refs.keys()):
-        if not discovered[node]:
-            dfs(node)
+        self.stats.structs_built += 1
+        if self._trace is not None:
+            self._trace('struct_built', name=struct_name, size=ctypes.sizeof(struct))
+        return struct
 
-    return tuple(reversed(sorted_nodes))
+    def _intern(self, key, build):
+        """Return the type interned under `key`, interning `build()` if none is."""
+        interned = self._find_interned(key)
+        if interned is None:
+            interned = self._interned[key] = build()
+        return interned
+
+    def _find_interned(self, key):
+        """Return the type interned under `key`, or None.
+
+        Types are interned under their kind followed by their layout, e.g.
+        `('array', item_type, length)`, so that types built the same way in
+        different places of a binary share one class.  Uses of interned types
+        are counted in `stats.interned`.
+        """
+        interned = self._interned.get(key)
+        if interned is not None:
+            self.stats.interned[key[0]] = self.stats.interned.get(key[0], 0) + 1
+        return interned
+
+    def _get_anon_name(self, what=''):
+        self._anon_name_counter += 1
+        return f'anon_{what}{self._anon_name_counter}'
+
+    def _get_member_info(self, member_die):
+        assert member_die.tag == 'DW_TAG_member'
+        type_die = _resolve_type(member_die.get_DIE_from_attribute('DW_AT_type'))
+        size = _get_type_size(type_die)
+        if 'DW_AT_data_member_location' in member_die.attributes:
+            offset = member_die.attributes['DW_AT_data_member_location'].value
+        else:
+            offset = None
 
+        if 'DW_AT_name' not in member_die.attributes:
+            name = None
+            ctypes_type = self._convert_type_die_to_ctypes(type_die)
+        else:
+            name = member_die.attributes['DW_AT_name'].value.decode('utf-8')
+            ctypes_type = self._convert_type_die_to_ctypes(type_die)
 
-def _convert_type_die_to_ctypes(type_die, declaration=False):
-    if type_die.tag in ('DW_TAG_typedef', 'DW_TAG_volatile_type', 'DW_TAG_const_type'):
-        return _convert_type_die_to_ctypes(_resolve_type(type_die),
-                                           declaration=declaration)
-    elif ('DW_AT_declaration' in type_die.attributes and
-          type_die.attributes['DW_AT_declaration'].value):
-        return _convert_type_die_to_ctypes(_resolve_declaration(type_die),
-                                           declaration=declaration)
-    elif type_die.tag == 'DW_TAG_base_type':
-        return _convert_base_type_die_to_ctypes(type_die)
-    elif type_die.tag == 'DW_TAG_pointer_type':
-        return _convert_pointer_type_die_to_ctypes(type_die)
-    elif type_die.tag == 'DW_TAG_subroutine_type':
-        # XXX: For the task of looking at program's data, we don't really care
-        # about function pointers.  If a need arises, ctypes allow defining
-        # `CFUNCTYPES`.
-        return ctypes.c_void_p
-    elif type_die.tag == 'DW_TAG_array_type':
-        return _convert_array_type_die_to_ctypes(type_die)
-    elif type_die.tag == 'DW_TAG_enumeration_type':
-        return _convert_enum_type_die_to_ctypes(type_die)
-    elif type_die.tag == 'DW_TAG_union_type':
-        return _convert_unon_type_die_to_ctypes(type_die)
-    elif type_die.tag == 'DW_TAG_structure_type':
-        return _convert_structure_type_die_to_ctypes(type_die, declaration=declaration)
-    else:
-        print(type_die)
-        import pdb; pdb.set_trace()
-        raise NotImplementedError(
-            f'Converting {type_die.tag} type DIEs is not yet supported.')
+        if 'DW_AT_bit_size' in member_die.attributes:
+            bit_size = member_die.attributes['DW_AT_bit_size'].value
+        else:
+            bit_size = None
 
+        return MemberInfo(name=name, ctypes_type=ctypes_type, die=member_die,
+                          size=size, offset=offset, bit_size=bit_size)
 
-def _resolve_type(type_die):
-    if type_die.tag in ('DW_TAG_typedef', 'DW_TAG_volatile_type', 'DW_TAG_const_type'):
-        return _resolve_type(type_die.get_DIE_from_attribute('DW_AT_type'))
+
+# Attributes of a DIE, besides its type and children, that its signature hashes.
+_SIGNATURE_ATTRIBUTES = (
+    'DW_AT_name', 'DW_AT_byte_size', 'DW_AT_encoding', 'DW_AT_declaration',
+    'DW_AT_data_member_location', 'DW_AT_bit_size', 'DW_AT_bit_offset',
+    'DW_AT_data_bit_offset', 'DW_AT_upper_bound', 'DW_AT_count',
+    'DW_AT_const_value',
+)
+
+
+def _strip_typedefs(type_die):
+    """Returns the type `type_die` names, without typedefs and qualifiers.
+
+    Unlike `_resolve_type`, qualifiers of void are kept.
+    """
+    while (type_die.tag in ('DW_TAG_typedef', 'DW_TAG_volatile_type', 'DW_TAG_const_type') and
+           'DW_AT_type' in type_die.attributes):
+        type_die = type_die.get_DIE_from_attribute('DW_AT_type')
     return type_die
 
 
-class DefinitionNotFound(Exception):
-    pass
+def _strip_qualifiers(type_die):
+    """Returns `type_die` without const and volatile, and their tags."""
+    qualifiers = []
+    while (type_die.tag in ('DW_TAG_const_type', 'DW_TAG_volatile_type') and
+           'DW_AT_type' in type_die.attributes):
+        qualifiers.append(type_die.tag)
+        type_die = type_die.get_DIE_from_attribute('DW_AT_type')
+    return type_die, tuple(qualifiers)
 
 
-def _resolve_declaration(maybe_declaration_die):
-    assert ('DW_AT_declaration' in maybe_declaration_die.attributes and
-            maybe_declaration_die.attributes['DW_AT_declaration'].value)
+class _LazyStructType(type(ctypes.Structure)):
+    """The metaclass of structs whose fields are converted on first use."""
 
-    declaration_die = maybe_declaration_die
-    type_name = declaration_die.attributes['DW_AT_name'].value
-    for compilation_unit in declaration_die.dwarfinfo.iter_CUs():
-            top_die = compilation_unit.get_top_DIE()
-            for child in top_die.iter_children():
-                if (('DW_AT_declaration' not in child.attributes or
-                            not child.attributes['DW_AT_declaration'].value) and
-                        child.attributes.get('DW_AT_name') and
-                        child.tag == declaration_die.tag and
-                        child.attributes.get('DW_AT_name').value == type_name):
-                    return child
+    def resolve(cls):
+        """Convert the fields of the struct, unless done already."""
+        if '_fields_' not in cls.__dict__:
+            cls._materialize()
 
-    raise DefinitionNotFound(f"Can't find declaration named {type_name}")
+    def __getattr__(cls, name):
+        # Only called for missing attributes, e.g. fields of an empty struct.
+        # Private names are looked up by ctypes itself.
+        if name.startswith('_') or '_fields_' in cls.__dict__:
+            raise AttributeError(name)
+        cls.resolve()
+        return getattr(cls, name)
+
+    def __call__(cls, *args, **kwargs):
+        cls.resolve()
+        return super().__call__(*args, **kwargs)
+
+    # `ctypes.sizeof()` can't be hooked: it's 0 until the struct is resolved.
+    def from_buffer(cls, *args):
+        cls.resolve()
+        return super().from_buffer(*args)
+
+    def from_buffer_copy(cls, *args):
+        cls.resolve()
+        return super().from_buffer_copy(*args)
+
+    def from_address(cls, *args):
+        cls.resolve()
+        return super().from_address(*args)
+
+    def in_dll(cls, *args):
+        cls.resolve()
+        return super().in_dll(*args)
+
+
+def resolved(ctype):
+    """Return `ctype`, converting its fields first if it's a lazy struct.
+
+    Needed before `ctypes.sizeof()` or `_fields_` are used, as a lazy struct
+    has neither until it's resolved.
+    """
+    if isinstance(ctype, _LazyStructType):
+        ctype.resolve()
+    return ctype
+
+
+class _LazyPointerMixin:
+    """Resolves the lazy struct a pointer points to when it's dereferenced."""
+    __slots__ = ()
+
+    @property
+    def contents(self):
+        self._type_.resolve()
+        return ctypes._Pointer.contents.__get__(self)
+
+    @contents.setter
+    def contents(self, value):
+        ctypes._Pointer.contents.__set__(self, value)
+
+    def __getitem__(self, index):
+        self._type_.resolve()
+        return super().__getitem__(index)
+
+
+def _toposort(refs):
+    """Sort the nodes of `refs` so that every node comes before its references.
+
+    The sort is a depth-first search with an explicit stack, which raises
+    RuntimeError on cycles.
+    """
+    # Node -> _DISCOVERED or _PROCESSED.
+    state = {}
+    sorted_nodes = []
+
+    for root in list(refs):
+        if root in state:
+            continue
+        state[root] = _DISCOVERED
+        stack = [(root, iter(refs[root]))]
+        while stack:
+            node, successors = stack[-1]
+            for successor in successors:
+                successor_state = state.get(successor)
+                if successor_state is None:
+                    state[successor] = _DISCOVERED
+                    stack.append((successor, iter(refs.get(successor, ()))))
+                    break
+                if successor_state == _DISCOVERED:
+                    raise RuntimeError('A cycle')
+            else:
+                stack.pop()
+                state[node] = _PROCESSED
+                sorted_nodes.append(node)
+
+    return tuple(reversed(sorted_nodes))
+
+
+_DISCOVERED = 1
+_PROCESSED = 2
+
+
+def _resolve_type(type_die):
+    while type_die.tag in ('DW_TAG_typedef', 'DW_TAG_volatile_type', 'DW_TAG_const_type'):
+        type_die = type_die.get_DIE_from_attribute('DW_AT_type')
+    return type_die
+
+
+class DefinitionNotFound(Exception):
+    pass
 
 
 _DWARF_BASE_TYPES_TO_CTYPES = {
@@ -240,60 +2456,11 @@ _DWARF_BASE_TYPES_TO_CTYPES = {
 def _convert_base_type_die_to_ctypes(type_die):
     type_name = type_die.attributes['DW_AT_name'].value
     if type_name not in _DWARF_BASE_TYPES_TO_CTYPES:
-        print(type_die)
         raise NotImplementedError(
             f'Converting {type_name} DWARF type is not yet supported')
     return _DWARF_BASE_TYPES_TO_CTYPES[type_name]
 
 
-def _convert_pointer_type_die_to_ctypes(pointer_die):
-    if 'DW_AT_type' not in pointer_die.attributes:
-        return ctypes.c_void_p
-    type_die = pointer_die.get_DIE_from_attribute('DW_AT_type')
-    if type_die.tag == 'DW_TAG_const_type' and not type_die.attributes:
-        return ctypes.c_void_p
-    try:
-        pointed_to_type = _convert_type_die_to_ctypes(type_die, declaration=True)
-    except DefinitionNotFound:
-        return ctypes.c_void_p  # XXX
-    return ctypes.POINTER(pointed_to_type)
-
-
-def _convert_array_type_die_to_ctypes(array_die):
-    (subrange_die,) = list(array_die.iter_children())
-    item_type = _convert_type_die_to_ctypes(array_die.get_DIE_from_attribute('DW_AT_type'))
-    if 'DW_AT_upper_bound' not in subrange_die.attributes:
-        # XXX: That should be only the last item in struct.
-        # import pdb; pdb.set_trace()
-        return item_type * 0
-    return item_type * subrange_die.attributes['DW_AT_upper_bound'].value
-
-
-def _convert_enum_type_die_to_ctypes(enum_die):
-    return _convert_type_die_to_ctypes(enum_die.get_DIE_from_attribute('DW_AT_type'))
-
-
-def _convert_unon_type_die_to_ctypes(union_die):
-    assert union_die.tag == 'DW_TAG_union_type'
-
-    if 'DW_AT_name' in union_die.attributes:
-        union_name = union_die.attributes['DW_AT_name'].value.decode('utf-8')
-    else:
-        union_name = _get_anon_name('union_')
-
-    union = type(union_name, (ctypes.Union,), {})
-
-    members_info = [
-        _get_member_info(member_die)
-        for member_die in union_die.iter_children()
-    ]
-
-    fields = [(member.name, member.ctypes_type, member.bit_size) for member in members_info]
-    _set_fields(union, fields)
-
-    return union
-
-
 def _split_anon_fields(struct_fields):
     """For each field definition with None name, get a anon name, and return
     a list of anonymous fields."""
@@ -319,225 +2486,6 @@ def _set_fields(struct_or_union, fields):
     struct_or_union._fields_ = struct_fields
 
 
-_structures = {}
-_structures_lock = threading.Lock()
-_declarations_to_be_resolved = {}
-
-import inspect
-
-
-def _dump(struct_die, struct_name=None, verbose=False):
-
-    if verbose:
-        print('\n' + '+' * 100)
-        print(struct_die)
-        for member in struct_die.iter_children():
-            print('\n' + '=' * 100)
-            print(member)
-            print('-' * 30)
-            print(member.get_DIE_from_attribute('DW_AT_type'))
-    else:
-        print(f'>>> {struct_name}')
-        for member_die in struct_die.iter_children():
-            if 'DW_AT_name' not in member_die.attributes:
-                member_name = '<anon>'
-            else:
-                member_name = member_die.attributes['DW_AT_name'].value.decode('utf-8')
-            member_type_die = _resolve_type(member_die.get_DIE_from_attribute('DW_AT_type'))
-            if 'DW_AT_byte_size' in member_type_die.attributes:
-                byte_size = member_type_die.attributes['DW_AT_byte_size'].value
-            else:
-                byte_size = '-'
-            offset = member_die.attributes['DW_AT_data_member_location'].value
-            if 'DW_AT_bit_size' in member_die.attributes:
-                bit_size = member_die.attributes['DW_AT_bit_size'].value
-            else:
-                bit_size = '-'
-            if 'DW_AT_bit_offset' in member_die.attributes:
-                bits_offset = member_die.attributes['DW_AT_bit_offset'].value
-            else:
-                bits_offset = '-'
-            print(f'    {member_name:25}'
-                  f'oft={offset:5} sz={byte_size:5} bits={bit_size:5} bits_oft={bits_offset:5}'
-                  f'type={member_type_die.tag:20}')
-
-
-def _dump_ctype_struct(struct):
-    for field_tuple in struct._fields_:
-        print(f'{field_tuple[0]}: {getattr(struct, field_tuple[0])}')
-
-
-def _convert_structure_type_die_to_ctypes(struct_die, declaration=False):
-    assert struct_die.tag == 'DW_TAG_structure_type'
-
-    stack_len = len(inspect.stack(0))
-
-    if 'DW_AT_name' in struct_die.attributes:
-        struct_name = struct_die.attributes['DW_AT_name'].value.decode('utf-8')
-        is_anon_struct = False
-    else:
-        struct_name = _get_anon_name('struct_')
-        is_anon_struct = True
-        # Can't have a declaration of an anon struct.
-        declaration = False
-
-    print(f'{stack_len}> converting {struct_name}')
-
-    if struct_name in _declarations_to_be_resolved and not declaration:
-        resolve_declaration = True
-    else:
-        resolve_declaration = False
-
-    if not is_anon_struct:
-        with _structures_lock:
-            if struct_name in _structures:
-                struct = _structures[struct_name]
-                if not resolve_declaration:
-                    print(f'{stack_len}> returning {struct_name} from cache')
-                    return _structures[struct_name]
-
-    if not resolve_declaration:
-        # Forward declare the struct for self referencing structures.
-        struct = type(struct_name, (ctypes.Structure,), {})
-        if not is_anon_struct:
-            with _structures_lock:
-                print(f'{stack_len}> saving not yet completed {struct_name} in cache')
-                _structures[struct_name] = struct
-
-    if declaration:
-        if is_anon_struct:
-            import pdb; pdb.set_trace()
-        assert not is_anon_struct
-        _declarations_to_be_resolved[struct_name] = struct_die
-        return struct
-
-    members_info = [
-        _get_member_info(member_die)
-        for member_die in struct_die.iter_children()
-    ]
-
-    # if struct_name in (b'task_struct', 'task_struct'):
-    #     import pdb; pdb.set_trace()
-
-    def pad_fields(members_info):
-        struct_fields = []
-        struct_size = struct_die.attributes['DW_AT_byte_size'].value
-        padding_nr = 0
-        bytes_so_far = 0
-
-        def pad(n):
-            nonlocal padding_nr, bytes_so_far
-            if not n:
-                return
-            assert n > 0
-            struct_fields.append((f'__padding_{padding_nr}', ctypes.c_byte * n, None))
-            padding_nr += 1
-            bytes_so_far += n
-
-        for member in members_info:
-            if member.offset > bytes_so_far:
-                pad(member.offset - bytes_so_far)
-
-            if member.offset < bytes_so_far:
-                assert member.bit_size is not None
-                # XXX
-                if member.offset + member.size != bytes_so_far:
-                    continue
-                continue  # XXX
-                # assert member.offset + member.size == bytes_so_far
-            else:
-                bytes_so_far += member.size
-
-            struct_fields.append((
-                    member.name,
-                    member.ctypes_type,
-                    None # member.bit_size,
-            ))
-
-        pad(struct_size - bytes_so_far)
-
-        return struct_fields
-
-    # TODO: Try to resolve flexible array members?
-
-    struct_fields = pad_fields(members_info)
-    try:
-        print(f'{stack_len}> setting fields on {struct_name}')
-        _set_fields(struct, struct_fields)
-    except Exception as e:
-        # import pdb; pdb.set_trace()
-        print(e)
-        raise
-
-    # struct_size = struct_die.attributes['DW_AT_byte_size'].value
-    # if ctypes.sizeof(struct) != struct_size:
-    #     print(f"{struct_name} size doesn't match.  Struct's DW_AT_byte_size: {struct_size}; sizeof(struct): {ctypes.sizeof(struct)}")
-    #     print(struct_die)
-    #
-    #     import pdb; pdb.set_trace()
-    #
-    #     for member_die in struct_die.iter_children():
-    #         member_name = member_die.attributes['DW_AT_name'].value.decode('ascii')
-    #         member_type = _resolve_type(member_die.get_DIE_from_attribute('DW_AT_type'))
-    #         ctypes_field = getattr(struct, member_name)
-    #         die_offset = member_die.attributes['DW_AT_data_member_location'].value
-    #         # if die_offset != ctypes_field.offset:
-    #         print(f'field: {member_name}:')
-    #         print(f'             DIE offset: {die_offset},\tfield offset: {ctypes_field.offset}')
-    #         die_size = _get_type_size(member_type)
-    #         # if die_size != ctypes_field.size:
-    #         print(f'             DIE size:   {die_size},\tfield size: {ctypes_field.size}')
-    #
-    #     import pdb; pdb.set_trace()
-    #
-
-    _validate(struct_die, struct)
-    print(f'{stack_len}> returning {struct_name}')
-
-    if resolve_declaration:
-        _declarations_to_be_resolved.pop(struct_name)
-
-    _dump(struct_die, struct_name=struct_name)
-    _dump_ctype_struct(struct)
-
-    return struct
-
-
-def _validate(struct_die, struct):
-    struct_size = struct_die.attributes['DW_AT_byte_size'].value
-    return # XXX
-    assert ctypes.sizeof(struct) == struct_size
-    # print(struct_die)
-    for member_die in struct_die.iter_children():
-        # print(member_die)
-        if 'DW_AT_name' in member_die.attributes:
-            member_name = member_die.attributes['DW_AT_name'].value.decode('ascii')
-        else:
-            member_name = None
-        member_type = _resolve_type(member_die.get_DIE_from_attribute('DW_AT_type'))
-        ctypes_field = getattr(struct, member_name)
-        die_offset = member_die.attributes['DW_AT_data_member_location'].value
-        if die_offset != ctypes_field.offset:
-            print(f'field: {member_name}:')
-            print(f'             DIE offset: {die_offset},\tfield offset: {ctypes_field.offset}')
-            import pdb; pdb.set_trace()
-        die_size = _get_type_size(member_type)
-        if die_size != ctypes_field.size:
-            print(f'             DIE size:   {die_size},\tfield size: {ctypes_field.size}')
-            import pdb; pdb.set_trace()
-
-
-_anon_name_counter = 0
-_anon_name_counter_lock = threading.Lock()
-
-
-def _get_anon_name(what=''):
-    global _anon_name_counter
-    with _anon_name_counter_lock:
-        _anon_name_counter += 1
-        return f'anon_{what}{_anon_name_counter}'
-
-
 @dataclass
 class MemberInfo:
     name: str
@@ -548,31 +2496,6 @@ class MemberInfo:
     bit_size: int = None
 
 
-def _get_member_info(member_die):
-    assert member_die.tag == 'DW_TAG_member'
-    type_die = _resolve_type(member_die.get_DIE_from_attribute('DW_AT_type'))
-    size = _get_type_size(type_die)
-    if 'DW_AT_data_member_location' in member_die.attributes:
-        offset = member_die.attributes['DW_AT_data_member_location'].value
-    else:
-        offset = None
-
-    if 'DW_AT_name' not in member_die.attributes:
-        name = None
-        ctypes_type = _convert_type_die_to_ctypes(type_die)
-    else:
-        name = member_die.attributes['DW_AT_name'].value.decode('utf-8')
-        ctypes_type = _convert_type_die_to_ctypes(type_die)
-
-    if 'DW_AT_bit_size' in member_die.attributes:
-        bit_size = member_die.attributes['DW_AT_bit_size'].value
-    else:
-        bit_size = None
-
-    return MemberInfo(name=name, ctypes_type=ctypes_type, die=member_die,
-                      size=size, offset=offset, bit_size=bit_size)
-
-
 def _get_type_size(type_die):
     type_die = _resolve_type(type_die)
     if 'DW_AT_byte_size' in type_die.attributes:
@@ -582,17 +2505,388 @@ def _get_type_size(type_die):
         item_size = _get_type_size(type_die.get_DIE_from_attribute('DW_AT_type'))
         if 'DW_AT_upper_bound' not in subrange_die.attributes:
             # XXX: That should be only the last item in struct.
-            # import pdb; pdb.set_trace()
             return 0
         return item_size * subrange_die.attributes['DW_AT_upper_bound'].value
     elif 'DW_AT_type' in type_die.attributes:
-        import pdb; pdb.set_trace()
         types_type_die = type_die.get_DIE_from_attribute('DW_AT_type')
         return types_type_die.attributes['DW_AT_byte_size'].value
     else:
-        import pdb; pdb.set_trace()
         raise NotImplementedError(f"Can't find size of {type_die}.")
 
 
+# Version of the format produced by `dump_layouts`.
+LAYOUT_VERSION = 1
+
+
+def dump_layouts(types, fingerprints=None):
+    """Describe ctypes types, and every type they reference, as plain data.
+
+    `types` maps names to ctypes types, as returned by `get_type`.  The result
+    only holds dicts, lists, strings and ints, so it can be saved as JSON and
+    turned back into ctypes types by `load_layouts` in a process that never
+    opens the binary.  Types are described as:
+
+      ['simple', 'c_int']                 a fundamental ctypes type
+      ['pointer', <type>]
+      ['array', <type>, length]
+      ['aggregate', key]                  a struct or union in 'aggregates'
+
+    Complete aggregates list the 'offsets' of their fields too.
+
+    Aggregates found in `fingerprints`, a dict mapping classes to strings,
+    have a 'fingerprint' too.  See `TypeLibrary.update_layouts`.
+    """
+    aggregates = {}
+    keys = {}
+
+    def describe(ctypes_type):
+        if isinstance(ctypes_type, type(ctypes.Structure)):
+            return ['aggregate', aggregate_key(ctypes_type, 'struct')]
+        if isinstance(ctypes_type, type(ctypes.Union)):
+            return ['aggregate', aggregate_key(ctypes_type, 'union')]
+        if isinstance(ctypes_type, type(ctypes.Array)):
+            return ['array', describe(ctypes_type._type_), ctypes_type._length_]
+        if isinstance(ctypes_type, type(ctypes.POINTER(ctypes.c_int))):
+            return ['pointer', describe(ctypes_type._type_)]
+        if getattr(ctypes, ctypes_type.__name__, None) is not ctypes_type:
+            raise NotImplementedError(f"Can't describe {ctypes_type}")
+        return ['simple', ctypes_type.__name__]
+
+    def aggregate_key(ctypes_type, kind):
+        if ctypes_type in keys:
+            return keys[ctypes_type]
+        key = ctypes_type.__name__
+        suffix = 1
+        while key in aggregates:
+            suffix += 1
+            key = f'{ctypes_type.__name__}#{suffix}'
+        keys[ctypes_type] = key
+        aggregate = aggregates[key] = {'kind': kind, 'name': ctypes_type.__name__}
+        if fingerprints is not None and ctypes_type in fingerprints:
+            aggregate['fingerprint'] = fingerprints[ctypes_type]
+        if '_fields_' not in ctypes_type.__dict__:
+            # An incomplete type, e.g. a pointer target that was never defined.
+            aggregate['fields'] = None
+            return key
+        aggregate['size'] = ctypes.sizeof(ctypes_type)
+        aggregate['pack'] = ctypes_type.__dict__.get('_pack_')
+        aggregate['anonymous'] = list(ctypes_type.__dict__.get('_anonymous_', ()))
+        aggregate['fields'] = [
+            [field[0], describe(field[1])] + list(field[2:])
+            for field in ctypes_type._fields_
+        ]
+        aggregate['offsets'] = [getattr(ctypes_type, field[0]).offset
+                                for field in ctypes_type._fields_]
+        return key
+
+    roots = {}
+    for name, ctypes_type in types.items():
+        if isinstance(name, bytes):
+            name = name.decode('utf-8')
+        roots[name] = describe(ctypes_type)
+    return {'version': LAYOUT_VERSION, 'roots': roots, 'aggregates': aggregates}
+
+
+def load_layouts(layouts):
+    """Rebuild the ctypes types described by `dump_layouts`.
+
+    Returns a dict mapping root names to ctypes types.  Structs and unions are
+    created first and get their `_fields_` afterwards, members held by value
+    before their containers, so self referencing types work.
+    """
+    classes = _load_aggregates(layouts)
+    return {name: _build_described_type(description, classes)
+            for name, description in layouts['roots'].items()}
+
+
+def _load_aggregates(layouts, known=None):
+    """Returns a dict mapping the keys of aggregates of `layouts` to classes.
+
+    `known` maps fingerprints to classes used as is for the aggregates with
+    those fingerprints.
+    """
+    if layouts.get('version') != LAYOUT_VERSION:
+        raise ValueError(f'Unsupported layout version {layouts.get("version")}')
+    aggregates = layouts['aggregates']
+    known = known or {}
+
+    classes = {}
+    for key, aggregate in aggregates.items():
+        if aggregate.get('fingerprint') in known:
+            classes[key] = known[aggregate['fingerprint']]
+            continue
+        base = ctypes.Structure if aggregate['kind'] == 'struct' else ctypes.Union
+        classes[key] = type(aggregate['name'], (base,), {})
+
+    for key in _aggregates_in_fields_order(aggregates):
+        aggregate = aggregates[key]
+        if aggregate.get('fingerprint') in known:
+            continue
+        cls = classes[key]
+        if aggregate['pack'] is not None:
+            cls._pack_ = aggregate['pack']
+        cls._anonymous_ = aggregate['anonymous']
+        cls._fields_ = [
+            (field[0], _build_described_type(field[1], classes)) + tuple(field[2:])
+            for field in aggregate['fields']
+        ]
+        if ctypes.sizeof(cls) != aggregate['size']:
+            raise ValueError(f'Size of {key} is {ctypes.sizeof(cls)}, '
+                             f'expected {aggregate["size"]}')
+        offsets = [getattr(cls, field[0]).offset for field in aggregate['fields']]
+        if offsets != aggregate.get('offsets', offsets):
+            raise ValueError(f"Field offsets of {key} don't match")
+    return classes
+
+
+def _build_described_type(description, classes):
+    kind = description[0]
+    if kind == 'simple':
+        return getattr(ctypes, description[1])
+    if kind == 'pointer':
+        return ctypes.POINTER(_build_described_type(description[1], classes))
+    if kind == 'array':
+        return _build_described_type(description[1], classes) * description[2]
+    if kind == 'aggregate':
+        return classes[description[1]]
+    raise ValueError(f'Unknown type description {description}')
+
+
+def _aggregates_in_fields_order(aggregates):
+    """Keys of complete `aggregates`, in an order `_fields_` can be set in.
+
+    Aggregates held by value come before the aggregates holding them.
+    """
+    refs = {key: set() for key in aggregates}
+    for key, aggregate in aggregates.items():
+        for field in aggregate['fields'] or ():
+            held = _held_aggregate(field[1])
+            if held is not None:
+                refs[key].add(held)
+    return [key for key in reversed(_toposort(refs))
+            if aggregates[key]['fields'] is not None]
+
+
+def _held_aggregate(description):
+    """The aggregate a field of type `description` holds by value, if any."""
+    while description[0] == 'array':
+        description = description[1]
+    if description[0] == 'aggregate':
+        return description[1]
+    return None
+
+
+def _referenced_aggregates(description):
+    """The aggregates a field of type `description` holds or points to."""
+    while description[0] in ('array', 'pointer'):
+        description = description[1]
+    if description[0] == 'aggregate':
+        return (description[1],)
+    return ()
+
+
+def _fingerprints_by_name(layouts):
+    """Map names of fingerprinted aggregates of `layouts` to their fingerprints."""
+    fingerprints = defaultdict(set)
+    for aggregate in layouts['aggregates'].values():
+        if 'fingerprint' in aggregate:
+            fingerprints[aggregate['name']].add(aggregate['fingerprint'])
+    return fingerprints
+
+
+def write_layouts(path, types, fingerprints=None):
+    """Save `dump_layouts(types, fingerprints)` as JSON to `path`."""
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(dump_layouts(types, fingerprints), f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def read_layouts(path):
+    """Load ctypes types saved by `write_layouts`."""
+    with open(path) as f:
+        return load_layouts(json.load(f))
+
+
+# Shared memory layout of a `LayoutDescriptor`: a header, then the pickled
+# layouts.
+_SHARED_DESCRIPTOR_MAGIC = b'D2CTLDS\0'
+_SHARED_DESCRIPTOR_HEADER = struct.Struct('<8sQ')  # magic, pickle size
+
+
+class LayoutDescriptor:
+    """Picklable layouts of ctypes types, for use in other processes.
+
+    ctypes classes can't be pickled.  A descriptor holds the layouts of
+    `dump_layouts` instead: fields, their offsets, sizes, pointer targets and
+    anonymous members of every type.  It's pickled as these layouts, and
+    `materialize()` builds the ctypes types in the receiving process.
+
+    `to_shared_memory()` places the pickled layouts in a
+    `multiprocessing.shared_memory` block, so that one process converts the
+    types and workers attach to it by name with `from_shared_memory()`,
+    rather than each getting a copy through a pipe.
+    """
+
+    def __init__(self, layouts):
+        self.layouts = layouts
+        self._types = None
+
+    @classmethod
+    def from_types(cls, types, fingerprints=None):
+        """Describe `types`, a dict mapping names to ctypes types."""
+        return cls(dump_layouts(types, fingerprints))
+
+    def __reduce__(self):
+        return type(self), (self.layouts,)
+
+    def materialize(self):
+        """Return a dict mapping root names to ctypes types.
+
+        The types are built on the first call, and later calls in the same
+        process return the same classes.
+        """
+        if self._types is None:
+            self._types = load_layouts(self.layouts)
+        return self._types
+
+    def to_shared_memory(self, name=None):
+        """Copy the descriptor to a new shared memory block.
+
+        Returns the `SharedMemory`.  The caller owns the block: it must keep
+        it open while workers attach, and `unlink()` it when done.
+        """
+        from multiprocessing import shared_memory
+
+        data = pickle.dumps(self.layouts, protocol=pickle.HIGHEST_PROTOCOL)
+        block = shared_memory.SharedMemory(
+            name=name, create=True, size=_SHARED_DESCRIPTOR_HEADER.size + len(data))
+        _SHARED_DESCRIPTOR_HEADER.pack_into(block.buf, 0, _SHARED_DESCRIPTOR_MAGIC,
+                                            len(data))
+        block.buf[_SHARED_DESCRIPTOR_HEADER.size:
+                  _SHARED_DESCRIPTOR_HEADER.size + len(data)] = data
+        return block
+
+    @classmethod
+    def from_shared_memory(cls, name):
+        """Load a descriptor from the shared memory block named `name`.
+
+        The layouts are unpickled straight from the block, which is closed,
+        but not unlinked, afterwards.
+        """
+        from multiprocessing import shared_memory
+
+        block = shared_memory.SharedMemory(name=name)
+        try:
+            magic, size = _SHARED_DESCRIPTOR_HEADER.unpack_from(block.buf)
+            if magic != _SHARED_DESCRIPTOR_MAGIC:
+                raise ValueError(f'{name} is not a layout descriptor')
+            with block.buf[_SHARED_DESCRIPTOR_HEADER.size:
+                           _SHARED_DESCRIPTOR_HEADER.size + size] as data:
+                return cls(pickle.loads(data))
+        finally:
+            block.close()
+
+
+def generate_module(binary_path, type_names, output_path,
+                    relocate_dwarf_sections=True):
+    """Write a Python module defining `type_names` from `binary_path`.
+
+    The module defines every struct and union reachable from `type_names` as
+    plain ctypes classes, along with the typedefs naming them, and imports
+    nothing but `ctypes`.  Classes are declared first and get their `_fields_`
+    afterwards, so self referencing types work.  The module is byte-compiled
+    next to `output_path`.
+    """
+    library = TypeLibrary(binary_path,
+                          relocate_dwarf_sections=relocate_dwarf_sections)
+    types = library.get_types(type_names)
+    nodes, _ = library._traverse_type_graph(
+        [library.find_type_die(type_name) for type_name in type_names])
+    # The types the typedefs name were converted by `get_types` already.
+    typedefs = {
+        die.attributes['DW_AT_name'].value: library._convert_type_die_to_ctypes(die)
+        for die in nodes.values()
+        if die.tag == 'DW_TAG_typedef' and 'DW_AT_type' in die.attributes
+    }
+
+    # Typedefs go first, so a root that is a typedef keeps its own entry.
+    layouts = dump_layouts({**typedefs, **types})
+    source = _layouts_to_source(
+        layouts, header=f'Generated by dwarf2ctypes from {binary_path}.')
+    tmp_path = f'{output_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(source)
+    os.replace(tmp_path, output_path)
+    py_compile.compile(output_path, doraise=True)
+
+
+def _layouts_to_source(layouts, header=''):
+    """Python source defining the types described by `dump_layouts`.
+
+    Roots become module level aliases, unless the name is already taken by a
+    class or isn't a valid identifier.
+    """
+    aggregates = layouts['aggregates']
+
+    used = {'ctypes'}
+    identifiers = {}
+    for key in aggregates:
+        identifier = _python_identifier(aggregates[key]['name'])
+        while identifier in used:
+            identifier += '_'
+        used.add(identifier)
+        identifiers[key] = identifier
+
+    def expression(description):
+        kind = description[0]
+        if kind == 'simple':
+            return f'ctypes.{description[1]}'
+        if kind == 'pointer':
+            return f'ctypes.POINTER({expression(description[1])})'
+        if kind == 'array':
+            return f'{expression(description[1])} * {description[2]}'
+        return identifiers[description[1]]
+
+    lines = ['# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4',
+             f'# {header}' if header else '# Generated by dwarf2ctypes.',
+             'import ctypes', '']
+    for key, aggregate in aggregates.items():
+        base = 'Structure' if aggregate['kind'] == 'struct' else 'Union'
+        lines += ['', f'class {identifiers[key]}(ctypes.{base}):', '    pass', '']
+
+    for key in _aggregates_in_fields_order(aggregates):
+        aggregate = aggregates[key]
+        identifier = identifiers[key]
+        lines.append('')
+        if aggregate['pack'] is not None:
+            lines.append(f'{identifier}._pack_ = {aggregate["pack"]!r}')
+        lines.append(f'{identifier}._anonymous_ = {aggregate["anonymous"]!r}')
+        lines.append(f'{identifier}._fields_ = [')
+        for field in aggregate['fields']:
+            extra = ''.join(f', {value!r}' for value in field[2:])
+            lines.append(f'    ({field[0]!r}, {expression(field[1])}{extra}),')
+        lines.append(']')
+
+    aliases = []
+    for name, description in layouts['roots'].items():
+        value = expression(description)
+        if name in used or not name.isidentifier() or keyword.iskeyword(name):
+            continue
+        used.add(name)
+        aliases.append(f'{name} = {value}')
+    if aliases:
+        lines += [''] + aliases
+
+    return '\n'.join(lines) + '\n'
+
+
+def _python_identifier(name):
+    identifier = ''.join(c if c.isalnum() or c == '_' else '_' for c in name)
+    if not identifier or identifier[0].isdigit() or keyword.iskeyword(identifier):
+        identifier = identifier + '_' if identifier[:1].isalpha() else '_' + identifier
+    return identifier
+
+
 if __name__ == '__main__':
     main()
@@ -1,5 +1,16 @@
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+import concurrent.futures
 import ctypes
+import importlib.util
+import io
+import json
+import os
+import pickle
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
 import unittest
 import unittest.mock
 
@@ -133,6 +144,772 @@ class CircularReferencesTest(DieTypeLoaderMixin, unittest.TestCase):
         pass
 
 
+class TypeIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dwarf_info = dwarf2ctypes._get_dwarf_info('testdata/cross_cu.o')
+        self.index = dwarf2ctypes.TypeIndex(self.dwarf_info)
+
+    def test_definition_and_declaration_are_separate(self):
+        definition = self.index.find_definition('DW_TAG_structure_type', b'node')
+        declaration = self.index.find_declaration('DW_TAG_structure_type', b'node')
+        self.assertNotIn('DW_AT_declaration', definition.attributes)
+        self.assertIn('DW_AT_declaration', declaration.attributes)
+        self.assertGreater(definition.offset, declaration.offset)
+
+    def test_parallel_build(self):
+        index = dwarf2ctypes._build_type_index(self.dwarf_info, 'testdata/cross_cu.o',
+                                               jobs=2)
+        self.assertEqual(index._offsets, self.index._offsets)
+
+    def test_split_cus(self):
+        self.assertEqual(dwarf2ctypes._split_cus(self.dwarf_info, 8), [[0], [109]])
+        self.assertEqual(dwarf2ctypes._split_cus(self.dwarf_info, 1), [[0, 109]])
+
+    def test_cus_not_kept(self):
+        dwarf_info = dwarf2ctypes._get_dwarf_info('testdata/cross_cu.o')
+        index = dwarf2ctypes.TypeIndex(dwarf_info)
+        self.assertEqual(dwarf_info._cu_cache, [])
+        self.assertEqual(dwarf_info._abbrevtable_cache, {})
+        # DIEs are parsed again when looked up.
+        self.assertEqual(
+            index.find_definition('DW_TAG_structure_type', b'node').offset, 139)
+
+    def test_missing(self):
+        self.assertIsNone(self.index.find(b'no_such_type'))
+        self.assertIsNone(self.index.find_definition('DW_TAG_union_type', b'node'))
+        with self.assertRaises(ValueError):
+            dwarf2ctypes.TypeLibrary(dwarf_info=self.dwarf_info).find_type_die(
+                b'no_such_type')
+
+    def test_resolve_declaration_across_cus(self):
+        declaration = self.index.find_declaration('DW_TAG_structure_type', b'node')
+        library = dwarf2ctypes.TypeLibrary(dwarf_info=self.dwarf_info)
+        definition = library._resolve_declaration(declaration)
+        self.assertEqual(definition.offset,
+                         self.index.find_definition('DW_TAG_structure_type', b'node').offset)
+
+    def test_get_type(self):
+        list_ = dwarf2ctypes.get_type('testdata/cross_cu.o', b'list')
+        self.assertEqual(ctypes.sizeof(dict(list_._fields_)['head']._type_), 16)
+
+
+class AcceleratorTablesTest(unittest.TestCase):
+
+    def _check_library(self, binary_path):
+        library = dwarf2ctypes.TypeLibrary(binary_path)
+        self.assertIsInstance(library.index, dwarf2ctypes.AcceleratedTypeIndex)
+        list_ = library.get_type(b'list')
+        self.assertEqual(ctypes.sizeof(dict(list_._fields_)['head']._type_), 16)
+        # Everything was found through the table.
+        self.assertIsNone(library.index._fallback)
+
+        # Declarations aren't in accelerator tables.
+        declaration = library.index.find_declaration('DW_TAG_structure_type', b'node')
+        self.assertIn('DW_AT_declaration', declaration.attributes)
+        self.assertIsNotNone(library.index._fallback)
+
+    def test_gdb_index(self):
+        self._check_library('testdata/cross_cu_gdb_index.elf')
+
+    def test_pubtypes(self):
+        self._check_library('testdata/cross_cu_pubtypes.o')
+
+    def test_disabled(self):
+        library = dwarf2ctypes.TypeLibrary('testdata/cross_cu_gdb_index.elf',
+                                           use_accelerator_tables=False)
+        self.assertIsInstance(library.index, dwarf2ctypes.TypeIndex)
+
+    def test_debug_names(self):
+        dwarf_info = dwarf2ctypes._get_dwarf_info('testdata/cross_cu.o')
+        index = dwarf2ctypes.TypeIndex(dwarf_info)
+        names = []
+        for cu_index, name in ((0, b'list'), (1, b'node')):
+            die = index.find_definition('DW_TAG_structure_type', name)
+            names.append((dwarf2ctypes._debug_names_hash(name), name, cu_index, die))
+        names.sort()
+
+        abbrevs = bytes([1, 0x13, 1, 0x0b, 3, 0x13, 0, 0, 0])
+        entries = b''
+        entry_offsets = []
+        for _, _, cu_index, die in names:
+            entry_offsets.append(len(entries))
+            entries += struct.pack('<BBI', 1, cu_index, die.offset - die.cu.cu_offset) + b'\0'
+        body = struct.pack('<HHIIIIIII', 5, 0, 2, 0, 0, 1, 2, len(abbrevs), 0)
+        body += struct.pack('<II', 0, 109)
+        body += struct.pack('<I', 1)
+        body += struct.pack('<2I', *(hash_ for hash_, _, _, _ in names))
+        body += struct.pack('<2I', *(die.attributes['DW_AT_name'].raw_value
+                                     for _, _, _, die in names))
+        body += struct.pack('<2I', *entry_offsets)
+        body += abbrevs + entries
+        data = struct.pack('<I', len(body)) + body
+
+        table = dwarf2ctypes._DebugNamesTable(data, dwarf_info)
+        self.assertEqual(table.find_cus(b'list'), [0])
+        self.assertEqual(table.find_cus(b'node'), [109])
+        self.assertEqual(table.find_cus(b'no_such_type'), [])
+
+
+class MappedSectionsTest(unittest.TestCase):
+
+    def test_sections_are_mapped(self):
+        dwarf_info = dwarf2ctypes._get_dwarf_info('testdata/cross_cu_gdb_index.elf')
+        self.assertIsInstance(dwarf_info.debug_info_sec.stream,
+                              dwarf2ctypes._MappedSectionStream)
+
+    def test_relocated_sections_are_copied(self):
+        dwarf_info = dwarf2ctypes._get_dwarf_info('testdata/cross_cu.o')
+        self.assertIsInstance(dwarf_info.debug_info_sec.stream, io.BytesIO)
+
+    def test_same_layouts(self):
+        layouts = []
+        for mmap_sections in (False, True):
+            library = dwarf2ctypes.TypeLibrary('testdata/cross_cu_gdb_index.elf',
+                                               mmap_sections=mmap_sections)
+            layouts.append(dwarf2ctypes.dump_layouts(
+                library.get_types([b'list', b'node'])))
+        self.assertEqual(layouts[0], layouts[1])
+
+    def test_stream(self):
+        data = b'0123456789'
+        stream = dwarf2ctypes._MappedSectionStream(data, 2, 6)
+        self.assertEqual(stream.read(2), b'23')
+        self.assertEqual(stream.tell(), 2)
+        self.assertEqual(stream.read(), b'4567')
+        self.assertEqual(stream.read(1), b'')
+        self.assertEqual(stream.seek(-1, os.SEEK_END), 5)
+        self.assertEqual(stream.read(5), b'7')
+        stream.seek(-3, os.SEEK_CUR)
+        self.assertEqual(stream.read(1), b'5')
+        self.assertEqual(bytes(stream.getbuffer()), b'234567')
+
+
+class DIEDecoderTest(unittest.TestCase):
+
+    def assert_same_dies(self, path, mmap_sections):
+        dwarf_info = dwarf2ctypes._get_dwarf_info(path, mmap_sections=mmap_sections)
+        decoder = dwarf2ctypes._DIEDecoder(dwarf_info)
+        for compilation_unit in dwarf_info.iter_CUs():
+            for die in compilation_unit.iter_DIEs():
+                if die.is_null():
+                    continue
+                view = decoder.die_at(die.offset)
+                self.assertIsInstance(view, dwarf2ctypes._DIEView)
+                self.assertEqual(view.tag, die.tag)
+                self.assertEqual(
+                    {name: attribute.value for name, attribute in view.attributes.items()},
+                    {name: attribute.value for name, attribute in die.attributes.items()
+                     if name in dwarf2ctypes._DECODED_ATTRIBUTES.values()})
+                if 'DW_AT_type' in die.attributes:
+                    self.assertEqual(view.get_DIE_from_attribute('DW_AT_type').offset,
+                                     die.get_DIE_from_attribute('DW_AT_type').offset)
+                self.assertEqual([child.offset for child in view.iter_children()],
+                                 [child.offset for child in die.iter_children()])
+
+    def test_same_dies_as_pyelftools(self):
+        for path in ('testdata/base_types.o', 'testdata/bitfields.o',
+                     'testdata/unions.o', 'testdata/duplicates.o',
+                     'testdata/cross_cu_gdb_index.elf'):
+            for mmap_sections in (False, True):
+                with self.subTest(path=path, mmap_sections=mmap_sections):
+                    self.assert_same_dies(path, mmap_sections)
+
+    def test_attribute_codes(self):
+        from elftools.dwarf.enums import ENUM_DW_AT
+
+        for code, name in dwarf2ctypes._DECODED_ATTRIBUTES.items():
+            self.assertEqual(ENUM_DW_AT[name], code)
+
+    def test_same_layouts(self):
+        layouts = []
+        for fast_die_decoder in (False, True):
+            library = dwarf2ctypes.TypeLibrary('testdata/cross_cu.o',
+                                               fast_die_decoder=fast_die_decoder)
+            layouts.append(library.dump_layouts(library.get_types([b'list', b'node'])))
+        self.assertEqual(layouts[0], layouts[1])
+
+    def test_unknown_forms_parsed_by_pyelftools(self):
+        dwarf_info = dwarf2ctypes._get_dwarf_info('testdata/unions.o')
+        top_die = next(dwarf_info.iter_CUs()).get_top_DIE()
+        with unittest.mock.patch.object(dwarf2ctypes, '_compile_abbrev_steps',
+                                        side_effect=NotImplementedError):
+            decoder = dwarf2ctypes._DIEDecoder(dwarf_info)
+            die = decoder.die_at(top_die.offset)
+        self.assertNotIsInstance(die, dwarf2ctypes._DIEView)
+        self.assertEqual(die.offset, top_die.offset)
+
+    def test_skipped_forms(self):
+        # DW_AT_name as DW_FORM_strx1, then DW_AT_low_pc as DW_FORM_addrx and
+        # DW_AT_byte_size as DW_FORM_data16.
+        specs = [(0x03, 0x25, None), (0x11, 0x1b, None), (0x0b, 0x1e, None)]
+        steps = dwarf2ctypes._compile_abbrev_steps(
+            specs, dwarf2ctypes._SIBLING_ATTRIBUTE, 4, 8, 5, '<')
+        self.assertEqual(steps, [(dwarf2ctypes._STEP_SKIP, None, 1),
+                                 (dwarf2ctypes._STEP_SKIP_ULEB128, None, None),
+                                 (dwarf2ctypes._STEP_SKIP, None, 16)])
+        with self.assertRaises(NotImplementedError):
+            dwarf2ctypes._compile_abbrev_steps(
+                specs, dwarf2ctypes._DECODED_ATTRIBUTES, 4, 8, 5, '<')
+
+
+class DeduplicationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.library = dwarf2ctypes.TypeLibrary('testdata/duplicates.o')
+
+    def test_identical_types_merged(self):
+        types = self.library.get_types([b'holder_a', b'holder_b'])
+        fields_a = dict(types[b'holder_a']._fields_)
+        fields_b = dict(types[b'holder_b']._fields_)
+        self.assertIs(fields_a['pair'], fields_b['pair'])
+        self.assertIs(fields_a['value'], fields_b['value'])
+        self.assertIsNot(fields_b['value'], fields_b['other'])
+        self.assertGreater(self.library.stats.duplicates_merged, 0)
+
+    def test_merged_behind_declarations(self):
+        # `struct holder` is only reached through a declaration, and holds
+        # the same `struct pair` as the root.
+        header = 'struct pair { int first; int second; };\n'
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        binary_path = _link_sources(work_dir, {
+            'root.c': header + ('struct holder;\n'
+                                'struct root { struct pair pair; struct holder *holder; }'
+                                ' root_var;\n'),
+            'holder.c': header + 'struct holder { struct pair pair; } holder_var;\n',
+        })
+        library = dwarf2ctypes.TypeLibrary(binary_path)
+        root = library.get_type(b'root')
+        holder = dict(root._fields_)['holder']._type_
+        self.assertIs(dict(holder._fields_)['pair'], dict(root._fields_)['pair'])
+        self.assertEqual(library.stats.duplicates_merged, 1)
+
+    def test_signatures(self):
+        index = self.library.index
+        holder_a = index.find(b'holder_a')
+        holder_b = index.find(b'holder_b')
+        self.assertNotEqual(holder_a.cu.cu_offset, holder_b.cu.cu_offset)
+        pair_a, value_a, _ = (self.library._signature(member.get_DIE_from_attribute('DW_AT_type'))
+                              for member in holder_a.iter_children())
+        pair_b, value_b, other_b = (self.library._signature(member.get_DIE_from_attribute('DW_AT_type'))
+                                    for member in holder_b.iter_children())
+        self.assertEqual(pair_a, pair_b)
+        self.assertEqual(value_a, value_b)
+        self.assertNotEqual(value_b, other_b)
+
+    def test_recursive_type(self):
+        holder_a = self.library.get_type(b'holder_a')
+        self.assertIs(dict(holder_a._fields_)['next']._type_, holder_a)
+
+
+class InterningTest(unittest.TestCase):
+
+    def setUp(self):
+        self.library = dwarf2ctypes.TypeLibrary('testdata/interning.o')
+        self.struct = self.library.get_type(b'interning')
+        self.field_types = dict(self.struct._fields_)
+
+    def test_anonymous_aggregates_shared(self):
+        # The members of the aggregates have different typedefs of int.
+        self.assertIs(self.field_types['f_first'], self.field_types['f_second'])
+        self.assertIs(self.field_types['f_third'], self.field_types['f_fourth'])
+        self.assertEqual(self.library.stats.interned['union'], 1)
+        self.assertEqual(self.library.stats.interned['struct'], 1)
+
+    def test_arrays_pointers_and_padding_shared(self):
+        self.assertIs(self.field_types['__padding_1'], self.field_types['__padding_2'])
+        self.assertIs(self.field_types['f_pointer'], self.field_types['f_other_pointer'])
+        self.assertGreaterEqual(self.library.stats.interned['padding'], 1)
+        self.assertEqual(self.library.stats.interned['pointer'], 1)
+        self.assertEqual(self.library.stats.interned['array'], 1)
+
+    def test_fields(self):
+        value = self.struct()
+        value.f_first.f_int = 1
+        value.f_second.f_int = 2
+        value.f_fourth.f_short = 3
+        self.assertEqual((value.f_first.f_int, value.f_second.f_int,
+                          value.f_third.f_short, value.f_fourth.f_short), (1, 2, 0, 3))
+
+
+class LazyTypeLibraryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.library = dwarf2ctypes.TypeLibrary('testdata/cross_cu.o', lazy=True)
+        self.list_ = self.library.get_type(b'list')
+        self.head_type = dict(self.list_._fields_)['head']
+        self.node = self.head_type._type_
+
+    def test_pointer_targets_left_empty(self):
+        self.assertEqual(ctypes.sizeof(self.list_), 16)
+        self.assertNotIn('_fields_', self.node.__dict__)
+        self.assertEqual(self.library.stats.structs_built, 1)
+
+    def test_resolve(self):
+        self.node.resolve()
+        self.assertEqual(ctypes.sizeof(self.node), 16)
+        self.assertIs(dict(self.node._fields_)['next']._type_, self.node)
+        self.assertIs(self.library.get_type(b'node'), self.node)
+
+    def test_resolved(self):
+        self.assertIs(dwarf2ctypes.resolved(self.node), self.node)
+        self.assertEqual(ctypes.sizeof(self.node), 16)
+        self.assertIs(dwarf2ctypes.resolved(self.head_type), self.head_type)
+        self.assertIs(dwarf2ctypes.resolved(ctypes.c_int), ctypes.c_int)
+
+    def test_field_lookup(self):
+        self.assertEqual(self.node.value.offset, 8)
+
+    def test_from_buffer_copy(self):
+        with self.assertRaises(ValueError):
+            self.node.from_buffer_copy(b'')
+        node = self.node.from_buffer_copy(struct.pack('<qq', 0, 42))
+        self.assertEqual(node.value, 42)
+
+    def test_dereference(self):
+        buffer = (ctypes.c_long * 2)(0, 42)
+        head = ctypes.cast(buffer, self.head_type)
+        self.assertEqual(head.contents.value, 42)
+        self.assertEqual(head[0].value, 42)
+
+    def test_no_cache_dir(self):
+        with self.assertRaises(ValueError):
+            dwarf2ctypes.TypeLibrary('testdata/cross_cu.o', lazy=True,
+                                     cache_dir=tempfile.gettempdir())
+
+
+class ConversionLimitsTest(unittest.TestCase):
+
+    def test_max_pointer_depth(self):
+        list_ = dwarf2ctypes.get_type('testdata/cross_cu.o', b'list',
+                                      max_pointer_depth=0)
+        self.assertIs(dict(list_._fields_)['head'], ctypes.c_void_p)
+        self.assertEqual(ctypes.sizeof(list_), 16)
+
+        list_ = dwarf2ctypes.get_type('testdata/cross_cu.o', b'list',
+                                      max_pointer_depth=1)
+        node = dict(list_._fields_)['head']._type_
+        self.assertIs(dict(node._fields_)['next']._type_, node)
+
+    def test_max_structs(self):
+        events = []
+        library = dwarf2ctypes.TypeLibrary(
+            'testdata/duplicates.o', max_structs=1,
+            trace=lambda event, **details: events.append((event, details)))
+        holder = library.get_type(b'holder_a')
+        self.assertEqual(ctypes.sizeof(holder), 24)
+        fields = dict(holder._fields_)
+        self.assertEqual([name for name, *_ in fields['pair']._fields_], ['_opaque'])
+        self.assertEqual(ctypes.sizeof(fields['pair']), 8)
+        # Anonymous unions belong to their container, and holder_a was converted.
+        self.assertIn('i', dict(fields['value']._fields_))
+        self.assertIs(fields['next']._type_, holder)
+
+        self.assertEqual(library.stats.pruned, [
+            dwarf2ctypes.PrunedType(name='pair', tag='DW_TAG_structure_type',
+                                    depth=0, reason='max_structs')])
+        self.assertIn(('pruned', {'name': 'pair', 'depth': 0, 'reason': 'max_structs'}),
+                      events)
+
+    def test_declarations_resolved_once(self):
+        library = dwarf2ctypes.TypeLibrary('testdata/cross_cu_chain.o', max_pointer_depth=5)
+        library.get_type(b'a')
+        self.assertEqual(library.stats.declarations_resolved, 2)
+
+    def test_converted_types_reused(self):
+        library = dwarf2ctypes.TypeLibrary('testdata/cross_cu.o', max_structs=1)
+        node = library.get_type(b'node')
+        list_ = library.get_type(b'list')
+        self.assertIs(dict(list_._fields_)['head']._type_, node)
+        self.assertEqual(library.stats.pruned, [])
+
+    def test_invalid_limits(self):
+        with self.assertRaises(ValueError):
+            dwarf2ctypes.TypeLibrary('testdata/cross_cu.o', max_structs=0)
+        with self.assertRaises(ValueError):
+            dwarf2ctypes.TypeLibrary('testdata/cross_cu.o', max_pointer_depth=-1)
+
+
+class UpdateLayoutsTest(unittest.TestCase):
+
+    def setUp(self):
+        library = dwarf2ctypes.TypeLibrary('testdata/incremental_v1.o')
+        self.previous = library.dump_layouts({b'root': library.get_type(b'root')})
+
+    def test_fingerprints(self):
+        for aggregate in self.previous['aggregates'].values():
+            self.assertEqual(len(aggregate['fingerprint']), 32)
+
+    def test_unchanged_binary(self):
+        library = dwarf2ctypes.TypeLibrary('testdata/incremental_v1.o')
+        update = library.update_layouts(self.previous)
+        self.assertEqual(library.stats.structs_built, 0)
+        self.assertEqual(library.stats.structs_reused, 4)
+        self.assertEqual(update.layouts, self.previous)
+        self.assertEqual((update.changed, update.added, update.removed), ([], [], []))
+
+    def test_rebuilt_binary(self):
+        library = dwarf2ctypes.TypeLibrary('testdata/incremental_v2.o')
+        update = library.update_layouts(self.previous)
+        self.assertEqual(update.changed, ['changed', 'root'])
+        self.assertEqual(update.added, ['added'])
+        self.assertEqual(update.removed, [])
+        # Only `unchanged` is reused: `points_to_changed` points to a changed
+        # struct, so it's converted again.
+        self.assertEqual(library.stats.structs_reused, 1)
+        self.assertEqual(library.stats.structs_built, 4)
+
+        root = update.types[b'root']
+        points_to_changed = dict(root._fields_)['points_to_changed']._type_
+        changed = dict(points_to_changed._fields_)['changed']._type_
+        self.assertEqual(ctypes.sizeof(changed), 16)
+        full = dwarf2ctypes.TypeLibrary('testdata/incremental_v2.o')
+        self.assertEqual(update.layouts,
+                         full.dump_layouts({b'root': full.get_type(b'root')}))
+
+
+class CachedTypeIndexTest(unittest.TestCase):
+
+    BINARY_PATH = 'testdata/cross_cu.o'
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def _load(self, **kwargs):
+        dwarf_info = dwarf2ctypes._get_dwarf_info(self.BINARY_PATH)
+        return dwarf2ctypes._load_cached_type_index(
+            dwarf_info, self.BINARY_PATH, self.cache_dir, **kwargs)
+
+    def test_matches_type_index(self):
+        self._load()
+        (index_file,) = os.listdir(self.cache_dir)
+        mapped_index = self._load()
+        self.assertIsInstance(mapped_index, dwarf2ctypes.MappedTypeIndex)
+        self.assertEqual(os.listdir(self.cache_dir), [index_file])
+
+        index = dwarf2ctypes.TypeIndex(
+            dwarf2ctypes._get_dwarf_info(self.BINARY_PATH))
+        for name in (b'list', b'node', b'int', b'cross_cu_b.c'):
+            self.assertEqual(mapped_index.find(name).offset, index.find(name).offset)
+        self.assertEqual(
+            mapped_index.find_definition('DW_TAG_structure_type', b'node').offset,
+            index.find_definition('DW_TAG_structure_type', b'node').offset)
+        self.assertEqual(
+            mapped_index.find_declaration('DW_TAG_structure_type', b'node').offset,
+            index.find_declaration('DW_TAG_structure_type', b'node').offset)
+        self.assertIsNone(mapped_index.find(b'no_such_type'))
+
+    def test_get_type(self):
+        for _ in range(2):
+            list_ = dwarf2ctypes.get_type(self.BINARY_PATH, b'list',
+                                          cache_dir=self.cache_dir)
+            self.assertEqual(ctypes.sizeof(list_), 16)
+
+    def test_corrupt_index_is_rebuilt(self):
+        self._load()
+        (index_file,) = os.listdir(self.cache_dir)
+        with open(os.path.join(self.cache_dir, index_file), 'wb') as f:
+            f.write(b'garbage')
+        self.assertIsNotNone(self._load().find(b'list'))
+
+    def test_eviction(self):
+        stale_path = os.path.join(self.cache_dir, 'stale.typeidx')
+        with open(stale_path, 'wb') as f:
+            f.write(b'x' * 100)
+        os.utime(stale_path, (0, 0))
+        self._load(cache_max_bytes=1)
+        self.assertFalse(os.path.exists(stale_path))
+        # The index in use is never evicted.
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+
+class LayoutsTest(unittest.TestCase):
+
+    def _round_trip(self, types):
+        layouts = json.loads(json.dumps(dwarf2ctypes.dump_layouts(types)))
+        return dwarf2ctypes.load_layouts(layouts)
+
+    def assertSameLayout(self, expected, actual):
+        self.assertEqual(ctypes.sizeof(expected), ctypes.sizeof(actual))
+        self.assertEqual([field[0] for field in expected._fields_],
+                         [field[0] for field in actual._fields_])
+        for field in expected._fields_:
+            self.assertEqual(getattr(expected, field[0]).offset,
+                             getattr(actual, field[0]).offset)
+
+    def test_base_types(self):
+        base_types = dwarf2ctypes.get_type('testdata/base_types.o', b'base_types')
+        loaded = self._round_trip({b'base_types': base_types})['base_types']
+        self.assertIsNot(loaded, base_types)
+        self.assertSameLayout(base_types, loaded)
+
+    def test_anonymous_unions(self):
+        struct_ctypes = dwarf2ctypes.get_type('testdata/unions.o',
+                                              b'nested_anon_union_struct')
+        struct = self._round_trip({'s': struct_ctypes})['s']()
+        struct.f_short = 0x1234
+        self.assertEqual(struct.f_char, 0x34)
+
+    def test_self_reference(self):
+        node = dwarf2ctypes.get_type('testdata/cross_cu.o', b'node')
+        loaded = self._round_trip({'node': node})['node']
+        self.assertSameLayout(node, loaded)
+        self.assertIs(dict(loaded._fields_)['next']._type_, loaded)
+
+    def test_loading_does_not_import_pyelftools(self):
+        path = os.path.join(tempfile.mkdtemp(), 'layout.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        dwarf2ctypes.write_layouts(
+            path, {'list': dwarf2ctypes.get_type('testdata/cross_cu.o', b'list')})
+        code = ('import sys, ctypes, dwarf2ctypes; '
+                f'list_ = dwarf2ctypes.read_layouts({path!r})["list"]; '
+                'assert ctypes.sizeof(list_) == 16; '
+                'assert "elftools" not in sys.modules')
+        subprocess.check_call([sys.executable, '-c', code])
+
+    def test_get_type_warm_start(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cold = dwarf2ctypes.get_type('testdata/cross_cu.o', b'list',
+                                     cache_dir=cache_dir)
+        with unittest.mock.patch.object(dwarf2ctypes, '_get_dwarf_info',
+                                        side_effect=AssertionError):
+            warm = dwarf2ctypes.get_type('testdata/cross_cu.o', b'list',
+                                         cache_dir=cache_dir)
+        self.assertSameLayout(cold, warm)
+
+
+def _attach_layout_descriptor(name):
+    node = dwarf2ctypes.LayoutDescriptor.from_shared_memory(name).materialize()['node']
+    return ctypes.sizeof(node), [getattr(node, field[0]).offset for field in node._fields_]
+
+
+class LayoutDescriptorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.library = dwarf2ctypes.TypeLibrary('testdata/cross_cu.o')
+        self.descriptor = self.library.get_descriptor([b'node'])
+        self.node = self.library.get_type(b'node')
+
+    def assert_same_node(self, node):
+        self.assertIsNot(node, self.node)
+        self.assertEqual(ctypes.sizeof(node), ctypes.sizeof(self.node))
+        self.assertEqual([(field[0], getattr(node, field[0]).offset) for field in node._fields_],
+                         [(field[0], getattr(self.node, field[0]).offset)
+                          for field in self.node._fields_])
+
+    def test_pickle(self):
+        descriptor = pickle.loads(pickle.dumps(self.descriptor))
+        self.assert_same_node(descriptor.materialize()['node'])
+
+    def test_materialize_once(self):
+        types = self.descriptor.materialize()
+        self.assertIs(self.descriptor.materialize()['node'], types['node'])
+
+    def test_offsets_checked(self):
+        self.descriptor.layouts['aggregates']['node']['offsets'][-1] += 1
+        with self.assertRaises(ValueError):
+            self.descriptor.materialize()
+
+    def test_shared_memory(self):
+        block = self.descriptor.to_shared_memory()
+        try:
+            with concurrent.futures.ProcessPoolExecutor(2) as executor:
+                results = list(executor.map(_attach_layout_descriptor, [block.name] * 2))
+        finally:
+            block.close()
+            block.unlink()
+        expected = (ctypes.sizeof(self.node),
+                    [getattr(self.node, field[0]).offset for field in self.node._fields_])
+        self.assertEqual(results, [expected] * 2)
+
+
+def _link_sources(work_dir, sources):
+    """Compile the CUs of `sources`, file names to C code, into one object."""
+    objects = []
+    for name, source in sources.items():
+        source_path = os.path.join(work_dir, name)
+        with open(source_path, 'w') as f:
+            f.write(source)
+        objects.append(source_path[:-2] + '.o')
+        subprocess.check_call(['gcc', '-g', '-c', source_path, '-o', objects[-1]])
+    binary_path = os.path.join(work_dir, 'linked.o')
+    subprocess.check_call(['ld', '-r', *objects, '-o', binary_path])
+    return binary_path
+
+
+class GenerateModuleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+
+    def _generate(self, binary_path, type_names):
+        output_path = os.path.join(self.output_dir, 'generated_types.py')
+        dwarf2ctypes.generate_module(binary_path, type_names, output_path)
+        self.assertTrue(os.path.exists(importlib.util.cache_from_source(output_path)))
+        with open(output_path) as f:
+            self.assertNotIn('dwarf2ctypes', f.read().split('\n', 2)[2])
+        spec = importlib.util.spec_from_file_location('generated_types', output_path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    def test_self_reference(self):
+        module = self._generate('testdata/cross_cu.o', [b'list'])
+        self.assertEqual(ctypes.sizeof(module.list), 16)
+        self.assertIs(dict(module.node._fields_)['next']._type_, module.node)
+
+    def test_anonymous_unions(self):
+        module = self._generate('testdata/unions.o', [b'nested_anon_union_struct'])
+        struct = module.nested_anon_union_struct()
+        struct.f_short = 0x1234
+        self.assertEqual(struct.f_char, 0x34)
+
+    def test_typedefs_behind_declarations(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        sources = {
+            'ta.c': 'struct node;\nstruct list { struct node *head; } list_var;\n',
+            'tb.c': ('typedef int value_t;\n'
+                     'struct node { struct node *next; value_t value; } node_var;\n'),
+        }
+        binary_path = _link_sources(work_dir, sources)
+
+        module = self._generate(binary_path, [b'list'])
+        self.assertIs(dict(module.node._fields_)['value'], ctypes.c_int)
+        self.assertIs(module.value_t, ctypes.c_int)
+
+    def test_typedefs_converted_once(self):
+        with unittest.mock.patch.object(
+                dwarf2ctypes.TypeLibrary, '_convert_roots', autospec=True,
+                side_effect=dwarf2ctypes.TypeLibrary._convert_roots) as convert_roots:
+            module = self._generate('testdata/interning.o', [b'interning'])
+        convert_roots.assert_called_once()
+        self.assertIs(module.count_t, ctypes.c_int)
+        self.assertIs(module.length_t, ctypes.c_int)
+
+
+class TypeLibraryTest(unittest.TestCase):
+
+    def test_declarations_across_several_cus(self):
+        a = dwarf2ctypes.get_type('testdata/cross_cu_chain.o', b'a')
+        b = dict(a._fields_)['b']._type_
+        c = dict(b._fields_)['c']._type_
+        self.assertEqual(ctypes.sizeof(c), 8)
+
+    def test_same_class_within_library(self):
+        library = dwarf2ctypes.TypeLibrary('testdata/cross_cu.o')
+        list_ = library.get_type(b'list')
+        node = library.get_type(b'node')
+        self.assertIs(dict(list_._fields_)['head']._type_, node)
+
+    def test_get_types(self):
+        library = dwarf2ctypes.TypeLibrary('testdata/cross_cu.o')
+        with unittest.mock.patch.object(
+                library, '_traverse_type_graph',
+                wraps=library._traverse_type_graph) as traverse:
+            types = library.get_types([b'list', b'node'])
+        traverse.assert_called_once()
+        self.assertEqual(list(types), [b'list', b'node'])
+        self.assertIs(dict(types[b'list']._fields_)['head']._type_, types[b'node'])
+
+    def test_get_types_cached(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        dwarf2ctypes.get_types('testdata/cross_cu.o', [b'node'], cache_dir=cache_dir)
+        for _ in range(2):
+            # Converted, then loaded from the cache.
+            types = dwarf2ctypes.get_types('testdata/cross_cu.o', [b'list', b'node'],
+                                           cache_dir=cache_dir)
+            self.assertEqual(ctypes.sizeof(types[b'list']), 16)
+            self.assertEqual(ctypes.sizeof(types[b'node']), 16)
+            self.assertIs(dict(types[b'list']._fields_)['head']._type_, types[b'node'])
+
+    def test_cached_types_are_the_library_types(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        dwarf2ctypes.get_types('testdata/cross_cu.o', [b'node'], cache_dir=cache_dir)
+        dwarf2ctypes.get_types('testdata/cross_cu.o', [b'list'], cache_dir=cache_dir)
+
+        library = dwarf2ctypes.TypeLibrary('testdata/cross_cu.o', cache_dir=cache_dir)
+        node = library.get_type(b'node')
+        self.assertEqual(library.stats.layouts_loaded, 1)
+        self.assertIs(library.get_type(b'node'), node)
+        self.assertIs(dict(library.get_type(b'list')._fields_)['head']._type_, node)
+        self.assertEqual(library.stats.layouts_loaded, 1)
+        # Types converted later are the loaded ones too.
+        self.assertIs(library.get_types([b'list', b'node'])[b'node'], node)
+        self.assertEqual(library.stats.structs_built, 0)
+
+    def test_stats_and_trace(self):
+        events = []
+        library = dwarf2ctypes.TypeLibrary(
+            'testdata/cross_cu.o',
+            trace=lambda event, **details: events.append((event, details)))
+        library.get_type(b'list')
+        self.assertEqual(library.stats.structs_built, 2)
+        self.assertEqual(library.stats.declarations_resolved, 1)
+        self.assertGreater(library.stats.dies_visited, 0)
+        self.assertLessEqual({'dwarf_info', 'index', 'traverse', 'toposort', 'convert'},
+                             set(library.stats.phase_seconds))
+        self.assertIn(('struct_built', {'name': 'node', 'size': 16}), events)
+
+        library.get_type(b'node')
+        self.assertEqual(library.stats.structs_built, 0)
+        self.assertGreater(library.stats.cache_hits, 0)
+
+    def test_quiet(self):
+        with unittest.mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            dwarf2ctypes.get_type('testdata/cross_cu.o', b'list')
+        self.assertEqual(stdout.getvalue(), '')
+
+    def test_libraries_are_independent(self):
+        # Both binaries define a `struct node`, with different layouts.
+        other_path = os.path.join(tempfile.mkdtemp(), 'other.o')
+        self.addCleanup(shutil.rmtree, os.path.dirname(other_path))
+        source_path = other_path[:-2] + '.c'
+        with open(source_path, 'w') as f:
+            f.write('struct node { char tag; } node_var;\n')
+        subprocess.check_call(['gcc', '-g', '-c', source_path, '-o', other_path])
+
+        node = dwarf2ctypes.TypeLibrary('testdata/cross_cu.o').get_type(b'node')
+        other_node = dwarf2ctypes.TypeLibrary(other_path).get_type(b'node')
+        self.assertEqual(ctypes.sizeof(node), 16)
+        self.assertEqual(ctypes.sizeof(other_node), 1)
+
+    def test_deep_chain_behind_declaration(self):
+        # The root points to a declaration of the head of a chain of structs
+        # held by value, defined in another CU.
+        depth = 1500
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        sources = {
+            'root.c': 'struct nest0;\nstruct root { struct nest0 *p; } root_var;\n',
+            'nest.c': 'struct nest%d { long value; };\n' % depth + ''.join(
+                'struct nest%d { struct nest%d inner; };\n' % (i, i + 1)
+                for i in reversed(range(depth))) + 'struct nest0 nest_var;\n',
+        }
+        binary_path = _link_sources(work_dir, sources)
+
+        root = dwarf2ctypes.get_type(binary_path, b'root')
+        nest = dict(root._fields_)['p']._type_
+        self.assertEqual(ctypes.sizeof(nest), 8)
+        self.assertEqual(nest.__name__, 'nest0')
+
+    def test_threads(self):
+        libraries = [dwarf2ctypes.TypeLibrary('testdata/cross_cu.o')
+                     for _ in range(4)]
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            types = list(executor.map(lambda library: library.get_type(b'list'),
+                                      libraries))
+        self.assertEqual(len({id(type_) for type_ in types}), 4)
+        for type_ in types:
+            self.assertEqual(ctypes.sizeof(type_), 16)
+
+
 class TopoSortTest(unittest.TestCase):
 
     def test_it(self):
@@ -154,6 +931,11 @@ class TopoSortTest(unittest.TestCase):
         with self.assertRaises(RuntimeError):
             dwarf2ctypes._toposort(refs)
 
+    def test_deep(self):
+        depth = sys.getrecursionlimit() * 10
+        refs = {i: [i + 1] for i in range(depth)}
+        self.assertEqual(dwarf2ctypes._toposort(refs), tuple(range(depth + 1)))
+
 
 if __name__ == '__main__':
     unittest.main()
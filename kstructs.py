@@ -0,0 +1,256 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""Read kernel data structures through a memory source.
+
+Structs are ctypes types, e.g. converted by `dwarf2ctypes`, and memory is
+read through anything with the `read()` and `read_many()` of `memsource`,
+e.g. an `AddressSpace`.
+
+Walkers follow the links of `list_head`, `hlist_head` and `rb_root`
+containers, reading only the link words, and yield the addresses of the
+structs holding the nodes.  The structs, or some of their fields, are then
+read in one batch by `read_structs()` and `read_field()`.
+
+A `FieldReader`, made by `make_reader()`, reads only the bytes of the fields
+it's asked for, e.g. `pid` and `comm` of a `task_struct`, and unpacks them
+with precompiled `struct.Struct`s.
+"""
+from collections import namedtuple
+import ctypes
+import struct
+
+import dwarf2ctypes
+
+_POINTER = struct.Struct('P')
+# Fields this close are read at once, with the bytes between them.
+DEFAULT_MAX_GAP = 64
+_INTEGER_FORMATS = {1: 'b', 2: 'h', 4: 'i', 8: 'q'}
+
+
+def resolve_field(struct_cls, path):
+    """Return the offset and the type of the field at `path` in `struct_cls`.
+
+    `path` is a dotted name, e.g. `'se.run_node'`.  Members of anonymous
+    structs and unions are found by their own names, as in C.
+    """
+    offset = 0
+    field_type = struct_cls
+    for name in path.split('.'):
+        member = _find_member(field_type, name)
+        if member is None:
+            raise AttributeError(f'{field_type.__name__} has no field {name!r}')
+        member_offset, field_type = member
+        offset += member_offset
+    return offset, dwarf2ctypes.resolved(field_type)
+
+
+def _find_member(struct_cls, name):
+    """Return the offset and the type of the member `name` of `struct_cls`,
+    looking into its anonymous members, or None."""
+    anonymous = struct_cls.__dict__.get('_anonymous_', ())
+    for field in _fields(struct_cls):
+        offset = getattr(struct_cls, field[0]).offset
+        if field[0] == name:
+            if len(field) > 2:
+                raise TypeError(f'{struct_cls.__name__}.{name} is a bit field')
+            return offset, field[1]
+        if field[0] in anonymous:
+            member = _find_member(field[1], name)
+            if member is not None:
+                return offset + member[0], member[1]
+    return None
+
+
+def _fields(struct_cls):
+    """Return the fields of `struct_cls`, converting them first for lazy
+    `dwarf2ctypes` structs."""
+    return dwarf2ctypes.resolved(struct_cls).__dict__.get('_fields_', ())
+
+
+def _read_pointer(mem, address):
+    return _POINTER.unpack(mem.read(address, _POINTER.size))[0]
+
+
+def iter_list(mem, head, container, field):
+    """Yield the addresses of the `container` structs linked into the list
+    at address `head` by their `list_head` `field`.
+
+    Only the `next` pointers are read, one per entry.
+    """
+    offset, list_head = resolve_field(container, field)
+    next_offset, _ = resolve_field(list_head, 'next')
+    address = _read_pointer(mem, head + next_offset)
+    while address != head:
+        yield address - offset
+        address = _read_pointer(mem, address + next_offset)
+
+
+def iter_hlist(mem, head, container, field):
+    """Yield the addresses of the `container` structs linked into the hash
+    list at address `head` by their `hlist_node` `field`.
+
+    `head` is a `hlist_head`, whose `first` pointer is its only member.
+    """
+    offset, hlist_node = resolve_field(container, field)
+    next_offset, _ = resolve_field(hlist_node, 'next')
+    address = _read_pointer(mem, head)
+    while address:
+        yield address - offset
+        address = _read_pointer(mem, address + next_offset)
+
+
+def iter_rbtree(mem, root, container, field):
+    """Yield the addresses of the `container` structs in the red-black tree
+    at address `root` by their `rb_node` `field`, in order.
+
+    `root` is a `rb_root`, or a `rb_root_cached`, whose first member is the
+    pointer to the root node.  The left and right pointers of each node are
+    read at once.
+    """
+    offset, rb_node = resolve_field(container, field)
+    left_offset, _ = resolve_field(rb_node, 'rb_left')
+    right_offset, _ = resolve_field(rb_node, 'rb_right')
+    start = min(left_offset, right_offset)
+    length = max(left_offset, right_offset) + _POINTER.size - start
+
+    def children(node):
+        data = mem.read(node + start, length)
+        return (_POINTER.unpack_from(data, left_offset - start)[0],
+                _POINTER.unpack_from(data, right_offset - start)[0])
+
+    stack = []
+    node = _read_pointer(mem, root)
+    while stack or node:
+        while node:
+            left, right = children(node)
+            stack.append((node, right))
+            node = left
+        node, right = stack.pop()
+        yield node - offset
+        node = right
+
+
+def read_structs(mem, struct_cls, addresses):
+    """Return copies of the `struct_cls` at each of `addresses`, read in one
+    batch."""
+    size = ctypes.sizeof(dwarf2ctypes.resolved(struct_cls))
+    return [struct_cls.from_buffer_copy(data)
+            for data in mem.read_many([(address, size) for address in addresses])]
+
+
+def read_field(mem, struct_cls, addresses, path):
+    """Return the field at `path` of the `struct_cls` at each of `addresses`,
+    read in one batch.
+
+    Numbers are returned as ints, other fields as ctypes instances.
+    """
+    offset, field_type = resolve_field(struct_cls, path)
+    size = ctypes.sizeof(field_type)
+    values = [field_type.from_buffer_copy(data)
+              for data in mem.read_many([(address + offset, size)
+                                         for address in addresses])]
+    if issubclass(field_type, ctypes._SimpleCData):
+        return [value.value for value in values]
+    return values
+
+
+class FieldReader:
+    """Reads some fields of structs of a type, and only their bytes.
+
+    Fields are grouped into spans of the struct, merging fields at most
+    `max_gap` bytes apart, and each span is unpacked by a `struct.Struct`.
+    Values are returned as a named tuple, whose names are the paths of the
+    fields with dots replaced by underscores.  Numbers and pointers are
+    ints, arrays of bytes are `bytes`, other arrays are tuples, and other
+    fields, e.g. structs, are ctypes instances.
+    """
+
+    def __init__(self, struct_cls, paths, max_gap=DEFAULT_MAX_GAP):
+        self.struct_cls = struct_cls
+        self.paths = tuple(paths)
+        self.record = namedtuple('Fields',
+                                 [path.replace('.', '_') for path in self.paths],
+                                 rename=True)
+        fields = []
+        for index, path in enumerate(self.paths):
+            offset, field_type = resolve_field(struct_cls, path)
+            fields.append((offset, ctypes.sizeof(field_type), index) +
+                          _field_format(field_type))
+        fields.sort()
+        # [start, end, format] of each span.
+        spans = []
+        getters = [None] * len(fields)
+        value_index = 0
+        for offset, size, index, field_format, count, convert in fields:
+            if spans and spans[-1][1] <= offset <= spans[-1][1] + max_gap:
+                span = spans[-1]
+                if offset > span[1]:
+                    span[2] += f'{offset - span[1]}x'
+            else:
+                span = [offset, offset, '=']
+                spans.append(span)
+            span[1] = offset + size
+            span[2] += field_format
+            getters[index] = (value_index, count, convert)
+            value_index += count
+        self.spans = [(start, struct.Struct(span_format)) for start, _, span_format in spans]
+        self._getters = getters
+
+    def unpack(self, data):
+        """Return the fields from the `data` read for each span."""
+        values = []
+        for (_, span), span_data in zip(self.spans, data):
+            values.extend(span.unpack(span_data))
+        fields = []
+        for index, count, convert in self._getters:
+            if convert is None:
+                fields.append(values[index])
+            else:
+                fields.append(convert(values[index:index + count]))
+        return self.record._make(fields)
+
+    def requests(self, address):
+        """Return the `(address, length)` read for the struct at `address`."""
+        return [(address + start, span.size) for start, span in self.spans]
+
+    def read(self, mem, address):
+        """Return the fields of the struct at `address`."""
+        return self.unpack(mem.read_many(self.requests(address)))
+
+    def read_many(self, mem, addresses):
+        """Return the fields of the struct at each of `addresses`, read in
+        one batch."""
+        requests = []
+        for address in addresses:
+            requests.extend(self.requests(address))
+        data = mem.read_many(requests)
+        spans_nr = len(self.spans)
+        return [self.unpack(data[i:i + spans_nr]) for i in range(0, len(data), spans_nr)]
+
+
+def make_reader(struct_cls, paths, max_gap=DEFAULT_MAX_GAP):
+    """Return a `FieldReader` of the fields at `paths` of `struct_cls`, e.g.
+    `make_reader(task_struct, ['pid', 'comm', 'tasks.next'])`."""
+    return FieldReader(struct_cls, paths, max_gap)
+
+
+def _field_format(field_type):
+    """Return the `struct` format of `field_type`, the number of values it
+    unpacks to, and the function making the field of them, if not the value
+    itself."""
+    if issubclass(field_type, (ctypes._Pointer, ctypes._SimpleCData)):
+        code = getattr(field_type, '_type_', 'P')
+        if issubclass(field_type, ctypes._Pointer) or code == 'P':
+            return _INTEGER_FORMATS[ctypes.sizeof(field_type)].upper(), 1, None
+        if code in 'bBhHiIlLqQ':
+            signed = _INTEGER_FORMATS[ctypes.sizeof(field_type)]
+            return (signed.upper() if code.isupper() else signed), 1, None
+        if code in 'fd?c':
+            return code, 1, None
+    elif issubclass(field_type, ctypes.Array):
+        item_format, _, item_convert = _field_format(field_type._type_)
+        # Only arrays of scalars; others, e.g. of arrays, are ctypes instances.
+        if item_format in ('b', 'B', 'c'):
+            return f'{field_type._length_}s', 1, None
+        if len(item_format) == 1 and item_convert is None:
+            return f'{field_type._length_}{item_format}', field_type._length_, tuple
+    return f'{ctypes.sizeof(field_type)}s', 1, lambda values: field_type.from_buffer_copy(values[0])
@@ -0,0 +1,180 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+import ctypes
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import unittest.mock
+
+import dwarf2ctypes
+import kstructs
+import memsource
+
+_BASE = 0x1000
+
+
+class KernelListsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.task = dwarf2ctypes.get_type('testdata/kernel_lists.o', b'task')
+        self.size = ctypes.sizeof(self.task)
+        self.memory = bytearray(_BASE + 16 * self.size)
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.path = os.path.join(temp_dir, 'memory')
+
+    def task_address(self, index):
+        return _BASE + index * self.size
+
+    def field_address(self, index, path):
+        return self.task_address(index) + kstructs.resolve_field(self.task, path)[0]
+
+    def set_pointer(self, address, value):
+        struct.pack_into('P', self.memory, address, value)
+
+    def set_pids(self):
+        for index in range(16):
+            struct.pack_into('i', self.memory, self.task_address(index), 100 + index)
+
+    def open_source(self):
+        with open(self.path, 'wb') as f:
+            f.write(self.memory)
+        source = memsource.FileSource(self.path)
+        self.addCleanup(source.close)
+        return source
+
+    def test_resolve_field(self):
+        self.assertEqual(kstructs.resolve_field(self.task, 'pid'), (0, ctypes.c_int))
+        # A member of an anonymous union.
+        offset, list_head = kstructs.resolve_field(self.task, 'tasks')
+        self.assertEqual(offset, self.task.tasks.offset)
+        self.assertEqual(list_head.__name__, 'list_head')
+        self.assertEqual(kstructs.resolve_field(self.task, 'se.run_node.rb_left')[0],
+                         self.task.se.offset + self.task.se.size - 8)
+        with self.assertRaises(AttributeError):
+            kstructs.resolve_field(self.task, 'se.missing')
+
+    def test_iter_list(self):
+        # The list is in task 0, and links tasks 3, 1 and 2.
+        order = [0, 3, 1, 2]
+        for index, next_index in zip(order, order[1:] + order[:1]):
+            self.set_pointer(self.field_address(index, 'tasks.next'),
+                             self.field_address(next_index, 'tasks'))
+        source = self.open_source()
+        with unittest.mock.patch.object(source, 'read', wraps=source.read) as read:
+            addresses = list(kstructs.iter_list(source, self.field_address(0, 'tasks'),
+                                                self.task, 'tasks'))
+        self.assertEqual(addresses, [self.task_address(index) for index in order[1:]])
+        self.assertEqual(read.call_count, 4)
+        self.assertTrue(all(call.args[1] == 8 for call in read.call_args_list))
+
+    def test_iter_hlist(self):
+        head = 0x100
+        self.set_pointer(head, self.field_address(5, 'pid_links'))
+        self.set_pointer(self.field_address(5, 'pid_links.next'),
+                         self.field_address(2, 'pid_links'))
+        source = self.open_source()
+        self.assertEqual(list(kstructs.iter_hlist(source, head, self.task, 'pid_links')),
+                         [self.task_address(5), self.task_address(2)])
+        self.assertEqual(list(kstructs.iter_hlist(source, head + 8, self.task, 'pid_links')),
+                         [])
+
+    def test_iter_rbtree(self):
+        root = 0x100
+
+        def set_children(index, left, right):
+            for name, child in (('rb_left', left), ('rb_right', right)):
+                if child is not None:
+                    self.set_pointer(self.field_address(index, f'se.run_node.{name}'),
+                                     self.field_address(child, 'se.run_node'))
+
+        #       4
+        #     2   6
+        #    1 3    7
+        self.set_pointer(root, self.field_address(4, 'se.run_node'))
+        set_children(4, 2, 6)
+        set_children(2, 1, 3)
+        set_children(6, None, 7)
+        source = self.open_source()
+        self.assertEqual(list(kstructs.iter_rbtree(source, root, self.task, 'se.run_node')),
+                         [self.task_address(index) for index in (1, 2, 3, 4, 6, 7)])
+
+    def test_read_structs(self):
+        self.set_pids()
+        source = self.open_source()
+        addresses = [self.task_address(index) for index in (3, 1, 2)]
+        with unittest.mock.patch.object(source, 'read_many',
+                                        wraps=source.read_many) as read_many:
+            tasks = kstructs.read_structs(source, self.task, addresses)
+        self.assertEqual([task.pid for task in tasks], [103, 101, 102])
+        read_many.assert_called_once()
+
+    def test_read_field(self):
+        self.set_pids()
+        self.set_pointer(self.field_address(1, 'tasks.next'), 0x1234)
+        source = self.open_source()
+        addresses = [self.task_address(index) for index in (1, 2)]
+        self.assertEqual(kstructs.read_field(source, self.task, addresses, 'pid'), [101, 102])
+        self.assertEqual([ctypes.cast(pointer, ctypes.c_void_p).value for pointer in
+                          kstructs.read_field(source, self.task, addresses, 'tasks.next')],
+                         [0x1234, None])
+
+    def test_make_reader(self):
+        self.set_pids()
+        comm = self.field_address(2, 'comm')
+        self.memory[comm:comm + 4] = b'init'
+        self.set_pointer(self.field_address(2, 'tasks.next'), 0x1234)
+        self.set_pointer(self.field_address(2, 'se.run_node.rb_left'), 0x5678)
+        source = self.open_source()
+        reader = kstructs.make_reader(self.task, ['comm', 'pid', 'tasks.next',
+                                                  'se.run_node.rb_left'])
+        fields = reader.read(source, self.task_address(2))
+        self.assertEqual(fields.pid, 102)
+        self.assertEqual(fields.comm.rstrip(b'\0'), b'init')
+        self.assertEqual(fields.tasks_next, 0x1234)
+        self.assertEqual(fields.se_run_node_rb_left, 0x5678)
+        self.assertEqual(fields[:2], (fields.comm, 102))
+        # The fields are close enough to be read at once, but only up to the
+        # end of the last one.
+        self.assertEqual(reader.requests(self.task_address(2)),
+                         [(self.task_address(2), self.field_address(2, 'se.run_node.rb_left')
+                           + 8 - self.task_address(2))])
+
+    def test_make_reader_spans(self):
+        self.set_pids()
+        self.set_pointer(self.field_address(1, 'tasks.next'), 0x1234)
+        source = self.open_source()
+        reader = kstructs.make_reader(self.task, ['tasks.next', 'pid', 'tasks'], max_gap=0)
+        self.assertEqual(reader.requests(0), [(0, 4), (self.task.tasks.offset, 8),
+                                              (self.task.tasks.offset, 16)])
+        with unittest.mock.patch.object(source, 'read_many',
+                                        wraps=source.read_many) as read_many:
+            fields = reader.read_many(source, [self.task_address(index) for index in (1, 2)])
+        read_many.assert_called_once()
+        self.assertEqual([(field.pid, field.tasks_next) for field in fields],
+                         [(101, 0x1234), (102, 0)])
+        # Structs are read as ctypes instances.
+        self.assertEqual(ctypes.cast(fields[0].tasks.next, ctypes.c_void_p).value, 0x1234)
+
+    def test_make_reader_arrays(self):
+        class Arrays(ctypes.Structure):
+            _fields_ = [('shorts', ctypes.c_short * 3), ('chars', ctypes.c_char * 4),
+                        ('pairs', (ctypes.c_int * 2) * 2), ('names', (ctypes.c_char * 4) * 3)]
+
+        data = Arrays((1, -2, 3), b'abc', ((4, 5), (6, 7)))
+        for name, value in zip(data.names, (b'ab', b'cd', b'ef')):
+            name.value = value
+        source = unittest.mock.Mock()
+        source.read_many.side_effect = lambda requests: [
+            bytes(data)[address:address + length] for address, length in requests]
+        fields = kstructs.make_reader(Arrays, ['shorts', 'chars', 'pairs', 'names']).read(
+            source, 0)
+        self.assertEqual(fields.shorts, (1, -2, 3))
+        self.assertEqual(fields.chars, b'abc\0')
+        self.assertEqual([list(pair) for pair in fields.pairs], [[4, 5], [6, 7]])
+        self.assertEqual([name.value for name in fields.names], [b'ab', b'cd', b'ef'])
+
+
+if __name__ == '__main__':
+    unittest.main()
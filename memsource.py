@@ -0,0 +1,652 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""Read memory of a running or dumped system, to fill ctypes types.
+
+A `MemorySource` reads whole pages from a backend, keeps recently read pages
+in an LRU cache, and reads runs of adjacent missing pages at once, so reading
+a struct usually costs one cache lookup.  Backends are a local file, e.g.
+`/dev/mem` (`FileSource`), the memory saved in an ELF core (`ElfCoreSource`),
+and a process, e.g. over ssh, that reads for us through a pipe
+(`PipeSource`).
+
+An `AddressSpace` reads virtual memory through a source, translating
+addresses by the segments of an ELF core such as `/proc/kcore`, or by
+walking x86-64 page tables (`X86_64PageTables`).
+
+Files that can be mapped, e.g. vmcores and memory snapshots, are read by a
+`MappedSource`, whose `view()` returns ctypes instances backed by the mapping
+rather than copies.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+import bisect
+import ctypes
+import mmap
+import os
+import select
+import shlex
+import struct
+import subprocess
+import threading
+
+import dwarf2ctypes
+
+PAGE_SIZE = 4096
+# Default number of pages kept by a `MemorySource`.
+DEFAULT_CACHE_PAGES = 1024
+# Default number of page translations kept by an `AddressSpace`.
+DEFAULT_TLB_ENTRIES = 4096
+
+
+class MemoryReadError(Exception):
+    """Raised when some of the memory asked for can't be read."""
+
+
+@dataclass
+class SourceStats:
+    """Counters of a `MemorySource`."""
+    # Pages found in, and missing from, the cache.
+    hits: int = 0
+    misses: int = 0
+    # Reads done by the backend, and the bytes they returned.
+    reads: int = 0
+    bytes_read: int = 0
+
+
+class MemorySource:
+    """Reads memory in pages, through an LRU cache of `cache_pages` pages.
+
+    Subclasses implement `_read_range(address, length)`, which returns the
+    bytes at `address`, or fewer of them when the rest can't be read.
+    Backends that can serve several ranges at once override
+    `_read_ranges(ranges)` instead.
+
+    Cached pages are never refreshed.  Sources of live memory should be
+    `invalidate()`d when stale data matters.
+    """
+
+    def __init__(self, page_size=PAGE_SIZE, cache_pages=DEFAULT_CACHE_PAGES):
+        if cache_pages < 1:
+            raise ValueError('cache_pages must be positive')
+        self.page_size = page_size
+        self._cache_pages = cache_pages
+        # Page number -> bytes of the page, least recently used first.
+        self._pages = OrderedDict()
+        self.stats = SourceStats()
+
+    def read(self, address, length):
+        """Return the `length` bytes at `address`."""
+        page, start = divmod(address, self.page_size)
+        if start + length > self.page_size:
+            return self.read_many([(address, length)])[0]
+        data = self._pages.get(page)
+        if data is None:
+            data = self._fetch([page])[page]
+        else:
+            self._pages.move_to_end(page)
+            self.stats.hits += 1
+        chunk = data[start:start + length]
+        if len(chunk) != length:
+            raise MemoryReadError(f"Can't read {length} bytes at 0x{address:x}")
+        return chunk
+
+    def read_many(self, requests):
+        """Return the bytes of each `(address, length)` of `requests`.
+
+        The pages of all requests missing from the cache are fetched
+        together, with one backend read per run of adjacent pages.
+        """
+        requests = list(requests)
+        page_size = self.page_size
+        pages = sorted({page
+                        for address, length in requests if length > 0
+                        for page in range(address // page_size,
+                                          (address + length - 1) // page_size + 1)})
+        pages_data = self._fetch(pages)
+
+        results = []
+        for address, length in requests:
+            chunks = []
+            remaining = length
+            page, start = divmod(address, page_size)
+            while remaining > 0:
+                chunk = pages_data[page][start:start + remaining]
+                chunks.append(chunk)
+                remaining -= len(chunk)
+                if len(chunk) < page_size - start and remaining > 0:
+                    raise MemoryReadError(
+                        f"Can't read {length} bytes at 0x{address:x}")
+                page += 1
+                start = 0
+            results.append(b''.join(chunks))
+        return results
+
+    def read_struct(self, struct_cls, address):
+        """Return a copy of the `struct_cls` at `address`."""
+        size = ctypes.sizeof(dwarf2ctypes.resolved(struct_cls))
+        return struct_cls.from_buffer_copy(self.read(address, size))
+
+    def invalidate(self):
+        """Forget the cached pages."""
+        self._pages.clear()
+
+    def _fetch(self, pages):
+        """Return a dict mapping `pages`, sorted page numbers, to their bytes."""
+        pages_data = {}
+        runs = []
+        for page in pages:
+            data = self._pages.get(page)
+            if data is not None:
+                self._pages.move_to_end(page)
+                self.stats.hits += 1
+                pages_data[page] = data
+            elif runs and runs[-1][0] + runs[-1][1] == page:
+                runs[-1][1] += 1
+            else:
+                runs.append([page, 1])
+        if not runs:
+            return pages_data
+
+        page_size = self.page_size
+        runs_data = self._read_ranges([(first * page_size, count * page_size)
+                                       for first, count in runs])
+        for (first, count), data in zip(runs, runs_data):
+            self.stats.misses += count
+            self.stats.reads += 1
+            self.stats.bytes_read += len(data)
+            for i in range(count):
+                page_data = data[i * page_size:(i + 1) * page_size]
+                pages_data[first + i] = page_data
+                # Pages that can't be read are tried again next time.
+                if page_data:
+                    self._pages[first + i] = page_data
+        while len(self._pages) > self._cache_pages:
+            self._pages.popitem(last=False)
+        return pages_data
+
+    def _read_ranges(self, ranges):
+        return [self._read_range(address, length) for address, length in ranges]
+
+    def _read_range(self, address, length):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FileSource(MemorySource):
+    """Memory read from a file, e.g. `/dev/mem` or a raw memory snapshot.
+
+    Addresses are offsets in the file.
+    """
+
+    def __init__(self, path, page_size=PAGE_SIZE, cache_pages=DEFAULT_CACHE_PAGES):
+        super().__init__(page_size=page_size, cache_pages=cache_pages)
+        self.path = path
+        self._fd = os.open(path, os.O_RDONLY)
+
+    def _read_range(self, address, length):
+        return self._pread(address, length)
+
+    def _pread(self, offset, length):
+        try:
+            return os.pread(self._fd, length, offset)
+        except OSError:
+            if length <= self.page_size:
+                return b''
+        # Some pages of the range can't be read, e.g. reserved pages of
+        # `/dev/mem`: read the ones before them.
+        chunks = []
+        for chunk_offset in range(0, length, self.page_size):
+            chunk = self._pread(offset + chunk_offset,
+                                min(self.page_size, length - chunk_offset))
+            chunks.append(chunk)
+            if len(chunk) < self.page_size:
+                break
+        return b''.join(chunks)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class MappedSource(MemorySource):
+    """Memory of a file mapped in memory, e.g. a vmcore or a raw snapshot.
+
+    Addresses are offsets in the file.  Reads are slices of the mapping, so
+    no pages are cached, and `view()` returns structs that share the memory
+    of the mapping.  The file is mapped copy-on-write: changing a view
+    doesn't change the file.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    def read(self, address, length):
+        data = self._map[address:address + length]
+        if len(data) != length:
+            raise MemoryReadError(f"Can't read {length} bytes at 0x{address:x}")
+        return data
+
+    def read_many(self, requests):
+        return [self.read(address, length) for address, length in requests]
+
+    def _read_range(self, address, length):
+        return self._map[address:address + length]
+
+    def view(self, struct_cls, address):
+        """Return the `struct_cls` at `address`, without copying it."""
+        size = ctypes.sizeof(dwarf2ctypes.resolved(struct_cls))
+        if address < 0 or address + size > len(self._map):
+            raise MemoryReadError(f"Can't read {size} bytes at 0x{address:x}")
+        return struct_cls.from_buffer(self._map, address)
+
+    def view_array(self, struct_cls, address, count):
+        """Return the array of `count` `struct_cls` at `address`, without
+        copying it."""
+        return self.view(dwarf2ctypes.resolved(struct_cls) * count, address)
+
+    def close(self):
+        # Views keep the mapping alive; it's unmapped once they are all gone.
+        self._map = None
+
+
+@dataclass
+class Segment:
+    """`size` bytes of memory at `address`, found at `offset` of the memory
+    they're read from, e.g. of a file."""
+    address: int
+    size: int
+    offset: int
+
+
+class ElfCoreSource(FileSource):
+    """Physical memory saved in an ELF core, e.g. a kdump vmcore.
+
+    Addresses are physical addresses, mapped to the file by the `p_paddr` of
+    the PT_LOAD segments.  Memory of a segment beyond its `p_filesz` wasn't
+    saved and can't be read.
+    """
+
+    def __init__(self, path, page_size=PAGE_SIZE, cache_pages=DEFAULT_CACHE_PAGES):
+        super().__init__(path, page_size=page_size, cache_pages=cache_pages)
+        self.segments = sorted(
+            (Segment(address=segment['p_paddr'], size=segment['p_filesz'],
+                     offset=segment['p_offset'])
+             for segment in self._load_segments()
+             if segment['p_paddr'] != _NO_PHYSICAL_ADDRESS),
+            key=lambda segment: segment.address)
+        self._addresses = [segment.address for segment in self.segments]
+
+    def _load_segments(self):
+        with open(self.path, 'rb') as f:
+            return _load_segments(f)
+
+    def _read_range(self, address, length):
+        chunks = []
+        end = address + length
+        first = max(bisect.bisect_right(self._addresses, address) - 1, 0)
+        for segment in self.segments[first:]:
+            if segment.address + segment.size <= address:
+                continue
+            if segment.address > address:
+                break
+            chunk_end = min(end, segment.address + segment.size)
+            chunk = self._pread(segment.offset + address - segment.address,
+                                chunk_end - address)
+            chunks.append(chunk)
+            address += len(chunk)
+            if address < chunk_end or address == end:
+                break
+        return b''.join(chunks)
+
+
+# `p_paddr` of segments without physical memory, e.g. vmalloc in /proc/kcore.
+_NO_PHYSICAL_ADDRESS = 0xffffffffffffffff
+
+
+def _load_segments(stream):
+    """Return the PT_LOAD program headers of the ELF file in `stream`."""
+    # pyelftools is imported lazily, like in dwarf2ctypes.
+    from elftools.elf.elffile import ELFFile
+
+    return [segment.header for segment in ELFFile(stream).iter_segments()
+            if segment['p_type'] == 'PT_LOAD']
+
+
+class _SourceStream:
+    """A read-only file object over the memory of a `MemorySource`.
+
+    Sources don't know their size, so the end of the stream is taken to be
+    at the end of the 64-bit address space.
+    """
+
+    def __init__(self, source):
+        self._source = source
+        self._position = 0
+
+    def read(self, size):
+        data = self._source.read(self._position, size)
+        self._position += size
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += 1 << 64
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+
+# Run by `PipeSource` on the other end of the pipe, with the path to read
+# as its argument.  Requests are `_PIPE_REQUEST`s, and each is answered with
+# a `_PIPE_RESPONSE` followed by the bytes read.
+PIPE_SERVER_SCRIPT = '''\
+import os, struct, sys
+fd = os.open(sys.argv[1], os.O_RDONLY)
+requests, responses = sys.stdin.buffer, sys.stdout.buffer
+while True:
+    request = requests.read(16)
+    if len(request) < 16:
+        break
+    address, length = struct.unpack('<QQ', request)
+    try:
+        data = os.pread(fd, length, address)
+    except OSError:
+        data = b''
+    responses.write(struct.pack('<Q', len(data)) + data)
+    responses.flush()
+'''
+_PIPE_REQUEST = struct.Struct('<QQ')  # address, length
+_PIPE_RESPONSE = struct.Struct('<Q')  # length
+
+
+class PipeSource(MemorySource):
+    """Memory read by a process running `PIPE_SERVER_SCRIPT`.
+
+    The process is started once, and serves all reads.  The requests of a
+    `read_many` are all sent while the responses are read, so a batch of
+    reads costs one round trip.  Requests that may not fit in the pipe are
+    sent by another thread, as the process stops reading them when the
+    responses fill its own pipe.  See `over_ssh` for reading memory of
+    another machine.
+    """
+
+    def __init__(self, command, page_size=PAGE_SIZE, cache_pages=DEFAULT_CACHE_PAGES):
+        super().__init__(page_size=page_size, cache_pages=cache_pages)
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+
+    @classmethod
+    def over_ssh(cls, destination, path='/dev/mem', port=None, python='python3',
+                 page_size=PAGE_SIZE, cache_pages=DEFAULT_CACHE_PAGES):
+        """Read `path` on `destination`, e.g. 'root@localhost', over ssh."""
+        command = ['ssh', destination]
+        if port is not None:
+            command += ['-p', str(port)]
+        command.append(f'{python} -c {shlex.quote(PIPE_SERVER_SCRIPT)} {shlex.quote(path)}')
+        return cls(command, page_size=page_size, cache_pages=cache_pages)
+
+    def _read_ranges(self, ranges):
+        requests = b''.join(_PIPE_REQUEST.pack(address, length)
+                            for address, length in ranges)
+        writer = None
+        if len(requests) <= select.PIPE_BUF:
+            self._write_requests(requests)
+        else:
+            writer = threading.Thread(target=self._write_requests, args=(requests,),
+                                      daemon=True)
+            writer.start()
+        try:
+            results = []
+            for _ in ranges:
+                (length,) = _PIPE_RESPONSE.unpack(self._read_exactly(_PIPE_RESPONSE.size))
+                results.append(self._read_exactly(length))
+            return results
+        finally:
+            if writer is not None:
+                writer.join()
+
+    def _write_requests(self, requests):
+        try:
+            self._process.stdin.write(requests)
+            self._process.stdin.flush()
+        except BrokenPipeError:
+            # The process exited, which reading its responses reports.
+            pass
+
+    def _read_exactly(self, size):
+        data = self._process.stdout.read(size)
+        if len(data) != size:
+            raise MemoryReadError(f'Memory reader exited with {self._process.poll()}')
+        return data
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.stdin.close()
+            self._process.wait()
+        self._process.stdout.close()
+
+
+@dataclass
+class TranslationStats:
+    """Counters of an `AddressSpace`."""
+    # Translations found in, and missing from, the TLB.
+    tlb_hits: int = 0
+    tlb_misses: int = 0
+
+
+class AddressSpace:
+    """Virtual memory, read through a `MemorySource`.
+
+    Addresses are translated to addresses of `source` by `segments`, which
+    are kept sorted and searched by bisection, or by `page_tables`, e.g.
+    `X86_64PageTables`.  Translations of the `tlb_entries` pages used last
+    are cached, so translating an address usually costs a dict lookup.
+
+    `from_elf_core` makes an address space out of the segments of an ELF
+    core, e.g. of `/proc/kcore`.
+    """
+
+    def __init__(self, source, segments=None, page_tables=None,
+                 tlb_entries=DEFAULT_TLB_ENTRIES):
+        if (segments is None) == (page_tables is None):
+            raise ValueError('Either segments or page_tables is required')
+        self.source = source
+        self.segments = sorted(segments or (), key=lambda segment: segment.address)
+        self._addresses = [segment.address for segment in self.segments]
+        self.page_tables = page_tables
+        self._tlb_entries = tlb_entries
+        # Virtual page number -> address of the page in `source`.
+        self._tlb = OrderedDict()
+        self.stats = TranslationStats()
+
+    @classmethod
+    def from_elf_core(cls, source, tlb_entries=DEFAULT_TLB_ENTRIES):
+        """The virtual memory saved in the ELF core read by `source`.
+
+        `source` reads the core file, e.g. `FileSource('/proc/kcore')`, or
+        `PipeSource.over_ssh(host, '/proc/kcore')`.  Its PT_LOAD program
+        headers are parsed by pyelftools, and map their `p_vaddr` to
+        `p_offset` in the file.
+        """
+        segments = [Segment(address=segment['p_vaddr'], size=segment['p_filesz'],
+                            offset=segment['p_offset'])
+                    for segment in _load_segments(_SourceStream(source))]
+        return cls(source, segments=segments, tlb_entries=tlb_entries)
+
+    def translate(self, address):
+        """Return the address of `source` that `address` translates to."""
+        return self._translate(address)[0]
+
+    def _translate(self, address):
+        """Return the translation of `address`, and the number of bytes from
+        `address` on mapped contiguously, up to the end of its page."""
+        page, start = divmod(address, PAGE_SIZE)
+        base = self._tlb.get(page)
+        if base is not None:
+            self._tlb.move_to_end(page)
+            self.stats.tlb_hits += 1
+            return base + start, PAGE_SIZE - start
+        self.stats.tlb_misses += 1
+
+        if self.page_tables is not None:
+            # Pages of page tables are at least PAGE_SIZE large, and aligned.
+            target, _ = self.page_tables.translate(address)
+            mapped = PAGE_SIZE - start
+        else:
+            i = bisect.bisect_right(self._addresses, address) - 1
+            segment = self.segments[i] if i >= 0 else None
+            if segment is None or address >= segment.address + segment.size:
+                raise MemoryReadError(f"Can't translate 0x{address:x}")
+            target = segment.offset + address - segment.address
+            mapped = min(segment.address + segment.size - address, PAGE_SIZE - start)
+            if start > address - segment.address or mapped < PAGE_SIZE - start:
+                # The segment only has part of the page.
+                return target, mapped
+
+        self._tlb[page] = target - start
+        if len(self._tlb) > self._tlb_entries:
+            self._tlb.popitem(last=False)
+        return target, mapped
+
+    def read(self, address, length):
+        """Return the `length` bytes at virtual `address`."""
+        target, mapped = self._translate(address)
+        if length <= mapped:
+            return self.source.read(target, length)
+        return self.read_many([(address, length)])[0]
+
+    def read_many(self, requests):
+        """Return the bytes at each virtual `(address, length)` of `requests`.
+
+        The translated ranges are all read by one `source.read_many`.
+        """
+        pieces = []
+        bounds = []
+        for address, length in requests:
+            first = len(pieces)
+            while length > 0:
+                target, mapped = self._translate(address)
+                size = min(mapped, length)
+                pieces.append((target, size))
+                address += size
+                length -= size
+            bounds.append((first, len(pieces)))
+        data = self.source.read_many(pieces)
+        return [b''.join(data[first:end]) for first, end in bounds]
+
+    def read_struct(self, struct_cls, address):
+        """Return a copy of the `struct_cls` at virtual `address`."""
+        size = ctypes.sizeof(dwarf2ctypes.resolved(struct_cls))
+        return struct_cls.from_buffer_copy(self.read(address, size))
+
+    def view(self, struct_cls, address):
+        """Return the `struct_cls` at virtual `address` of a `MappedSource`.
+
+        The struct shares the memory of the source, unless its pages aren't
+        contiguous in the source, e.g. with page tables, in which case it's
+        a copy.
+        """
+        target = self._contiguous_translation(address, ctypes.sizeof(dwarf2ctypes.resolved(struct_cls)))
+        if target is None:
+            return self.read_struct(struct_cls, address)
+        return self.source.view(struct_cls, target)
+
+    def view_array(self, struct_cls, address, count):
+        """Return the array of `count` `struct_cls` at virtual `address` of
+        a `MappedSource`, like `view()`."""
+        return self.view(dwarf2ctypes.resolved(struct_cls) * count, address)
+
+    def _contiguous_translation(self, address, length):
+        """Return the translation of `address` if the `length` bytes there
+        are contiguous in `source`, else None."""
+        target, mapped = self._translate(address)
+        while mapped < length:
+            next_target, next_mapped = self._translate(address + mapped)
+            if next_target != target + mapped:
+                return None
+            mapped += next_mapped
+        return target
+
+    def flush(self):
+        """Forget cached translations, e.g. after page tables changed."""
+        self._tlb.clear()
+        if self.page_tables is not None:
+            self.page_tables.flush()
+
+    def close(self):
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Shifts of the virtual address bits indexing each level of x86-64 page
+# tables: PML4, PDPT, PD and PT.
+_X86_64_LEVEL_SHIFTS = (39, 30, 21, 12)
+_X86_64_ENTRY = struct.Struct('<Q')
+_X86_64_PRESENT = 1 << 0
+_X86_64_LARGE_PAGE = 1 << 7
+_X86_64_ADDRESS_MASK = 0x000ffffffffff000
+
+
+class X86_64PageTables:
+    """Translates virtual addresses by walking 4-level x86-64 page tables.
+
+    The tables are read from `source`, physical memory, starting at the
+    PML4 table of `cr3`.  The address of every table found during a walk is
+    cached, so walks of addresses near each other start from their lowest
+    shared table, and usually read one entry.
+    """
+
+    def __init__(self, source, cr3):
+        self.source = source
+        self._pml4 = cr3 & _X86_64_ADDRESS_MASK
+        # (level, virtual address >> bits translated from that level on) ->
+        # physical address of the table.
+        self._tables = {}
+
+    def translate(self, address):
+        """Return the physical address of `address`, and the size of its page."""
+        level, table = 0, self._pml4
+        for cached_level in (3, 2, 1):
+            cached = self._tables.get(
+                (cached_level, address >> (_X86_64_LEVEL_SHIFTS[cached_level] + 9)))
+            if cached is not None:
+                level, table = cached_level, cached
+                break
+
+        while True:
+            shift = _X86_64_LEVEL_SHIFTS[level]
+            (entry,) = _X86_64_ENTRY.unpack(
+                self.source.read(table + ((address >> shift) & 0x1ff) * 8, 8))
+            if not entry & _X86_64_PRESENT:
+                raise MemoryReadError(f'0x{address:x} is not mapped')
+            page_size = 1 << shift
+            if level == 3 or (level > 0 and entry & _X86_64_LARGE_PAGE):
+                base = entry & _X86_64_ADDRESS_MASK & ~(page_size - 1)
+                return base + (address & (page_size - 1)), page_size
+            table = entry & _X86_64_ADDRESS_MASK
+            level += 1
+            self._tables[(level, address >> (_X86_64_LEVEL_SHIFTS[level] + 9))] = table
+
+    def flush(self):
+        """Forget the addresses of tables."""
+        self._tables.clear()
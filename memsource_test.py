@@ -0,0 +1,388 @@
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+import ctypes
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+import dwarf2ctypes
+import memsource
+
+_ELF_HEADER = struct.Struct('<16sHHIQQQIHHHHHH')
+_PROGRAM_HEADER = struct.Struct('<IIQQQQQQ')
+
+
+def _write_elf_core(path, segments):
+    """Write an x86-64 ELF core with a PT_LOAD per `(vaddr, paddr, data)`."""
+    offset = _ELF_HEADER.size + _PROGRAM_HEADER.size * len(segments)
+    headers = []
+    for vaddr, paddr, data in segments:
+        headers.append(_PROGRAM_HEADER.pack(1, 7, offset, vaddr, paddr,
+                                            len(data), len(data), 0x1000))
+        offset += len(data)
+    with open(path, 'wb') as f:
+        f.write(_ELF_HEADER.pack(b'\x7fELF\x02\x01\x01' + bytes(9), 4, 62, 1, 0,
+                                 _ELF_HEADER.size, 0, 0, _ELF_HEADER.size,
+                                 _PROGRAM_HEADER.size, len(segments), 0, 0, 0))
+        f.writelines(headers)
+        f.writelines(data for _, _, data in segments)
+
+
+class TempDirMixin:
+
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+    def write_file(self, name, data):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+
+class FileSourceTest(TempDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data = random.Random(0).randbytes(8 * memsource.PAGE_SIZE + 100)
+        self.source = memsource.FileSource(self.write_file('memory', self.data))
+        self.addCleanup(self.source.close)
+
+    def test_read(self):
+        self.assertEqual(self.source.read(10, 20), self.data[10:30])
+        self.assertEqual(self.source.read(4090, 20), self.data[4090:4110])
+        self.assertEqual(self.source.stats.misses, 2)
+        self.assertEqual(self.source.stats.reads, 2)
+
+    def test_cached_pages(self):
+        self.source.read(10, 20)
+        self.source.read(100, 8)
+        self.assertEqual(self.source.stats.hits, 1)
+        self.assertEqual(self.source.stats.reads, 1)
+
+    def test_read_many_coalesced(self):
+        page_size = memsource.PAGE_SIZE
+        requests = [(page_size * 3 + 8, 8), (8, 8), (page_size + 8, 8),
+                    (page_size * 2 - 12, 8)]
+        self.assertEqual(self.source.read_many(requests),
+                         [self.data[address:address + length]
+                          for address, length in requests])
+        # Pages 0 to 1, then page 3.
+        self.assertEqual(self.source.stats.reads, 2)
+        self.assertEqual(self.source.stats.misses, 3)
+
+    def test_lru_eviction(self):
+        source = memsource.FileSource(self.source.path, cache_pages=2)
+        self.addCleanup(source.close)
+        page_size = memsource.PAGE_SIZE
+        source.read(0, 1)
+        source.read(page_size, 1)
+        source.read(0, 1)
+        source.read(page_size * 2, 1)
+        source.read(0, 1)
+        self.assertEqual(source.stats.hits, 2)
+        source.read(page_size, 1)
+        self.assertEqual(source.stats.misses, 4)
+
+    def test_end_of_file(self):
+        self.assertEqual(self.source.read(len(self.data) - 10, 10), self.data[-10:])
+        with self.assertRaises(memsource.MemoryReadError):
+            self.source.read(len(self.data) - 10, 11)
+        with self.assertRaises(memsource.MemoryReadError):
+            self.source.read_many([(len(self.data) - 5000, 5001)])
+
+    def test_read_struct(self):
+        class Pair(ctypes.Structure):
+            _fields_ = [('a', ctypes.c_uint32), ('b', ctypes.c_uint32)]
+
+        pair = self.source.read_struct(Pair, 4092)
+        self.assertEqual((pair.a, pair.b), struct.unpack_from('<II', self.data, 4092))
+
+    def test_read_lazy_struct(self):
+        library = dwarf2ctypes.TypeLibrary('testdata/cross_cu.o', lazy=True)
+        node = dict(library.get_type(b'list')._fields_)['head']._type_
+        value = self.source.read_struct(node, 4092).value
+        self.assertEqual(value, struct.unpack_from('<q', self.data, 4100)[0])
+
+    def test_invalidate(self):
+        self.source.read(0, 1)
+        self.source.invalidate()
+        self.source.read(0, 1)
+        self.assertEqual(self.source.stats.reads, 2)
+
+
+class MappedSourceTest(TempDirMixin, unittest.TestCase):
+
+    class Pair(ctypes.Structure):
+        _fields_ = [('a', ctypes.c_uint32), ('b', ctypes.c_uint32)]
+
+    def setUp(self):
+        super().setUp()
+        self.data = random.Random(2).randbytes(2 * memsource.PAGE_SIZE)
+        self.path = self.write_file('memory', self.data)
+        self.source = memsource.MappedSource(self.path)
+        self.addCleanup(self.source.close)
+
+    def test_read(self):
+        self.assertEqual(self.source.read(4090, 20), self.data[4090:4110])
+        self.assertEqual(self.source.read_many([(0, 4), (8, 4)]),
+                         [self.data[0:4], self.data[8:12]])
+        with self.assertRaises(memsource.MemoryReadError):
+            self.source.read(len(self.data) - 1, 2)
+
+    def test_view(self):
+        pair = self.source.view(self.Pair, 4092)
+        self.assertEqual((pair.a, pair.b), struct.unpack_from('<II', self.data, 4092))
+
+    def test_views_share_memory(self):
+        first = self.source.view(self.Pair, 16)
+        second = self.source.view(self.Pair, 16)
+        first.a = 0x12345678
+        self.assertEqual(second.a, 0x12345678)
+        self.assertEqual(self.source.read(16, 4), struct.pack('<I', 0x12345678))
+        # The mapping is copy-on-write.
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_view_array(self):
+        pairs = self.source.view_array(self.Pair, 8, 3)
+        self.assertEqual([(pair.a, pair.b) for pair in pairs],
+                         [struct.unpack_from('<II', self.data, 8 + i * 8) for i in range(3)])
+
+    def test_view_beyond_end(self):
+        with self.assertRaises(memsource.MemoryReadError):
+            self.source.view(self.Pair, len(self.data) - 4)
+
+    def test_view_outlives_close(self):
+        pair = self.source.view(self.Pair, 0)
+        self.source.close()
+        self.assertEqual(pair.a, struct.unpack_from('<I', self.data)[0])
+
+
+class ElfCoreSourceTest(TempDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.low = bytes(range(256)) * 32
+        self.high = bytes(reversed(range(256))) * 16
+        self.path = os.path.join(self.temp_dir, 'core')
+        _write_elf_core(self.path, [
+            (0xffff888000000000, 0x100000, self.low),
+            (0xffff888000002000, 0x102000, self.high),
+            (0xffffc90000000000, 0xffffffffffffffff, b'\xaa' * 4096),
+            (0xffff888000010000, 0x110000, b'\x55' * 4096),
+        ])
+        self.source = memsource.ElfCoreSource(self.path)
+        self.addCleanup(self.source.close)
+
+    def test_read(self):
+        self.assertEqual(self.source.read(0x100010, 4), self.low[0x10:0x14])
+        self.assertEqual(self.source.read(0x110000, 2), b'\x55\x55')
+
+    def test_adjacent_segments(self):
+        self.assertEqual(self.source.read(0x101ffe, 4), self.low[-2:] + self.high[:2])
+
+    def test_unsaved_memory(self):
+        with self.assertRaises(memsource.MemoryReadError):
+            self.source.read(0x103000, 4)
+        with self.assertRaises(memsource.MemoryReadError):
+            self.source.read(0xff000, 4)
+
+    def test_segments_without_physical_address_skipped(self):
+        self.assertEqual([segment.address for segment in self.source.segments],
+                         [0x100000, 0x102000, 0x110000])
+
+
+class PipeSourceTest(TempDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data = random.Random(1).randbytes(4 * memsource.PAGE_SIZE)
+        path = self.write_file('memory', self.data)
+        self.source = memsource.PipeSource(
+            [sys.executable, '-c', memsource.PIPE_SERVER_SCRIPT, path])
+        self.addCleanup(self.source.close)
+
+    def test_read(self):
+        self.assertEqual(self.source.read(4000, 200), self.data[4000:4200])
+        self.assertEqual(self.source.read(4100, 4), self.data[4100:4104])
+        self.assertEqual(self.source.stats.reads, 1)
+
+    def test_read_many(self):
+        requests = [(0, 4), (3 * memsource.PAGE_SIZE, 4)]
+        self.assertEqual(self.source.read_many(requests),
+                         [self.data[0:4], self.data[3 * memsource.PAGE_SIZE:][:4]])
+        self.assertEqual(self.source.stats.reads, 2)
+
+    def test_beyond_end(self):
+        with self.assertRaises(memsource.MemoryReadError):
+            self.source.read(len(self.data), 1)
+
+    def test_batch_larger_than_pipes(self):
+        # Every other page of a sparse file, so requests aren't coalesced and
+        # both the requests and the responses overflow their pipes.
+        path = os.path.join(self.temp_dir, 'sparse')
+        with open(path, 'wb') as f:
+            f.truncate(20000 * memsource.PAGE_SIZE)
+        source = memsource.PipeSource(
+            [sys.executable, '-c', memsource.PIPE_SERVER_SCRIPT, path])
+        self.addCleanup(source.close)
+        # Fail rather than hang if reading deadlocks.
+        timer = threading.Timer(60, source._process.kill)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        requests = [(i * 2 * memsource.PAGE_SIZE, 8) for i in range(10000)]
+        self.assertEqual(source.read_many(requests), [bytes(8)] * len(requests))
+        self.assertEqual(source.stats.reads, 10000)
+
+
+class AddressSpaceTest(TempDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.low = bytes(range(256)) * 32
+        self.high = bytes(reversed(range(256))) * 16
+        path = os.path.join(self.temp_dir, 'core')
+        _write_elf_core(path, [
+            (0xffff888000000000, 0xffffffffffffffff, self.low),
+            (0xffff888000002000, 0xffffffffffffffff, self.high),
+            (0xffffffff81000000, 0x1000000, b'\x55' * 0x800),
+        ])
+        self.path = path
+        self.address_space = memsource.AddressSpace.from_elf_core(memsource.FileSource(path))
+        self.addCleanup(self.address_space.close)
+
+    def test_read(self):
+        self.assertEqual(self.address_space.read(0xffff888000000010, 4), self.low[0x10:0x14])
+        self.assertEqual(self.address_space.read(0xffffffff81000000, 2), b'\x55\x55')
+
+    def test_across_segments(self):
+        self.assertEqual(self.address_space.read(0xffff888000001ffe, 4),
+                         self.low[-2:] + self.high[:2])
+        self.assertEqual(self.address_space.read_many([(0xffff888000000ffc, 8),
+                                                       (0xffff888000002000, 2)]),
+                         [self.low[0xffc:0x1004], self.high[:2]])
+
+    def test_unmapped(self):
+        with self.assertRaises(memsource.MemoryReadError):
+            self.address_space.read(0xffff888000003000, 1)
+        with self.assertRaises(memsource.MemoryReadError):
+            self.address_space.read(0xffffffff81000800, 1)
+        with self.assertRaises(memsource.MemoryReadError):
+            self.address_space.read(0x1000, 1)
+
+    def test_tlb(self):
+        self.address_space.read(0xffff888000000010, 4)
+        self.address_space.read(0xffff888000000100, 4)
+        self.assertEqual(self.address_space.stats.tlb_misses, 1)
+        self.assertEqual(self.address_space.stats.tlb_hits, 1)
+
+    def test_partial_pages_not_cached(self):
+        self.address_space.read(0xffffffff81000000, 1)
+        self.address_space.read(0xffffffff81000000, 1)
+        self.assertEqual(self.address_space.stats.tlb_misses, 2)
+
+    def test_core_read_through_pipe(self):
+        address_space = memsource.AddressSpace.from_elf_core(memsource.PipeSource(
+            [sys.executable, '-c', memsource.PIPE_SERVER_SCRIPT, self.path]))
+        self.addCleanup(address_space.close)
+        self.assertEqual(address_space.read(0xffff888000002000, 2), self.high[:2])
+
+    def test_translate(self):
+        self.assertEqual(self.address_space.translate(0xffff888000002004),
+                         self.address_space.segments[1].offset + 4)
+
+    def test_view(self):
+        address_space = memsource.AddressSpace.from_elf_core(memsource.MappedSource(self.path))
+        self.addCleanup(address_space.close)
+        values = address_space.view_array(ctypes.c_uint8, 0xffff888000001ffe, 4)
+        self.assertEqual(bytes(values), self.low[-2:] + self.high[:2])
+        values[0] = 0
+        self.assertEqual(address_space.read(0xffff888000001ffe, 1), b'\0')
+
+
+class X86_64PageTablesTest(TempDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        memory = bytearray(16 * memsource.PAGE_SIZE)
+
+        def set_entry(table_page, index, value):
+            struct.pack_into('<Q', memory, table_page * memsource.PAGE_SIZE + index * 8,
+                             value)
+
+        # 0xffff888000000000: PML4 at page 1, PDPT at page 2, PD at page 3 and
+        # PT at page 4.  Its second 4 KiB page is at page 8, and its second
+        # 2 MiB page is large.
+        set_entry(1, 0x111, 2 * memsource.PAGE_SIZE | 0x63)
+        set_entry(2, 0, 3 * memsource.PAGE_SIZE | 0x63)
+        set_entry(3, 0, 4 * memsource.PAGE_SIZE | 0x63)
+        set_entry(4, 1, 8 * memsource.PAGE_SIZE | 0x8000000000000063)
+        # Its fourth page is at page 5, and its fifth and sixth at pages 9
+        # and 10.
+        set_entry(4, 3, 5 * memsource.PAGE_SIZE | 0x63)
+        set_entry(4, 4, 9 * memsource.PAGE_SIZE | 0x63)
+        set_entry(4, 5, 10 * memsource.PAGE_SIZE | 0x63)
+        set_entry(3, 1, 0x40000000 | 0xe3)
+        # A 1 GiB page at 0xffff888040000000.
+        set_entry(2, 1, 0x80000000 | 0xe3)
+        memory[8 * memsource.PAGE_SIZE:9 * memsource.PAGE_SIZE] = b'\xab' * memsource.PAGE_SIZE
+        memory[5 * memsource.PAGE_SIZE:6 * memsource.PAGE_SIZE] = b'\x05' * memsource.PAGE_SIZE
+        memory[9 * memsource.PAGE_SIZE:11 * memsource.PAGE_SIZE] = (
+            b'\x09' * memsource.PAGE_SIZE + b'\x0a' * memsource.PAGE_SIZE)
+        self.path = self.write_file('memory', memory)
+        self.source = memsource.FileSource(self.path)
+        self.addCleanup(self.source.close)
+        self.page_tables = memsource.X86_64PageTables(self.source, memsource.PAGE_SIZE)
+
+    def test_translate(self):
+        self.assertEqual(self.page_tables.translate(0xffff888000001234),
+                         (8 * memsource.PAGE_SIZE + 0x234, memsource.PAGE_SIZE))
+        self.assertEqual(self.page_tables.translate(0xffff888000212345),
+                         (0x40012345, 1 << 21))
+        self.assertEqual(self.page_tables.translate(0xffff888040012345),
+                         (0x80012345, 1 << 30))
+
+    def test_not_present(self):
+        with self.assertRaises(memsource.MemoryReadError):
+            self.page_tables.translate(0xffff888000002000)
+        with self.assertRaises(memsource.MemoryReadError):
+            self.page_tables.translate(0xffffffff81000000)
+
+    def test_tables_cached(self):
+        self.page_tables.translate(0xffff888000001000)
+        with unittest.mock.patch.object(self.source, 'read', wraps=self.source.read) as read:
+            self.page_tables.translate(0xffff888000001008)
+        read.assert_called_once_with(4 * memsource.PAGE_SIZE + 8, 8)
+
+    def test_address_space(self):
+        address_space = memsource.AddressSpace(self.source, page_tables=self.page_tables)
+        self.assertEqual(address_space.read(0xffff888000001ffe, 2), b'\xab\xab')
+        with self.assertRaises(memsource.MemoryReadError):
+            address_space.read(0xffff888000001ffe, 4)
+
+    def test_view(self):
+        source = memsource.MappedSource(self.path)
+        address_space = memsource.AddressSpace(
+            source, page_tables=memsource.X86_64PageTables(source, memsource.PAGE_SIZE))
+        self.addCleanup(address_space.close)
+        # Contiguous pages are viewed in place.
+        values = address_space.view_array(ctypes.c_uint8, 0xffff888000004ffe, 4)
+        values[0] = 0
+        self.assertEqual(source.read(9 * memsource.PAGE_SIZE + 0xffe, 4), b'\0\x09\x0a\x0a')
+        # Others are copied.
+        values = address_space.view_array(ctypes.c_uint8, 0xffff888000003ffe, 4)
+        self.assertEqual(bytes(values), b'\x05\x05\x09\x09')
+        values[0] = 0
+        self.assertEqual(source.read(5 * memsource.PAGE_SIZE + 0xffe, 1), b'\x05')
+
+
+if __name__ == '__main__':
+    unittest.main()
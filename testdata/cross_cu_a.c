@@ -0,0 +1,6 @@
+struct node;
+
+struct list {
+  struct node *head;
+  int length;
+} list_var;
@@ -0,0 +1,5 @@
+struct b;
+
+struct a {
+  struct b *b;
+} a_var;
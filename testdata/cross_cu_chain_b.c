@@ -0,0 +1,5 @@
+struct c;
+
+struct b {
+  struct c *c;
+} b_var;
@@ -0,0 +1,3 @@
+struct c {
+  long value;
+} c_var;
@@ -0,0 +1,13 @@
+struct pair {
+  int first;
+  int second;
+};
+
+struct holder_a {
+  struct pair pair;
+  union {
+    int i;
+    short s;
+  } value;
+  struct holder_a *next;
+} holder_a;
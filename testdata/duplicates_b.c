@@ -0,0 +1,16 @@
+struct pair {
+  int first;
+  int second;
+};
+
+struct holder_b {
+  struct pair pair;
+  union {
+    int i;
+    short s;
+  } value;
+  union {
+    int i;
+    long l;
+  } other;
+} holder_b;
@@ -0,0 +1,16 @@
+struct unchanged {
+  int a;
+};
+
+struct changed {
+  int a;
+};
+
+struct points_to_changed {
+  struct changed *changed;
+};
+
+struct root {
+  struct unchanged unchanged;
+  struct points_to_changed *points_to_changed;
+} root;
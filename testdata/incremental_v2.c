@@ -0,0 +1,22 @@
+struct unchanged {
+  int a;
+};
+
+struct changed {
+  int a;
+  long b;
+};
+
+struct points_to_changed {
+  struct changed *changed;
+};
+
+struct added {
+  int a;
+};
+
+struct root {
+  struct unchanged unchanged;
+  struct points_to_changed *points_to_changed;
+  struct added *added;
+} root;
@@ -0,0 +1,28 @@
+typedef int count_t;
+typedef int length_t;
+
+struct interning {
+  union {
+    count_t f_int;
+    char f_chars[4];
+  } f_first;
+  union {
+    length_t f_int;
+    char f_chars[4];
+  } f_second;
+  struct {
+    count_t f_int;
+    short f_short;
+  } f_third;
+  struct {
+    length_t f_int;
+    short f_short;
+  } f_fourth;
+  int f_ints[2];
+  char f_char;
+  int f_after_padding;
+  char f_other_char;
+  int f_after_other_padding;
+  int *f_pointer;
+  int *f_other_pointer;
+} var;
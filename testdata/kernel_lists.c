@@ -0,0 +1,30 @@
+struct list_head {
+  struct list_head *next, *prev;
+};
+
+struct hlist_node {
+  struct hlist_node *next, **pprev;
+};
+
+struct rb_node {
+  unsigned long __rb_parent_color;
+  struct rb_node *rb_right;
+  struct rb_node *rb_left;
+};
+
+struct sched_entity {
+  unsigned long weight;
+  struct rb_node run_node;
+};
+
+struct task {
+  int pid;
+  char comm[16];
+  union {
+    struct list_head tasks;
+    unsigned long tasks_words[2];
+  };
+  struct hlist_node pid_links;
+  struct sched_entity se;
+  char padding[64];
+} var;